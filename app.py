@@ -2,9 +2,12 @@ import google.generativeai as genai
 import os
 import logging
 import json
+import math
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, abort, url_for
+from flask import Flask, render_template, request, jsonify, abort, url_for, Response, stream_with_context
 from dotenv import load_dotenv
+import click
+import numpy as np
 
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required
@@ -12,20 +15,49 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.exc import IntegrityError
 from flask import flash, redirect
-from flask import session
-import io
-from pypdf import PdfReader
+from flask import session, g
 
 # --- NEW Langchain and FAISS imports ---
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores import FAISS
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import PromptTemplate
 from langchain.chains.question_answering import load_qa_chain
-import hashlib # For generating unique IDs for PDFs
-import shutil # For cleaning up old indexes
+from langchain_core.documents import Document
+import pickle
+import random
+import re
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from response_cache import ResponseCache, make_cache_key, normalize_question
+from single_flight import SingleFlight
+from prewarm import PromptPopularity, CachePrewarmer, PrewarmJob
+from llm_gateway import LLMGateway, LLMGatewayError, CircuitBreaker
+from summarizer import MapReduceSummarizer
+from pdf_extraction import extract_pdf_text, decode_text_bytes
+from extraction_cache import ExtractedTextCache, sha256_bytes
+from vector_store_cache import VectorStoreCache, IndexMissing
+from embedding_cache import EmbeddingStore, CachedEmbeddings
+from embedding_backends import create_embeddings, LocalHashedEmbeddings
+from bm25_index import BM25Index, reciprocal_rank_fusion
+from text_cleanup import split_pages, strip_repeated_lines, drop_near_duplicates
+from chunker import chunk_pages, count_tokens, pack_to_budget
+from faiss_formats import (
+    choose_index_type, build_vector_store, save_vector_store, open_vector_store, read_index_meta,
+    benchmark_index_types, synthetic_vectors,
+)
+from ingest_jobs import JobQueue, JobWorkerPool
+from index_registry import IndexRegistry, IndexSweeper
+from index_storage import NodeIndexCache, IndexNotFound, create_index_storage, validate_index_id
+from subject_classifier import SubjectClassifier, load_corpora
+from question_bank import (
+    VALID_ANSWERS, topic_fingerprint, question_key, unique_questions, pick_least_served,
+)
+from structured_output import salvage, strip_code_fence, text, number, boolean, array, obj, field
 
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -43,7 +75,8 @@ try:
     genai.configure(api_key=API_KEY)
     # We'll use a model suitable for various tasks (text, chat, JSON),for now i m using gemini 1.5 flash free
     # gemini-1.5-flash is generally faster and cheaper for many tasks.
-    model = genai.GenerativeModel('gemini-1.5-flash')
+    GEMINI_MODEL_NAME = 'gemini-1.5-flash'
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME)
     logging.info("Gemini API configured successfully.")
 except Exception as e:
     logging.exception(f"Error configuring Gemini API: {e}")
@@ -98,6 +131,7 @@ class User(db.Model, UserMixin):
     password_hash = db.Column(db.String(128), nullable=False) # Store hash, not password
     # Add the relationship to QuizAttempt
     quiz_attempts = db.relationship('QuizAttempt', backref='attempt_user', lazy=True, cascade="all, delete-orphan") # 'attempt_user' lets us access user from attempt
+    pdf_documents = db.relationship('PdfDocument', backref='owner', lazy=True, cascade="all, delete-orphan")
 
 
     def __repr__(self):
@@ -128,6 +162,46 @@ class QuizAttempt(db.Model):
         return f"QuizAttempt(User ID: {self.user_id}, Subject: {self.subject}, Score: {self.score}/{self.total_questions}, Time: {self.timestamp})"
 
 
+class QuizQuestion(db.Model):
+    """A validated generated quiz question, banked so later quizzes on the same topic can skip the AI call."""
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(50), nullable=False)
+    topic_fingerprint = db.Column(db.String(32), nullable=False) # See question_bank.topic_fingerprint
+    difficulty = db.Column(db.String(10), nullable=False)
+    question_key = db.Column(db.String(32), nullable=False) # Normalised question text hash, for duplicate detection
+    question = db.Column(db.Text, nullable=False)
+    options = db.Column(db.Text, nullable=False) # JSON list of the 4 option strings
+    correct_answer = db.Column(db.String(1), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    times_served = db.Column(db.Integer, nullable=False, default=0)
+    last_served_at = db.Column(db.DateTime)
+    __table_args__ = (
+        db.UniqueConstraint('subject', 'topic_fingerprint', 'difficulty', 'question_key', name='uq_quiz_question'),
+    )
+
+    def to_quiz_item(self):
+        return {"question": self.question, "options": json.loads(self.options), "correct_answer": self.correct_answer}
+
+    def __repr__(self):
+        return f"QuizQuestion(Subject: {self.subject}, Difficulty: {self.difficulty}, Served: {self.times_served})"
+
+
+class PdfDocument(db.Model):
+    """A PDF the user has processed for Q&A; index_id names its (possibly shared) FAISS index in index storage."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    # Stored in the column created as index_path (db.create_all() never alters existing tables); rows written
+    # before index storage held absolute paths and are rewritten by upgrade_pdf_document_index_ids() at startup
+    index_id = db.Column('index_path', db.String(500), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('user_id', 'index_path', name='uq_pdf_document_user_index'),)
+
+    def __repr__(self):
+        return f"PdfDocument(User ID: {self.user_id}, File: {self.filename})"
+
+
 @login_manager.user_loader
 def load_user(user_id):
     """Loads user from the database based on user_id stored in session."""
@@ -183,47 +257,381 @@ if not os.path.exists(FAISS_INDEX_DIR):
 
 
 
+# --- AI Response Cache ---
+# Identical prompts (same topic typed by a whole class) are served from cache instead of calling Gemini again.
+AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+AI_CACHE_TTLS = { # Seconds, per endpoint. Stable factual content can live longer than personalised output.
+    'summary': 24 * 3600,
+    'summary_chunk': 7 * 24 * 3600, # Per-section summaries of long uploads, keyed by section content
+    'visual_description': 7 * 24 * 3600,
+    'quiz': 10 * 60,
+    'battle_flow': 7 * 24 * 3600,
+    'map_info': 7 * 24 * 3600,
+    'writing_feedback': 24 * 3600,
+    'chemical_equation': 30 * 24 * 3600,
+    'biological_process': 7 * 24 * 3600,
+    'flashcards': 24 * 3600,
+    'chatbot': 3600,
+}
+response_cache = ResponseCache(
+    os.path.join(instance_path, "ai_response_cache.db"),
+    max_memory_entries=int(os.getenv('AI_CACHE_MEMORY_ENTRIES', 512)),
+    max_disk_entries=int(os.getenv('AI_CACHE_DISK_ENTRIES', 20000)),
+    endpoint_ttls=AI_CACHE_TTLS,
+)
+
+# Concurrent identical prompts (a class all clicking "Generate" at once) share one upstream call.
+single_flight = SingleFlight(os.path.join(instance_path, "single_flight"))
+
+# How often each input of the free-text, stable-answer endpoints is requested; the pre-warmer keeps the top ones cached.
+prompt_popularity = PromptPopularity(os.path.join(instance_path, "prompt_popularity.db"))
+
+
+# --- LLM Gateway ---
+# Every route calls Gemini through this one object: cache, coalescing, deadlines, retries, circuit breaker.
+AI_DEADLINES = { # Seconds, per endpoint, including retries. Long documents get more time.
+    'summary': 60,
+    'writing_feedback': 60,
+    'quiz': 45,
+    'chatbot': 20,
+}
+llm_gateway = LLMGateway(
+    model,
+    GEMINI_MODEL_NAME,
+    cache=response_cache if AI_CACHE_ENABLED else None,
+    single_flight=single_flight,
+    deadlines=AI_DEADLINES,
+    default_deadline=int(os.getenv('AI_DEFAULT_DEADLINE', 30)),
+    max_retries=int(os.getenv('AI_MAX_RETRIES', 2)),
+    max_concurrency=int(os.getenv('AI_MAX_CONCURRENCY', 8)),
+    max_streams=int(os.getenv('AI_MAX_STREAMS', 4)), # SSE streams, bounded separately from AI_MAX_CONCURRENCY
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv('AI_BREAKER_THRESHOLD', 5)),
+        reset_timeout=int(os.getenv('AI_BREAKER_RESET_SECONDS', 30)),
+    ),
+)
+
+
+# Long uploads are summarized section by section in parallel, then the partial summaries are combined.
+summarizer = MapReduceSummarizer(
+    llm_gateway,
+    single_pass_tokens=int(os.getenv('SUMMARY_SINGLE_PASS_TOKENS', 12000)),
+    chunk_tokens=int(os.getenv('SUMMARY_CHUNK_TOKENS', 6000)),
+    max_workers=int(os.getenv('SUMMARY_MAX_WORKERS', 4)),
+)
+
+
+def generate_ai_text(endpoint, prompt, generation_config=None, store=True):
+    """
+    Calls Gemini through the gateway and returns an AIResult (text, block_reason, ...).
+    Set store=False for structured output so it is only cached (via cache_ai_result) after validation.
+    """
+    result = llm_gateway.generate(endpoint, prompt, generation_config, store=store)
+    if result.cached or result.shared:
+        g.ai_served_without_upstream = True
+    return result
+
+
+def cache_ai_result(endpoint, result):
+    """Stores a validated AI result in the response cache."""
+    llm_gateway.store_result(endpoint, result)
+
+
+def used_upstream_quota(response):
+    """Limiter hook: cache hits and coalesced requests don't count against the per-minute AI limits."""
+    return not g.get('ai_served_without_upstream', False)
+
+
+def ai_error_status(error):
+    """HTTP status for a failed AI call: 503/504 when the gateway failed fast, 500 otherwise."""
+    return error.status_code if isinstance(error, LLMGatewayError) else 500
+
+
+def wants_stream():
+    """True when the client opted into Server-Sent Events with ?stream=1."""
+    return request.args.get('stream') in ('1', 'true')
+
+
+def sse_response(endpoint, prompt, empty_message):
+    """
+    Streams a generation to the browser as Server-Sent Events.
+    Each chunk is sent as {"delta": ...}; the stream ends with a 'done' or 'error' event.
+    """
+    def events():
+        produced = False
+        try:
+            for chunk in llm_gateway.stream(endpoint, prompt):
+                produced = produced or bool(chunk.strip())
+                yield f"data: {json.dumps({'delta': chunk})}\n\n"
+            if not produced:
+                logging.warning(f"Streamed '{endpoint}' generation is empty.")
+                yield f"data: {json.dumps({'delta': empty_message})}\n\n"
+            logging.info(f"Streamed '{endpoint}' generation completed.")
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            logging.exception(f"Error during streamed '{endpoint}' generation: {e}")
+            message = str(e) if isinstance(e, LLMGatewayError) else f"An internal error occurred during generation. Details: {str(e)}"
+            yield f"event: error\ndata: {json.dumps({'error': message})}\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}, # Stop proxies buffering the stream
+    )
+
+
+# --- Extracted Text Cache ---
+# The same lecture PDF uploaded to summary, feedback or Q&A is parsed once, keyed by the SHA-256 of its bytes.
+extracted_text_cache = ExtractedTextCache(
+    os.path.join(instance_path, "extracted_text"),
+    max_bytes=int(os.getenv('EXTRACTED_TEXT_CACHE_MB', 500)) * 1024 * 1024,
+)
+
+
 # --- Langchain Helper Functions ---
 
 def get_pdf_text_from_file_storage(pdf_file_storage):
-    text = ""
     try:
-        pdf_stream = io.BytesIO(pdf_file_storage.read())
-        pdf_reader = PdfReader(pdf_stream)
-        if pdf_reader.is_encrypted:
-            try: pdf_reader.decrypt('')
-            except Exception: logging.warning(f"Could not decrypt PDF {pdf_file_storage.filename}")
-        for page in pdf_reader.pages:
-            page_text = page.extract_text()
-            if page_text: text += page_text + "\n"
+        return extract_pdf_text(pdf_file_storage.read(), pdf_file_storage.filename, cache=extracted_text_cache).text
     except Exception as e:
         logging.error(f"Error reading PDF file {pdf_file_storage.filename}: {e}")
         raise
-    return text
 
 
-def get_text_chunks_langchain(text):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=10000, chunk_overlap=1000)
-    chunks = text_splitter.split_text(text)
-    return chunks
+# PDF Q&A chunks are sized in (estimated) model tokens and follow headings and pages; see chunker.chunk_pages
+QA_CHUNK_TOKENS = int(os.getenv('QA_CHUNK_TOKENS', 400))
+QA_CHUNK_OVERLAP_TOKENS = int(os.getenv('QA_CHUNK_OVERLAP_TOKENS', 50))
+
+# --- PDF Q&A Caches ---
+# Question embeddings (by normalized question) and final answers (by index content hash + normalized question),
+# so a question the class has already asked about the same document costs no upstream calls.
+QA_CACHE_TTLS = {
+    'query_embedding': int(os.getenv('QA_EMBEDDING_CACHE_TTL_SECONDS', 7 * 24 * 3600)),
+    'pdf_qa_answer': int(os.getenv('QA_ANSWER_CACHE_TTL_SECONDS', 24 * 3600)),
+}
+qa_cache = ResponseCache(
+    os.path.join(instance_path, "pdf_qa_cache.db"),
+    max_memory_entries=int(os.getenv('QA_CACHE_MEMORY_ENTRIES', 1024)),
+    max_disk_entries=int(os.getenv('QA_CACHE_DISK_ENTRIES', 50000)),
+    endpoint_ttls=QA_CACHE_TTLS,
+)
+
+# Embedding backend, chosen per deployment: "google" (Gemini embedding API) or "local" (NumPy hashed TF-IDF,
+# optionally with an LSA projection fitted by `flask fit-local-embeddings`; no network needed)
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'google')
+GOOGLE_EMBEDDING_MODEL = os.getenv('GOOGLE_EMBEDDING_MODEL', "models/embedding-001")
+LOCAL_EMBEDDING_MODEL_PATH = os.getenv('LOCAL_EMBEDDING_MODEL_PATH', os.path.join(instance_path, "local_embeddings.npz"))
+# Chunk embeddings are stored locally so re-indexing a document someone already indexed costs no API calls
+embedding_store = EmbeddingStore(os.path.join(instance_path, "embedding_cache.db"))
+
+
+@lru_cache(maxsize=1)
+def get_embeddings_client():
+    """Returns the long-lived embeddings client shared by ingestion and questions in this worker (remote backends locally cached)."""
+    embeddings = create_embeddings(
+        EMBEDDING_BACKEND,
+        api_key=API_KEY,
+        google_model=GOOGLE_EMBEDDING_MODEL,
+        local_model_path=LOCAL_EMBEDDING_MODEL_PATH,
+    )
+    logging.info(f"Using '{EMBEDDING_BACKEND}' embedding backend ({embeddings.model_name}).")
+    if getattr(embeddings, 'is_local', False):
+        return embeddings
+    return CachedEmbeddings(
+        embeddings, embedding_store, embeddings.model_name,
+        query_cache=qa_cache if AI_CACHE_ENABLED else None,
+    )
+
+
+# Large documents can be indexed with quantized (SQ8 / IVF-PQ) FAISS indexes; see faiss_formats.choose_index_type
+QA_INDEX_TYPE = os.getenv('QA_INDEX_TYPE', 'auto') # auto, flat, sq8, ivf_sq8 or ivf_pq
+QA_QUANTIZE_MIN_CHUNKS = int(os.getenv('QA_QUANTIZE_MIN_CHUNKS', 2000))
+QA_PQ_MIN_CHUNKS = int(os.getenv('QA_PQ_MIN_CHUNKS', 20000))
+QA_INDEX_MMAP = os.getenv('QA_INDEX_MMAP', 'true').lower() in ('1', 'true', 'yes')
+QA_IVF_NPROBE = int(os.getenv('QA_IVF_NPROBE', 16))
 
-def create_and_save_vector_store(text_chunks, index_path):
-    """Creates a FAISS vector store from text chunks and saves it locally."""
-    try:
-        embeddings = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            google_api_key=API_KEY 
-        )
 
-        vector_store = FAISS.from_texts(text_chunks, embedding=embeddings)
-        vector_store.save_local(index_path)
-        logging.info(f"FAISS vector store saved to: {index_path}")
+def load_vector_store(index_path):
+    """
+    Opens a saved FAISS index, memory-mapped so workers share its pages (used by vector_store_cache on a miss).
+    Raises IncompatibleIndex for an index embedded with another model than the current backend's.
+    """
+    embeddings = get_embeddings_client()
+    return open_vector_store(index_path, embeddings, mmap=QA_INDEX_MMAP, nprobe=QA_IVF_NPROBE, model_name=embeddings.model_name)
+
+
+# Loaded FAISS indexes stay in memory between questions; reloaded if the files change on disk
+vector_store_cache = VectorStoreCache(
+    load_vector_store,
+    max_bytes=int(os.getenv('VECTOR_STORE_CACHE_MB', 512)) * 1024 * 1024,
+)
+
+
+EMBEDDING_PROGRESS_BATCH = 20 # Chunks embedded between progress updates
+
+
+def create_and_save_vector_store(text_chunks, index_path, progress=None, metadatas=None):
+    """
+    Creates a FAISS vector store from text chunks and saves it locally. progress(fraction) is called as chunks are embedded.
+    The index is written to a scratch directory and renamed into place, so readers never see a half-written index
+    and a concurrent build of the same document simply loses the rename.
+    """
+    building_path = os.path.join(FAISS_INDEX_DIR, ".building", f"{os.path.basename(index_path)}-{uuid.uuid4().hex[:8]}")
+    try:
+        embeddings = get_embeddings_client()
+
+        vectors = []
+        for i in range(0, len(text_chunks), EMBEDDING_PROGRESS_BATCH):
+            vectors.extend(embeddings.embed_documents(text_chunks[i:i + EMBEDDING_PROGRESS_BATCH]))
+            if progress:
+                progress(len(vectors) / len(text_chunks))
+        index_type = choose_index_type(len(text_chunks), QA_INDEX_TYPE, QA_QUANTIZE_MIN_CHUNKS, QA_PQ_MIN_CHUNKS)
+        vector_store = build_vector_store(text_chunks, vectors, embeddings, index_type, metadatas)
+        save_vector_store(vector_store, building_path, index_type, embeddings.model_name)
+        BM25Index.build(text_chunks).save(building_path) # Keyword index for hybrid retrieval, saved with the vectors
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        try:
+            os.rename(building_path, index_path)
+        except OSError:
+            if not os.path.isdir(index_path):
+                raise
+            logging.info(f"FAISS vector store {index_path} was saved by another worker first.")
+        logging.info(f"FAISS vector store ({index_type}, {len(text_chunks)} chunks) saved to: {index_path}")
     except Exception as e:
         logging.error(f"Error creating/saving vector store at {index_path}: {e}")
         raise
+    finally:
+        shutil.rmtree(building_path, ignore_errors=True)
+
+def chunk_documents(vector_store, chunk_ids=None):
+    """Returns stored chunks by position (the order they were embedded), or all of them."""
+    if chunk_ids is None:
+        chunk_ids = range(len(vector_store.index_to_docstore_id))
+    return [vector_store.docstore.search(vector_store.index_to_docstore_id[i]) for i in chunk_ids]
+
+
+def load_lexical_index(index_path):
+    try:
+        return BM25Index.load(index_path)
+    except FileNotFoundError:
+        # Index built before keyword search existed: derive it from the chunks stored with the vectors
+        logging.info(f"[PDF_QA_ASK] No BM25 file in {index_path}; building it in memory.")
+        return BM25Index.build([doc.page_content for doc in chunk_documents(vector_store_cache.get(index_path))])
+
+
+lexical_index_cache = VectorStoreCache(
+    load_lexical_index,
+    max_bytes=int(os.getenv('LEXICAL_INDEX_CACHE_MB', 128)) * 1024 * 1024,
+)
+
+QA_CANDIDATES = 12 # Per retriever, before fusion and packing
+QA_CONTEXT_TOKENS = int(os.getenv('QA_CONTEXT_TOKENS', 2000)) # Budget for retrieved text in each QA prompt
+# Share of the question's IDF weight the best keyword match must cover to skip the embedding call
+BM25_FAST_PATH_COVERAGE = float(os.getenv('BM25_FAST_PATH_COVERAGE', 0.85))
+
+
+# Each selected document's index is searched on this pool; FAISS and NumPy release the GIL while they work
+retrieval_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('QA_RETRIEVAL_THREADS', 4)), thread_name_prefix="qa-retrieval"
+)
+
+
+def _tag_source(documents, index_path):
+    """Copies cached chunks with the index they came from (the cached ones are shared), so answers can cite each document."""
+    return [Document(page_content=doc.page_content, metadata={**doc.metadata, "index_path": index_path}) for doc in documents]
+
 
+def _whole_document(index_path):
+    """All chunks of a document small enough to skip ranking, otherwise None."""
+    if lexical_index_cache.get(index_path).num_docs > QA_CANDIDATES:
+        return None
+    return _tag_source(chunk_documents(vector_store_cache.get(index_path)), index_path)
+
+
+def _lexical_candidates(index_path, question):
+    """Keyword hits in one index as (document, score, coverage), with scores comparable across indexes."""
+    hits = lexical_index_cache.get(index_path).search(question, k=QA_CANDIDATES)
+    if not hits:
+        return []
+    documents = _tag_source(chunk_documents(vector_store_cache.get(index_path), [doc_id for doc_id, _, _ in hits]), index_path)
+    # Raw BM25 scores depend on each index's term statistics; scaling by the index's best score and how much
+    # of the question that hit covers keeps the order within a document and ranks better-matching documents first
+    top_score, top_coverage = hits[0][1], hits[0][2]
+    return [
+        (doc, (score / top_score) * top_coverage if top_score > 0 else 0.0, coverage)
+        for doc, (_, score, coverage) in zip(documents, hits)
+    ]
+
+
+def _semantic_candidates(index_path, query_vector):
+    """Vector hits in one index as (document, L2 distance); distances from one embedding model compare across indexes."""
+    vector_store = vector_store_cache.get(index_path)
+    if vector_store.index.d != len(query_vector): # Built by another model before index metadata recorded it
+        logging.warning(f"[PDF_QA_ASK] {index_path} has {vector_store.index.d}-d vectors, the query {len(query_vector)}-d; "
+                        "using keyword search only for it.")
+        return []
+    hits = vector_store.similarity_search_with_score_by_vector(query_vector, k=QA_CANDIDATES)
+    return list(zip(_tag_source([doc for doc, _ in hits], index_path), [distance for _, distance in hits]))
+
+
+def _unique_texts(documents):
+    return list(dict.fromkeys(doc.page_content for doc in documents))
+
+
+def retrieve_relevant_chunks(index_paths, question, token_budget=QA_CONTEXT_TOKENS):
+    """
+    Returns (documents, mode): the most relevant chunks of the selected indexes, best first, packed up to token_budget.
+    Every index is searched in parallel; keyword (BM25) and vector hits are each ranked by score across all indexes
+    and merged with reciprocal rank fusion. When the keyword match is confident, or every document fits in the
+    budget, no query embedding is requested.
+    """
+    whole = list(retrieval_executor.map(_whole_document, index_paths))
+    if all(documents is not None for documents in whole):
+        everything = [doc for documents in whole for doc in documents]
+        if sum(count_tokens(doc.page_content) for doc in everything) <= token_budget:
+            return everything, 'all'
+
+    lexical = [hit for hits in retrieval_executor.map(lambda path: _lexical_candidates(path, question), index_paths) for hit in hits]
+    lexical.sort(key=lambda hit: hit[1], reverse=True)
+    if lexical and max(coverage for _, _, coverage in lexical) >= BM25_FAST_PATH_COVERAGE:
+        return pack_to_budget([doc for doc, _, _ in lexical], token_budget), 'lexical'
+
+    query_vector = get_embeddings_client().embed_query(question) # Embedded once for every index
+    semantic = [hit for hits in retrieval_executor.map(lambda path: _semantic_candidates(path, query_vector), index_paths) for hit in hits]
+    semantic.sort(key=lambda hit: hit[1])
+    by_text = {}
+    for doc in [doc for doc, _ in semantic] + [doc for doc, _, _ in lexical]:
+        by_text.setdefault(doc.page_content, doc)
+    fused = reciprocal_rank_fusion([
+        _unique_texts(doc for doc, _ in semantic),
+        _unique_texts(doc for doc, _, _ in lexical),
+    ])
+    return pack_to_budget([by_text[text] for text in fused], token_budget), 'hybrid'
+
+
+def source_pages(documents):
+    """Sorted page numbers covered by the retrieved chunks (empty for indexes built without page metadata)."""
+    pages = set()
+    for doc in documents:
+        if 'page_start' in doc.metadata:
+            pages.update(range(doc.metadata['page_start'], doc.metadata['page_end'] + 1))
+    return sorted(pages)
+
+
+def cited_sources(documents):
+    """Groups retrieved chunks by index: [{"index_path", "pages"}], in order of each document's best chunk."""
+    by_index = {}
+    for doc in documents:
+        by_index.setdefault(doc.metadata.get('index_path'), []).append(doc)
+    return [{"index_path": index_path, "pages": source_pages(docs)} for index_path, docs in by_index.items()]
+
+
+QA_MODEL_NAME = "gemini-1.5-flash"
+
+
+@lru_cache(maxsize=1)
 def get_conversational_qa_chain():
-    """Loads and returns a Langchain QA chain with a specific prompt."""
+    """Builds the Langchain QA chain once per worker and returns it."""
     prompt_template = """
     You are an AI assistant tasked with answering questions based ONLY on the provided context from a document.
     Read the context carefully. If the answer is found within the context, provide a clear and concise answer.
@@ -241,7 +649,7 @@ def get_conversational_qa_chain():
     """
 
     llm_model = ChatGoogleGenerativeAI(
-        model="gemini-1.5-flash",
+        model=QA_MODEL_NAME,
         temperature=0.3,
         google_api_key=API_KEY # Use the API_KEY loaded from .env
     )
@@ -343,7 +751,7 @@ def subject_page(subject):
 # --- API Endpoints for AI Features ---
 
 @app.route('/generate-summary', methods=['POST'])
-@limiter.limit("10 per minute")
+@limiter.limit("10 per minute", deduct_when=used_upstream_quota)
 def generate_summary():
     """
     Generates a summary from either pasted text (JSON) or an uploaded file (FormData).
@@ -377,39 +785,16 @@ def generate_summary():
 
             if file_extension == 'txt':
                 try:
-                    text_bytes = file.read()
-                    try:
-                        text_to_summarize = text_bytes.decode('utf-8')
-                    except UnicodeDecodeError:
-                         logging.warning(f"UTF-8 decode failed for {filename}, trying latin-1")
-                         text_to_summarize = text_bytes.decode('latin-1', errors='ignore')
+                    text_to_summarize = decode_text_bytes(file.read(), filename)
                     logging.info(f"Successfully read text from {filename}")
                 except Exception as e:
                      raise IOError(f"Could not read .txt file: {e}")
 
             elif file_extension == 'pdf':
                 try:
-                    pdf_stream = io.BytesIO(file.read())
-                    reader = PdfReader(pdf_stream)
-                    extracted_pages = []
-                    if reader.is_encrypted:
-                         # Try decrypting with an empty password, log if it fails
-                         try:
-                              reader.decrypt('')
-                              logging.info(f"Decrypted PDF {filename} with empty password.")
-                         except Exception as decrypt_e:
-                              logging.warning(f"Could not decrypt PDF {filename}: {decrypt_e}. Extraction might fail.")
-                              # Optional: return error if decryption needed but failed
-                              # raise IOError(f"PDF file '{filename}' is encrypted and could not be decrypted.")
-
-                    for i, page in enumerate(reader.pages):
-                        try:
-                            extracted_pages.append(page.extract_text() or "")
-                        except Exception as page_e:
-                            logging.warning(f"Could not extract text from page {i+1} of {filename}: {page_e}")
-                            extracted_pages.append("")
-                    text_to_summarize = "\n".join(extracted_pages)
-                    logging.info(f"Successfully extracted text from {len(reader.pages)} page(s) in {filename}")
+                    extracted = extract_pdf_text(file.read(), filename, cache=extracted_text_cache)
+                    text_to_summarize = extracted.text
+                    logging.info(f"Successfully extracted text from {extracted.page_count} page(s) in {filename}")
                 except Exception as e:
                      logging.exception(f"Error reading PDF file {filename}: {e}")
                      raise IOError(f"Could not process PDF file: {e}")
@@ -442,20 +827,18 @@ def generate_summary():
     # --- Text Extracted/Received - Now calling Gemini API ---
     try:
         logging.info(f"Generating summary using Gemini API for content from {input_source_description}...")
-        # (Optional text truncation logic can go here)
+        # Long documents are summarized chunk by chunk first; this returns the final (single or reduce) prompt
+        prompt = summarizer.build_prompt(text_to_summarize)
+        if wants_stream():
+            return sse_response('summary', prompt, f"Sorry, I couldn't generate a meaningful summary for the content from {input_source_description}.")
 
-        prompt = f"Summarize the following text concisely for a secondary school student. Focus on the main points and key information:\n\n---\n{text_to_summarize}\n---"
-        response = model.generate_content(prompt)
-
-        # (Keep the same response handling logic as before to extract summary_text and check for blocks/empty results)
-        summary_text = ""
-        if response.parts: summary_text = response.parts[0].text
-        elif hasattr(response, 'text'): summary_text = response.text
+        result = generate_ai_text('summary', prompt)
+        summary_text = result.text
 
         if not summary_text.strip():
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
+             if result.block_reason:
                  # ... (handle block reason) ...
-                 block_reason = response.prompt_feedback.block_reason
+                 block_reason = result.block_reason
                  logging.warning(f"Summary generation blocked for {input_source_description}: {block_reason}")
                  return jsonify({"error": f"Content blocked due to: {block_reason}. Try different content."}), 400
 
@@ -471,17 +854,22 @@ def generate_summary():
     except Exception as e:
         # (Keep the same general exception handling for the API call)
         logging.exception(f"Error during summary generation API call for {input_source_description}: {e}")
-        block_reason_msg = ""
-        try:
-            if response and response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
-                 logging.warning(f"Summary generation potentially blocked for {input_source_description}: {block_reason}")
-                 block_reason_msg = f" Content may be blocked ({block_reason})."
-        except NameError: pass
-        except AttributeError: pass
-        return jsonify({"error": f"An internal error occurred during summary generation.{block_reason_msg} Details: {str(e)}"}), 500
+        return jsonify({"error": f"An internal error occurred during summary generation. Details: {str(e)}"}), ai_error_status(e)
 # === END REVISED /generate-summary route ===
 
+def visual_description_prompt(topic):
+    """Shared with the cache pre-warmer, which must build exactly the prompt (and so the cache key) the route does."""
+    return f"""
+        Generate a detailed yet easy-to-understand description (around 6-10 sentences) to help a B Tech. engineering college student visualize the concept or topic of '{topic}'.
+        Focus on imagery, analogies, or easy-to-picture scenes. Avoid overly technical jargon but provide enough detail for a good mental picture.
+        {'''
+        Example for 'Gravity': 'Imagine the Earth like a giant, slightly stretchy trampoline. Anything with mass, like you or an apple, creates a small dip. Things naturally roll 'downhill' into these dips towards the object – that's gravity pulling them in! The bigger the mass, the deeper the dip, the stronger the pull.'
+        Example for 'Photosynthesis': 'Think of a tiny solar-powered kitchen inside a plant leaf. It uses sunlight energy, water sucked up by roots, and carbon dioxide from the air to cook up sugary food (glucose) for the plant's energy. As a bonus, it releases the oxygen we breathe as a waste product. This process is vital for life on Earth.'
+        '''}
+        Now, generate a description for: '{topic}'
+        """
+
+
 @app.route('/generate-visual-description', methods=['POST'])
 def generate_visual_description():
     """Generates a text description to aid visualization."""
@@ -499,25 +887,15 @@ def generate_visual_description():
 
     try:
         logging.info(f"Generating visual description for topic: {topic}")
-        prompt = f"""
-        Generate a detailed yet easy-to-understand description (around 6-10 sentences) to help a B Tech. engineering college student visualize the concept or topic of '{topic}'.
-        Focus on imagery, analogies, or easy-to-picture scenes. Avoid overly technical jargon but provide enough detail for a good mental picture.
-        {'''
-        Example for 'Gravity': 'Imagine the Earth like a giant, slightly stretchy trampoline. Anything with mass, like you or an apple, creates a small dip. Things naturally roll 'downhill' into these dips towards the object – that's gravity pulling them in! The bigger the mass, the deeper the dip, the stronger the pull.'
-        Example for 'Photosynthesis': 'Think of a tiny solar-powered kitchen inside a plant leaf. It uses sunlight energy, water sucked up by roots, and carbon dioxide from the air to cook up sugary food (glucose) for the plant's energy. As a bonus, it releases the oxygen we breathe as a waste product. This process is vital for life on Earth.'
-        '''}
-        Now, generate a description for: '{topic}'
-        """
+        prompt_popularity.record('visual_description', topic)
+        prompt = visual_description_prompt(topic)
         
-        response = model.generate_content(prompt)
-
-        description_text = ""
-        if response.parts: description_text = response.parts[0].text
-        elif hasattr(response, 'text'): description_text = response.text
+        result = generate_ai_text('visual_description', prompt)
+        description_text = result.text
 
         if not description_text.strip():
-            if response.prompt_feedback and response.prompt_feedback.block_reason:
-                block_reason = response.prompt_feedback.block_reason
+            if result.block_reason:
+                block_reason = result.block_reason
                 logging.warning(f"Visualization generation blocked: {block_reason}")
                 return jsonify({"error": f"Content blocked due to: {block_reason}. Try a different topic."}), 400
             else:
@@ -529,13 +907,297 @@ def generate_visual_description():
 
     except Exception as e:
         logging.exception(f"Error during visual description generation API call: {e}")
-        return jsonify({"error": f"An internal error occurred during visualization generation: {str(e)}"}), 500
+        return jsonify({"error": f"An internal error occurred during visualization generation: {str(e)}"}), ai_error_status(e)
 
 
 
+# --- Quiz Question Bank ---
+# Every validated generated question is banked per (subject, topic fingerprint, difficulty). Quizzes are assembled
+# from the bank first, and only the shortfall is generated, so repeated classroom topics need no AI call.
+QUIZ_BANK_ENABLED = os.getenv('QUIZ_BANK_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+QUIZ_BANK_RECENT_ATTEMPTS = int(os.getenv('QUIZ_BANK_RECENT_ATTEMPTS', 20)) # Questions in this many of a user's latest attempts aren't reused
+
+
+def recently_seen_question_keys(subject):
+    """Keys of the questions in the current user's most recent attempts for a subject (none when logged out)."""
+    if not current_user.is_authenticated:
+        return set()
+    attempts = (QuizAttempt.query.filter_by(user_id=current_user.id, subject=subject)
+                .order_by(QuizAttempt.timestamp.desc()).limit(QUIZ_BANK_RECENT_ATTEMPTS).all())
+    keys = set()
+    for attempt in attempts:
+        try:
+            questions = json.loads(attempt.quiz_data)
+        except (json.JSONDecodeError, TypeError):
+            continue
+        for q in questions if isinstance(questions, list) else []:
+            if isinstance(q, dict) and isinstance(q.get('question'), str):
+                keys.add(question_key(q['question']))
+    return keys
+
+
+def banked_quiz_questions(subject, fingerprint, difficulty):
+    return QuizQuestion.query.filter_by(subject=subject, topic_fingerprint=fingerprint, difficulty=difficulty).all()
+
+
+def bank_quiz_questions(subject, fingerprint, difficulty, questions):
+    """Adds validated questions to the bank (skipping ones already there); returns the new rows."""
+    existing = banked_quiz_questions(subject, fingerprint, difficulty)
+    rows = []
+    for q in unique_questions(questions, existing=[row.question for row in existing]):
+        rows.append(QuizQuestion(
+            subject=subject, topic_fingerprint=fingerprint, difficulty=difficulty,
+            question_key=question_key(q['question']), question=q['question'],
+            options=json.dumps(q['options']), correct_answer=q['correct_answer'],
+        ))
+    db.session.add_all(rows)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback() # A concurrent request banked the same questions first
+        logging.info(f"[QUIZ_BANK] Questions for {subject}/{fingerprint[:8]} were banked concurrently; skipped.")
+        return []
+    return rows
+
+
+def mark_quiz_questions_served(rows):
+    now = datetime.utcnow()
+    for row in rows:
+        row.times_served += 1
+        row.last_served_at = now
+    db.session.commit()
+
+
+# --- Subject Relevance Pre-Classifier ---
+# A local TF-IDF classifier, trained on subject_corpora/ plus the questions banked for each subject, rejects
+# clearly non-academic quiz text before any AI call and lets confidently on-subject text skip the model's
+# relevance step; only ambiguous text is left to the model.
+SUBJECT_CLASSIFIER_ENABLED = os.getenv('SUBJECT_CLASSIFIER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SUBJECT_CORPORA_DIR = os.path.join(app.root_path, "subject_corpora")
+SUBJECT_ACCEPT_CONFIDENCE = float(os.getenv('SUBJECT_ACCEPT_CONFIDENCE', 0.8))
+SUBJECT_REJECT_CONFIDENCE = float(os.getenv('SUBJECT_REJECT_CONFIDENCE', 0.8)) # Probability the text is non-academic
+SUBJECT_CLASSIFIER_RETRAIN_SECONDS = 3600 # Picks up newly banked questions
+SUBJECT_CLASSIFIER_BANKED_QUESTIONS = 2000 # Most recent banked questions per subject used for training
+
+
+@lru_cache(maxsize=1)
+def get_subject_classifier(training_period):
+    """Trains this worker's classifier; callers pass the current retraining period so it is rebuilt periodically."""
+    corpora = load_corpora(SUBJECT_CORPORA_DIR)
+    for subject in corpora:
+        banked = (QuizQuestion.query.with_entities(QuizQuestion.question).filter_by(subject=subject)
+                  .order_by(QuizQuestion.created_at.desc()).limit(SUBJECT_CLASSIFIER_BANKED_QUESTIONS).all())
+        corpora[subject] = corpora[subject] + [question for (question,) in banked]
+    classifier = SubjectClassifier.train(corpora)
+    logging.info(f"[SUBJECT_CLASSIFIER] Trained on {sum(len(p) for p in corpora.values())} passages, {len(classifier.vocabulary)} terms.")
+    return classifier
+
+
+def classify_quiz_subject(source_text, subject):
+    """Returns the classifier's SubjectDecision for quiz text, logging the decision and its confidence."""
+    classifier = get_subject_classifier(int(time.time() // SUBJECT_CLASSIFIER_RETRAIN_SECONDS))
+    decision = classifier.classify(
+        source_text, subject, accept_at=SUBJECT_ACCEPT_CONFIDENCE, reject_at=SUBJECT_REJECT_CONFIDENCE,
+    )
+    confidence = "n/a" if decision.confidence is None else f"{decision.confidence:.3f}"
+    logging.info(
+        f"[SUBJECT_CLASSIFIER] subject={subject} verdict={decision.verdict} confidence={confidence} "
+        f"best={decision.best_label} known_terms={decision.known_terms}/{decision.total_terms}"
+    )
+    return decision
+
+
+# --- Quiz Generation ---
+# Large quizzes are generated as several smaller concurrent requests ("shards") on a bounded pool, so wall-clock
+# time is close to the slowest shard's rather than one long generation; a shard keeps its valid questions and
+# re-requests only the ones that failed validation, instead of failing the whole quiz.
+QUIZ_SHARD_SIZE = int(os.getenv('QUIZ_SHARD_SIZE', 8)) # Questions per generation request
+QUIZ_SHARD_RETRIES = int(os.getenv('QUIZ_SHARD_RETRIES', 1))
+quiz_shard_pool = ThreadPoolExecutor(max_workers=int(os.getenv('QUIZ_MAX_WORKERS', 4)), thread_name_prefix="quiz-shard")
+
+
+class QuizNotRelevant(ValueError):
+    """The model judged the source text unrelated to the quiz subject."""
+
+
+class QuizBlocked(ValueError):
+    """The model refused to generate (safety block)."""
+
+
+def quiz_not_relevant_message(subject):
+    return f"The provided text does not seem to be related to {subject.capitalize()}. Please provide relevant text to generate a quiz."
+
+
+def quiz_prompt(subject, source_text, count, difficulty_description, avoid_repeating="", part=None, check_relevance=True):
+    """
+    Builds the quiz generation prompt; part=(i, n) asks shard i of n to cover its own share of the topic.
+    check_relevance=False drops the relevance step, for text the local classifier already accepted.
+    """
+    task = (f"generate exactly {count} multiple-choice quiz questions of {difficulty_description} difficulty. "
+            "For each question, provide 4 options (A, B, C, D) and the correct answer letter. Return the output ONLY as "
+            'a single valid JSON list of objects, like this example: `[{"question": "...", "options": [...], "correct_answer": "..."}, ...]`.')
+    focus = ""
+    if part:
+        focus = (
+            f"This is part {part[0]} of {part[1]} of a larger quiz generated in parallel. Split the topic's sub-topics, "
+            f"in the order they are usually taught, into {part[1]} groups and ask only about group {part[0]}."
+        )
+    if not check_relevance:
+        instructions = f"""
+        You are a subject-matter expert creating a {subject.capitalize()} quiz.
+
+        Based on the following "Source Text/Topic", {task}
+
+        Do not add any explanatory text before or after your JSON output."""
+    else:
+        instructions = f"""
+        You are a strict subject-matter expert creating a quiz.
+
+        **Step 1: Analyze Relevance.** First, determine if the following "Source Text/Topic" is relevant to the subject of **{subject.capitalize()}**.
+
+        **Step 2: Generate Output.**
+        * **If the text is NOT relevant** to {subject.capitalize()}, your ONLY output MUST be this exact JSON object:
+            `{{"error": "{quiz_not_relevant_message(subject)}"}}`
+        * **If the text IS relevant**, then proceed to {task}
+
+        Do not add any explanatory text before or after your JSON output in either case."""
+    return f"""{instructions}
+        {focus}
+        {avoid_repeating}
+
+        Source Text/Topic:
+        ---
+        {source_text}
+        ---
+
+        Generate the JSON quiz now:
+        """
+
+
+def answer_letter_from_option(q):
+    """Repairs a correct_answer given as the text of one of the options (e.g. "Paris") into its letter."""
+    options, answer = q.get("options"), q.get("correct_answer")
+    if isinstance(options, list) and isinstance(answer, str) and answer.strip() not in VALID_ANSWERS:
+        texts = [option.strip().lower() if isinstance(option, str) else None for option in options]
+        if answer.strip().lower() in texts and len(texts) == len(VALID_ANSWERS):
+            q["correct_answer"] = VALID_ANSWERS[texts.index(answer.strip().lower())]
+    return q
+
+
+# Invalid questions (e.g. three options, an unknown answer letter) are dropped rather than failing the shard
+QUIZ_SCHEMA = array(
+    obj({
+        "question": text(),
+        "options": array(text(), min_items=len(VALID_ANSWERS), max_items=len(VALID_ANSWERS)),
+        "correct_answer": text(choices=VALID_ANSWERS, upper=True),
+    }, prepare=answer_letter_from_option),
+    drop_invalid=True,
+)
+
+
+def parse_quiz_json(quiz_json_string):
+    """
+    Parses a generated quiz and returns its valid questions, dropping invalid ones. Raises QuizNotRelevant for the
+    model's relevance rejection, and ValueError when no question is usable.
+    """
+    try:
+        quiz_data = json.loads(strip_code_fence(quiz_json_string)[0]) # The rejection may come fenced too
+    except json.JSONDecodeError:
+        quiz_data = None # Let salvage() report it
+    if isinstance(quiz_data, dict) and isinstance(quiz_data.get("error"), str):
+        raise QuizNotRelevant(quiz_data["error"])
+    salvaged = salvage(QUIZ_SCHEMA, quiz_json_string)
+    if salvaged.repaired or salvaged.dropped:
+        logging.info(f"[QUIZ] Repaired {len(salvaged.repaired)} and dropped {len(salvaged.dropped)} item(s): "
+                     f"{salvaged.repaired + salvaged.dropped}")
+    if not salvaged.value:
+        raise ValueError("Generated quiz contains no valid questions.")
+    return salvaged.value
+
+
+def avoid_repeating_instruction(question_texts):
+    """Prompt line listing questions the model must not repeat or rephrase ("" if there are none)."""
+    if not question_texts:
+        return ""
+    return "Do not repeat or rephrase any of these existing questions:\n" + "\n".join(f"- {q}" for q in question_texts)
+
+
+def generate_quiz_shard(prompt, generation_config):
+    """Runs on the shard pool: one generation plus validation. Returns (valid questions, AIResult)."""
+    result = llm_gateway.generate('quiz', prompt, generation_config, store=False)
+    if not result.text.strip():
+        if result.block_reason:
+            raise QuizBlocked(result.block_reason)
+        raise ValueError("AI returned an empty response for the quiz.")
+    questions = parse_quiz_json(result.text)
+    llm_gateway.store_result('quiz', result) # Only usable output is cached; a hit is salvaged the same way again
+    return questions, result
+
+
+def generate_quiz_questions(subject, source_text, count, difficulty_description, existing=(), check_relevance=True):
+    """
+    Generates about count validated questions as shards of at most QUIZ_SHARD_SIZE, run concurrently. Invalid
+    questions in a shard's output are dropped and, up to QUIZ_SHARD_RETRIES times, only the missing number is
+    re-requested (a shard with no usable output is regenerated). Questions repeating one in existing or another
+    shard's are dropped. Returns (questions, whether every shard was served from cache without a failure). A
+    relevance rejection or safety block is raised at once, cancelling the shards not yet started; if every shard
+    fails, the last error is raised.
+    """
+    num_shards = math.ceil(count / QUIZ_SHARD_SIZE)
+    sizes = [count // num_shards + (1 if i < count % num_shards else 0) for i in range(num_shards)]
+
+    def shard_prompt(i, size, avoid):
+        return quiz_prompt(subject, source_text, size, difficulty_description, avoid_repeating_instruction(avoid),
+                           part=(i + 1, num_shards) if num_shards > 1 else None, check_relevance=check_relevance)
+
+    generation_config = genai.types.GenerationConfig(response_mime_type="application/json")
+    shard_questions = {i: [] for i in range(num_shards)}
+    pending = {i: shard_prompt(i, size, list(existing)) for i, size in enumerate(sizes)}
+    last_error, served_without_upstream = None, True
+    for attempt in range(QUIZ_SHARD_RETRIES + 1):
+        futures = {i: quiz_shard_pool.submit(generate_quiz_shard, prompt, generation_config) for i, prompt in pending.items()}
+        retry = {}
+        for i, future in futures.items():
+            try:
+                questions, result = future.result()
+            except (QuizNotRelevant, QuizBlocked):
+                for other in futures.values(): # The whole quiz is refused; don't spend calls on the other shards
+                    other.cancel()
+                raise
+            except ValueError as e: # No usable output: worth regenerating
+                logging.warning(f"[QUIZ] Shard {i + 1}/{num_shards} failed validation (attempt {attempt + 1}): {e}")
+                last_error, served_without_upstream = e, False
+                retry[i] = pending[i]
+                continue
+            except Exception as e: # The gateway already retried; don't stack more retries on it
+                logging.warning(f"[QUIZ] Shard {i + 1}/{num_shards} failed: {e}")
+                last_error, served_without_upstream = e, False
+                continue
+            served_without_upstream = served_without_upstream and (result.cached or result.shared)
+            kept = shard_questions[i]
+            shard_questions[i] = kept + unique_questions(questions, existing=list(existing) + [q["question"] for q in kept])
+            missing = sizes[i] - len(shard_questions[i])
+            if missing > 0: # Re-request only what was dropped, telling the model what this shard already has
+                logging.info(f"[QUIZ] Shard {i + 1}/{num_shards} has {len(shard_questions[i])} of {sizes[i]} valid questions; "
+                             f"re-requesting {missing}.")
+                retry[i] = shard_prompt(i, missing, list(existing) + [q["question"] for q in shard_questions[i]])
+        pending = retry
+        if not pending:
+            break
+    if not any(shard_questions.values()):
+        raise last_error or ValueError("Generated quiz contains no valid questions.")
+    short = sum(1 for i in range(num_shards) if len(shard_questions[i]) < sizes[i])
+    if short:
+        logging.warning(f"[QUIZ] {short} of {num_shards} shards came back short; returning the valid questions.")
+
+    merged = unique_questions([q for i in sorted(shard_questions) for q in shard_questions[i]], existing=existing)
+    logging.info(f"[QUIZ] Generated {len(merged)} unique questions in {num_shards} shard(s).")
+    return merged[:count], served_without_upstream
+
+
 # === MODIFY the /generate-quiz route AGAIN ===
 @app.route('/generate-quiz', methods=['POST'])
-@limiter.limit("5 per minute")
+@limiter.limit("5 per minute", deduct_when=used_upstream_quota)
 def generate_quiz():
     """Generates a multiple-choice quiz based on input text/topic, difficulty, and count but first checking if the input text is relevant to given subject."""
     logging.info("Received request for /generate-quiz")
@@ -568,102 +1230,89 @@ def generate_quiz():
         "hard": "hard (suitable for challenging university level)"
     }
     difficulty_description = difficulty_map.get(difficulty, "easy (suitable for secondary school level)")
+    difficulty = difficulty if difficulty in difficulty_map else 'easy'
 
     try:
-        logging.info(f"Generating {count} {difficulty_description} quiz questions using Gemini API...")
-
-        # --- MODIFY Prompt ---
-        prompt = f"""
-        You are a strict subject-matter expert creating a quiz.
-
-        **Step 1: Analyze Relevance.** First, determine if the following "Source Text/Topic" is relevant to the subject of **{subject.capitalize()}**.
-
-        **Step 2: Generate Output.**
-        * **If the text is NOT relevant** to {subject.capitalize()}, your ONLY output MUST be this exact JSON object:
-            `{{"error": "The provided text does not seem to be related to {subject.capitalize()}. Please provide relevant text to generate a quiz."}}`
-        * **If the text IS relevant**, then proceed to generate exactly {count} multiple-choice quiz questions of {difficulty_description} difficulty. For each question, provide 4 options (A, B, C, D) and the correct answer letter. Return the output ONLY as a single valid JSON list of objects, like this example: `[{{"question": "...", "options": [...], "correct_answer": "..."}}, ...]`.
-
-        Do not add any explanatory text before or after your JSON output in either case.
-
-        Source Text/Topic:
-        ---
-        {source_text}
-        ---
-
-        Generate the JSON quiz now:
-        """
-        # --- End Modify Prompt ---
-
-        
-
-        generation_config = genai.types.GenerationConfig(
-            response_mime_type="application/json"
-        )
-
-        response = model.generate_content(prompt, generation_config=generation_config)
-        logging.info("Quiz response received from Gemini.")
-
-        quiz_json_string = ""
-        if response.parts: quiz_json_string = response.parts[0].text
-        elif hasattr(response, 'text'): quiz_json_string = response.text
-
-        if not quiz_json_string.strip():
-             # ... (keep block reason check) ...
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
-                 logging.warning(f"Quiz generation blocked: {block_reason}")
-                 return jsonify({"error": f"Content blocked due to: {block_reason}. Try different text."}), 400
-             else:
-                 logging.warning("Received empty response string for quiz JSON.")
-                 return jsonify({"error": "AI returned an empty response for the quiz."}), 500
-
-        # Validate and parse the JSON
+        # --- Serve from the question bank when it holds enough questions this user hasn't just seen ---
+        bank_subject, fingerprint = subject.strip().lower(), topic_fingerprint(source_text)
+        relevance_checked = False
+        if SUBJECT_CLASSIFIER_ENABLED:
+            decision = classify_quiz_subject(source_text, bank_subject)
+            if decision.verdict == 'reject':
+                g.ai_served_without_upstream = True # Rejected locally: no AI call made
+                return jsonify({"error": quiz_not_relevant_message(subject)}), 400
+            relevance_checked = decision.verdict == 'accept'
+        banked = []
+        if QUIZ_BANK_ENABLED:
+            banked = pick_least_served(
+                banked_quiz_questions(bank_subject, fingerprint, difficulty), count,
+                exclude_keys=recently_seen_question_keys(subject),
+            )
+            if len(banked) == count:
+                g.ai_served_without_upstream = True # No AI call: doesn't count against the rate limit
+                mark_quiz_questions_served(banked)
+                logging.info(f"[QUIZ_BANK] Served all {count} {difficulty} questions from the bank ({bank_subject}/{fingerprint[:8]}).")
+                return jsonify({"quiz": [row.to_quiz_item() for row in banked], "from_bank": count})
+        shortfall = count - len(banked)
+
+        logging.info(f"Generating {shortfall} {difficulty_description} quiz questions using Gemini API ({len(banked)} from the bank)...")
         try:
-            quiz_data = json.loads(quiz_json_string)
-
-            # --- MODIFY Validation ---
-            # Keep structural validation but REMOVE check for specific count
-            if not isinstance(quiz_data, list):
-                raise ValueError("Generated JSON response is not a list.")
-            if not quiz_data:
-                raise ValueError("Generated JSON list of questions is empty.")
-
-            for i, q in enumerate(quiz_data):
-                q_num = i + 1
-                if not isinstance(q, dict): raise ValueError(f"Item {q_num} is not an object.")
-                required_keys = ["question", "options", "correct_answer"]
-                if not all(key in q for key in required_keys): raise ValueError(f"Q {q_num} missing keys.")
-                if not isinstance(q["question"], str) or not q["question"].strip(): raise ValueError(f"Q {q_num} invalid question.")
-                if not isinstance(q["options"], list) or len(q["options"]) != 4: raise ValueError(f"Q {q_num} options invalid.")
-                if not all(isinstance(opt, str) and opt.strip() for opt in q["options"]): raise ValueError(f"Q {q_num} invalid option text.")
-                valid_answers = ["A", "B", "C", "D"]
-                correct_answer_upper = q.get("correct_answer", "").upper() # Use .get for safety
-                if not correct_answer_upper or correct_answer_upper not in valid_answers: raise ValueError(f"Q {q_num} invalid correct_answer ('{q.get('correct_answer')}').")
-            # --- End Modify Validation ---
-
-            logging.info(f"Quiz JSON ({len(quiz_data)} questions) parsed and validated successfully (requested {count} {difficulty}).")
-            return jsonify({"quiz": quiz_data}) # Return the potentially variable length list
-
-        except (json.JSONDecodeError, ValueError) as e:
-             # ... (keep existing JSON/Validation error handling) ...
-             logging.error(f"Quiz JSON processing error: {e}\nReceived: {quiz_json_string}")
-             return jsonify({"error": f"AI response was not valid quiz JSON or failed validation: {e}"}), 500
-        except Exception as e:
-             # ... (keep existing unexpected error handling) ...
-             logging.exception(f"Unexpected error processing quiz JSON: {e}")
-             return jsonify({"error": "An unexpected error occurred processing quiz data."}), 500
+            generated, served_without_upstream = generate_quiz_questions(
+                subject, source_text, shortfall, difficulty_description,
+                existing=[row.question for row in banked], check_relevance=not relevance_checked,
+            )
+        except QuizNotRelevant as e:
+            logging.info(f"Quiz source text judged not relevant to {subject}.")
+            return jsonify({"error": str(e)}), 400
+        except QuizBlocked as e:
+            logging.warning(f"Quiz generation blocked: {e}")
+            return jsonify({"error": f"Content blocked due to: {e}. Try different text."}), 400
+        except ValueError as e:
+            # ... (keep existing JSON/Validation error handling) ...
+            logging.error(f"Quiz JSON processing error: {e}")
+            return jsonify({"error": f"AI response was not valid quiz JSON or failed validation: {e}"}), 500
+        if served_without_upstream:
+            g.ai_served_without_upstream = True
+
+        if QUIZ_BANK_ENABLED:
+            new_rows = bank_quiz_questions(bank_subject, fingerprint, difficulty, generated)
+            mark_quiz_questions_served(banked + new_rows)
+            logging.info(f"[QUIZ_BANK] Banked {len(new_rows)} new questions ({bank_subject}/{fingerprint[:8]}, {difficulty}).")
+        quiz = [row.to_quiz_item() for row in banked] + generated
+        random.shuffle(quiz) # Don't put banked questions always first
+        logging.info(f"Quiz assembled: {len(quiz)} questions (requested {count} {difficulty}, {len(banked)} from the bank).")
+        return jsonify({"quiz": quiz, "from_bank": len(banked)}) # Return the potentially variable length list
 
     except Exception as e:
         # ... (keep existing API call error handling) ...
         logging.exception(f"Error during quiz generation API call: {e}")
         block_reason_msg = ""
         # ... (code to check for block reason) ...
-        return jsonify({"error": f"An internal error occurred during quiz generation.{block_reason_msg} Details: {str(e)}"}), 500
+        return jsonify({"error": f"An internal error occurred during quiz generation.{block_reason_msg} Details: {str(e)}"}), ai_error_status(e)
 # === END MODIFIED /generate-quiz route ===
 
 
+def battle_flow_prompt(battle_name):
+    """Also used by the cache pre-warmer for every battle in the history page's dropdown."""
+    return f"""
+        For the historical battle '{battle_name}', generate a concise, chronological sequence of the main events, causes, or contributing factors that led up to the battle itself.
+        Present this as a clearly formatted numbered or bulleted list.
+        Focus on key developments understandable by a secondary school student. Avoid excessive detail.
+        Start from relevant background context and end just before the battle begins. Ensure the flow is logical and historically plausible.
+
+        Example format for 'Battle of Hastings':
+        * Death of Edward the Confessor created a succession crisis.
+        * Harold Godwinson was crowned King, but faced rival claims from William of Normandy and Harald Hardrada of Norway.
+        * Hardrada invaded northern England, forcing Harold to march north and defeat him at Stamford Bridge.
+        * While Harold was in the north, William landed his invasion force on the south coast at Pevensey.
+        * Harold rapidly marched his tired army south again to confront William near Hastings.
+
+        Now, generate the event flow for: '{battle_name}'
+        """
+
+
 @app.route('/generate-battle-flow', methods=['POST'])
-@limiter.limit("5 per minute")
+@limiter.limit("5 per minute", deduct_when=used_upstream_quota)
 def generate_battle_flow():
     """Generates a text flow of events leading up to a selected battle."""
     logging.info("Received request for /generate-battle-flow")
@@ -680,30 +1329,16 @@ def generate_battle_flow():
 
     try:
         logging.info(f"Generating event flow for battle: {battle_name}")
-        prompt = f"""
-        For the historical battle '{battle_name}', generate a concise, chronological sequence of the main events, causes, or contributing factors that led up to the battle itself.
-        Present this as a clearly formatted numbered or bulleted list.
-        Focus on key developments understandable by a secondary school student. Avoid excessive detail.
-        Start from relevant background context and end just before the battle begins. Ensure the flow is logical and historically plausible.
-
-        Example format for 'Battle of Hastings':
-        * Death of Edward the Confessor created a succession crisis.
-        * Harold Godwinson was crowned King, but faced rival claims from William of Normandy and Harald Hardrada of Norway.
-        * Hardrada invaded northern England, forcing Harold to march north and defeat him at Stamford Bridge.
-        * While Harold was in the north, William landed his invasion force on the south coast at Pevensey.
-        * Harold rapidly marched his tired army south again to confront William near Hastings.
+        prompt = battle_flow_prompt(battle_name)
+        if wants_stream():
+            return sse_response('battle_flow', prompt, "Sorry, I couldn't generate an event flow for this battle.")
 
-        Now, generate the event flow for: '{battle_name}'
-        """
-        response = model.generate_content(prompt)
-
-        flow_text = ""
-        if response.parts: flow_text = response.parts[0].text
-        elif hasattr(response, 'text'): flow_text = response.text
+        result = generate_ai_text('battle_flow', prompt)
+        flow_text = result.text
 
         if not flow_text.strip():
-            if response.prompt_feedback and response.prompt_feedback.block_reason:
-                block_reason = response.prompt_feedback.block_reason
+            if result.block_reason:
+                block_reason = result.block_reason
                 logging.warning(f"Event flow generation blocked: {block_reason}")
                 return jsonify({"error": f"Content blocked due to: {block_reason}. Try a different battle."}), 400
             else:
@@ -715,15 +1350,7 @@ def generate_battle_flow():
 
     except Exception as e:
         logging.exception(f"Error during battle flow generation API call: {e}")
-        block_reason_msg = ""
-        try:
-            if response and response.prompt_feedback and response.prompt_feedback.block_reason:
-                block_reason = response.prompt_feedback.block_reason
-                logging.warning(f"Battle flow generation potentially blocked: {block_reason}")
-                block_reason_msg = f" Content may be blocked ({block_reason})."
-        except NameError: pass
-        except AttributeError: pass
-        return jsonify({"error": f"An internal error occurred during event flow generation.{block_reason_msg} Details: {str(e)}"}), 500
+        return jsonify({"error": f"An internal error occurred during event flow generation. Details: {str(e)}"}), ai_error_status(e)
 
 
 #####This is without BOX implementation
@@ -857,6 +1484,34 @@ def generate_battle_flow():
 #         return jsonify({"error": f"An internal error occurred during map info generation.{block_reason_msg} Details: {str(e)}"}), 500
 # # === END MODIFIED /generate-map-info route ===
 
+def check_bounding_box(bbox):
+    if bbox["south_west_lat"] >= bbox["north_east_lat"]:
+        raise ValueError("south_west_lat must be strictly less than north_east_lat.")
+    # Note: Checking lon wrap-around (sw_lon > ne_lon) is complex and often not needed for typical map views, so omitted here.
+
+
+# Only a missing description fails the map: bad POIs are dropped, and a bad centre, zoom or bounding box is
+# nulled (the page then fits the map to the remaining POIs)
+MAP_INFO_SCHEMA = obj({
+    "center_lat": field(number(-90, 90), nullable=True, on_error=None),
+    "center_lon": field(number(-180, 180), nullable=True, on_error=None),
+    "zoom": field(number(0, 24, integer=True), nullable=True, on_error=None),
+    "description": text(non_empty=False),
+    "points_of_interest": field(array(obj({
+        "name": text(),
+        "lat": number(-90, 90),
+        "lon": number(-180, 180),
+        "popup_info": field(text(non_empty=False), on_error=""),
+    }), drop_invalid=True), on_error=list),
+    "bounding_box": field(obj({
+        "south_west_lat": number(-90, 90),
+        "south_west_lon": number(-180, 180),
+        "north_east_lat": number(-90, 90),
+        "north_east_lon": number(-180, 180),
+    }, check=check_bounding_box), nullable=True, on_error=None),
+})
+
+
 @app.route('/generate-map-info', methods=['POST'])
 def generate_map_info():
     """Generates structured data including bounding box for map visualization."""
@@ -924,63 +1579,30 @@ def generate_map_info():
             response_mime_type="application/json"
         )
 
-        response = model.generate_content(prompt, generation_config=generation_config)
+        result = generate_ai_text('map_info', prompt, generation_config, store=False)
         logging.info("Map info response received from Gemini.")
-
-        map_json_string = ""
-        if response.parts: map_json_string = response.parts[0].text
-        elif hasattr(response, 'text'): map_json_string = response.text
+        map_json_string = result.text
 
         if not map_json_string.strip():
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
+             if result.block_reason:
+                 block_reason = result.block_reason
                  logging.warning(f"Map info generation blocked: {block_reason}")
                  return jsonify({"error": f"Content blocked: {block_reason}. Try different text."}), 400
              else:
                  logging.warning("Received empty response string for map JSON.")
                  return jsonify({"error": "AI returned an empty response for map data."}), 500
 
-        # --- Validate and parse the JSON ---
+        # --- Validate and parse the JSON, salvaging what is usable ---
         try:
-            map_data = json.loads(map_json_string)
-            # Define required keys including the new one
-            required_keys = ["center_lat", "center_lon", "zoom", "description", "points_of_interest", "bounding_box"]
-            if not isinstance(map_data, dict) or not all(k in map_data for k in required_keys):
-                missing = [k for k in required_keys if k not in map_data]
-                raise ValueError(f"Generated JSON missing required key(s): {', '.join(missing)}.")
-
-            # Validate types and values (allowing null for center/zoom/bbox)
-            if map_data["center_lat"] is not None and not isinstance(map_data["center_lat"], (int, float)): raise ValueError("center_lat must be a number or null.")
-            if map_data["center_lon"] is not None and not isinstance(map_data["center_lon"], (int, float)): raise ValueError("center_lon must be a number or null.")
-            if map_data["zoom"] is not None and not isinstance(map_data["zoom"], int): raise ValueError("zoom must be an integer or null.")
-            if not isinstance(map_data["description"], str): raise ValueError("description must be a string.")
-
-            # Validate points_of_interest list
-            if not isinstance(map_data["points_of_interest"], list): raise ValueError("points_of_interest must be a list.")
-            for i, poi in enumerate(map_data["points_of_interest"]):
-                 if not isinstance(poi, dict) or not all(k in poi for k in ["name", "lat", "lon", "popup_info"]): raise ValueError(f"POI {i+1} missing keys.")
-                 if not isinstance(poi["lat"], (int, float)) or not isinstance(poi["lon"], (int, float)): raise ValueError(f"POI {i+1} lat/lon must be numbers.")
-                 if not (-90 <= poi["lat"] <= 90 and -180 <= poi["lon"] <= 180): raise ValueError(f"POI {i+1} coordinates ({poi['lat']}, {poi['lon']}) out of bounds.")
-                 if not isinstance(poi["name"], str) or not poi["name"].strip(): raise ValueError(f"POI {i+1} name invalid.")
-                 if not isinstance(poi["popup_info"], str): raise ValueError(f"POI {i+1} popup_info invalid.") # Allow empty popup
-
-            # Validate bounding_box (allow null, otherwise check structure and coords)
-            bbox = map_data["bounding_box"]
-            if bbox is not None:
-                 if not isinstance(bbox, dict): raise ValueError("bounding_box must be an object or null.")
-                 bbox_keys = ["south_west_lat", "south_west_lon", "north_east_lat", "north_east_lon"]
-                 if not all(k in bbox for k in bbox_keys): raise ValueError(f"bounding_box object missing required key(s): {', '.join([k for k in bbox_keys if k not in bbox])}.")
-                 if not all(isinstance(bbox[k], (int, float)) for k in bbox_keys): raise ValueError("bounding_box coordinates must be numbers.")
-                 # Basic range and logic checks for bbox coords
-                 sw_lat, sw_lon, ne_lat, ne_lon = bbox["south_west_lat"], bbox["south_west_lon"], bbox["north_east_lat"], bbox["north_east_lon"]
-                 if not (-90 <= sw_lat <= 90 and -90 <= ne_lat <= 90 and -180 <= sw_lon <= 180 and -180 <= ne_lon <= 180):
-                      raise ValueError("bounding_box coordinates out of valid lat/lon range.")
-                 if sw_lat >= ne_lat:
-                      raise ValueError("bounding_box south_west_lat must be strictly less than north_east_lat.")
-                 # Note: Checking lon wrap-around (sw_lon > ne_lon) is complex and often not needed for typical map views, so omitted here.
+            salvaged = salvage(MAP_INFO_SCHEMA, map_json_string)
+            map_data = salvaged.value
+            if salvaged.repaired or salvaged.dropped:
+                logging.info(f"[MAP_INFO] Repaired {len(salvaged.repaired)} and dropped {len(salvaged.dropped)} item(s): "
+                             f"{salvaged.repaired + salvaged.dropped}")
 
             # --- Validation Passed ---
             logging.info("Map info JSON parsed and validated successfully.")
+            cache_ai_result('map_info', result) # A cache hit is salvaged the same way again
             # Log the data being sent back for debugging
             logging.debug(f"Returning map data: {map_data}")
             return jsonify(map_data)
@@ -997,15 +1619,7 @@ def generate_map_info():
 
     except Exception as e:
         logging.exception(f"Error during map info generation API call: {e}")
-        block_reason_msg = ""
-        try:
-            if response and response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
-                 logging.warning(f"Map info generation potentially blocked: {block_reason}")
-                 block_reason_msg = f" Content may be blocked ({block_reason})."
-        except NameError: pass
-        except AttributeError: pass
-        return jsonify({"error": f"An internal error occurred during map info generation.{block_reason_msg} Details: {str(e)}"}), 500
+        return jsonify({"error": f"An internal error occurred during map info generation. Details: {str(e)}"}), ai_error_status(e)
 # === END REPLACEMENT for /generate-map-info ===
 
 
@@ -1115,23 +1729,11 @@ def get_writing_feedback():
 
             # Extract text from file (similar to summary logic)
             if file_extension == 'txt':
-                try:
-                    text_bytes = file.read()
-                    try: user_answer = text_bytes.decode('utf-8')
-                    except UnicodeDecodeError:
-                         logging.warning(f"UTF-8 decode failed for {filename}, trying latin-1")
-                         user_answer = text_bytes.decode('latin-1', errors='ignore')
+                try: user_answer = decode_text_bytes(file.read(), filename)
                 except Exception as e: raise IOError(f"Could not read .txt file: {e}")
 
             elif file_extension == 'pdf':
-                try:
-                    pdf_stream = io.BytesIO(file.read())
-                    reader = PdfReader(pdf_stream)
-                    if reader.is_encrypted:
-                         try: reader.decrypt('')
-                         except Exception: logging.warning(f"Could not decrypt PDF {filename}")
-                    extracted_pages = [p.extract_text() or "" for p in reader.pages]
-                    user_answer = "\n".join(extracted_pages)
+                try: user_answer = extract_pdf_text(file.read(), filename, cache=extracted_text_cache).text
                 except Exception as e: raise IOError(f"Could not process PDF file: {e}")
 
         elif content_type.startswith('application/json'):
@@ -1189,18 +1791,16 @@ def get_writing_feedback():
 
         Provide the feedback now:
         """
+        if wants_stream():
+            return sse_response('writing_feedback', prompt, "Sorry, I couldn't generate feedback for this answer.")
 
-        response = model.generate_content(prompt)
-
-        # (Keep the same response handling logic as before)
-        feedback_text = ""
-        if response.parts: feedback_text = response.parts[0].text
-        elif hasattr(response, 'text'): feedback_text = response.text
+        result = generate_ai_text('writing_feedback', prompt)
+        feedback_text = result.text
 
         if not feedback_text.strip():
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
+             if result.block_reason:
                  # ... handle block reason ...
-                 block_reason = response.prompt_feedback.block_reason
+                 block_reason = result.block_reason
                  logging.warning(f"Writing feedback generation blocked: {block_reason}")
                  return jsonify({"error": f"Content blocked due to: {block_reason}. Try rephrasing."}), 400
              else:
@@ -1214,14 +1814,21 @@ def get_writing_feedback():
     except Exception as e:
         # (Keep the same general exception handling for the API call)
         logging.exception(f"Error during writing feedback generation API call for user {current_user.email}: {e}")
-        block_reason_msg = ""
-        # ... (code to check for block reason in response) ...
-        return jsonify({"error": f"An internal error occurred during feedback generation.{block_reason_msg} Details: {str(e)}"}), 500
+        return jsonify({"error": f"An internal error occurred during feedback generation. Details: {str(e)}"}), ai_error_status(e)
 # === END REVISED /get-writing-feedback route ===
 
 
 
 # === NEW ROUTE for Chemical Equation Balancer ===
+# A single answer has nothing to drop: the flag is repaired (strings converted, missing means not balanced),
+# while a missing equation or explanation still fails the response
+EQUATION_SCHEMA = obj({
+    "balanced_equation": text(non_empty=False),
+    "explanation": text(non_empty=False),
+    "is_balanced_successfully": field(boolean(), on_error=False),
+})
+
+
 @app.route('/balance-chemical-equation', methods=['POST'])
 @login_required # Ensure user is logged in
 def balance_chemical_equation():
@@ -1282,16 +1889,13 @@ def balance_chemical_equation():
         generation_config = genai.types.GenerationConfig(
             response_mime_type="application/json"
         )
-        response = model.generate_content(prompt, generation_config=generation_config)
+        result = generate_ai_text('chemical_equation', prompt, generation_config, store=False)
         logging.info("Response received from Gemini for equation balancing.")
-
-        equation_data_json_string = ""
-        if response.parts: equation_data_json_string = response.parts[0].text
-        elif hasattr(response, 'text'): equation_data_json_string = response.text
+        equation_data_json_string = result.text
 
         if not equation_data_json_string.strip():
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
+             if result.block_reason:
+                 block_reason = result.block_reason
                  logging.warning(f"Equation balancing blocked: {block_reason}")
                  return jsonify({"error": f"Content blocked: {block_reason}. Try a different equation."}), 400
              else:
@@ -1300,21 +1904,14 @@ def balance_chemical_equation():
 
         # Validate and parse the JSON
         try:
-            equation_data = json.loads(equation_data_json_string)
-
-            required_keys = ["balanced_equation", "explanation", "is_balanced_successfully"]
-            if not isinstance(equation_data, dict) or not all(k in equation_data for k in required_keys):
-                missing = [k for k in required_keys if k not in equation_data]
-                raise ValueError(f"Generated JSON missing required key(s): {', '.join(missing)}.")
-            if not isinstance(equation_data.get("balanced_equation"), str):
-                raise ValueError("Balanced equation must be a string.")
-            if not isinstance(equation_data.get("explanation"), str):
-                raise ValueError("Explanation must be a string.")
-            if not isinstance(equation_data.get("is_balanced_successfully"), bool):
-                raise ValueError("is_balanced_successfully must be a boolean.")
+            salvaged = salvage(EQUATION_SCHEMA, equation_data_json_string)
+            equation_data = salvaged.value
+            if salvaged.repaired:
+                logging.info(f"[EQUATION] Repaired {len(salvaged.repaired)} field(s): {salvaged.repaired}")
 
             logging.info("Equation data JSON parsed and validated successfully.")
-            return jsonify(equation_data) # Return the whole parsed object
+            cache_ai_result('chemical_equation', result)
+            return jsonify(equation_data) # Return the validated object
 
         except json.JSONDecodeError as json_e:
             logging.error(f"Failed to parse equation JSON response: {json_e}\nReceived: {equation_data_json_string}")
@@ -1325,41 +1922,24 @@ def balance_chemical_equation():
 
     except Exception as e:
         logging.exception(f"Error during equation balancing API call for user {current_user.email}: {e}")
-        block_reason_msg = ""
-        # ... (Standard block reason checking logic) ...
-        try:
-            if response and response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
-                 logging.warning(f"Equation balancing potentially blocked: {block_reason}")
-                 block_reason_msg = f" Content may be blocked ({block_reason})."
-        except NameError: pass # response not defined
-        except AttributeError: pass # response has no prompt_feedback
-        return jsonify({"error": f"An internal error occurred during equation processing.{block_reason_msg} Details: {str(e)}"}), 500
+        return jsonify({"error": f"An internal error occurred during equation processing. Details: {str(e)}"}), ai_error_status(e)
 # === END NEW ROUTE ===      
 
 
 # === NEW ROUTE for Biological Process Explainer ===
-@app.route('/explain-biological-process', methods=['POST'])
-@login_required # Ensure user is logged in
-def explain_biological_process():
-    """Explains a biological process: overview, stages, I/O, significance."""
-    logging.info(f"Received request for /explain-biological-process from user: {current_user.email}")
-    if not request.is_json:
-        logging.error("Request is not JSON for biological process explainer")
-        return jsonify({"error": "Request must be JSON"}), 400
-
-    data = request.get_json()
-    process_name = data.get('process_name')
-
-    if not process_name or not isinstance(process_name, str) or not process_name.strip():
-        logging.error("Missing or invalid 'process_name'")
-        return jsonify({"error": "Please provide the name of the biological process."}), 400
-
-    try:
-        logging.info(f"Generating explanation for biological process: {process_name}")
-
-        # Prompt for structured JSON output
-        prompt = f"""
+# Non-text stages are dropped; anything else missing fails the response
+BIOLOGICAL_PROCESS_SCHEMA = obj({
+    "process_name_explained": text(non_empty=False),
+    "overview": text(non_empty=False),
+    "key_stages": array(text(), drop_invalid=True),
+    "inputs_outputs": text(non_empty=False),
+    "significance": text(non_empty=False),
+})
+
+
+def biological_process_prompt(process_name):
+    """Also used by the cache pre-warmer for the most requested processes."""
+    return f"""
         You are an expert biology educator.
         For the biological process "{process_name}", provide a detailed explanation suitable for a secondary school or early university student.
 
@@ -1387,19 +1967,39 @@ def explain_biological_process():
         Now, generate the JSON explanation for: "{process_name}"
         """
 
+
+@app.route('/explain-biological-process', methods=['POST'])
+@login_required # Ensure user is logged in
+def explain_biological_process():
+    """Explains a biological process: overview, stages, I/O, significance."""
+    logging.info(f"Received request for /explain-biological-process from user: {current_user.email}")
+    if not request.is_json:
+        logging.error("Request is not JSON for biological process explainer")
+        return jsonify({"error": "Request must be JSON"}), 400
+
+    data = request.get_json()
+    process_name = data.get('process_name')
+
+    if not process_name or not isinstance(process_name, str) or not process_name.strip():
+        logging.error("Missing or invalid 'process_name'")
+        return jsonify({"error": "Please provide the name of the biological process."}), 400
+
+    try:
+        logging.info(f"Generating explanation for biological process: {process_name}")
+        prompt_popularity.record('biological_process', process_name)
+
+        prompt = biological_process_prompt(process_name)
+
         generation_config = genai.types.GenerationConfig(
             response_mime_type="application/json"
         )
-        response = model.generate_content(prompt, generation_config=generation_config)
+        result = generate_ai_text('biological_process', prompt, generation_config, store=False)
         logging.info("Response received from Gemini for biological process explanation.")
-
-        process_data_json_string = ""
-        if response.parts: process_data_json_string = response.parts[0].text
-        elif hasattr(response, 'text'): process_data_json_string = response.text
+        process_data_json_string = result.text
 
         if not process_data_json_string.strip():
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
+             if result.block_reason:
+                 block_reason = result.block_reason
                  logging.warning(f"Bio process explanation blocked: {block_reason}")
                  return jsonify({"error": f"Content blocked: {block_reason}. Try a different process."}), 400
              else:
@@ -1408,24 +2008,11 @@ def explain_biological_process():
 
         # Validate and parse the JSON
         try:
-            process_data = json.loads(process_data_json_string)
-
-            required_keys = ["process_name_explained", "overview", "key_stages", "inputs_outputs", "significance"]
-            if not isinstance(process_data, dict) or not all(k in process_data for k in required_keys):
-                missing = [k for k in required_keys if k not in process_data]
-                raise ValueError(f"Generated JSON missing required key(s): {', '.join(missing)}.")
-
-            # Further type checks
-            if not isinstance(process_data.get("process_name_explained"), str): raise ValueError("'process_name_explained' must be a string.")
-            if not isinstance(process_data.get("overview"), str): raise ValueError("'overview' must be a string.")
-            if not isinstance(process_data.get("key_stages"), list) or not all(isinstance(s, str) for s in process_data.get("key_stages",[])):
-                raise ValueError("'key_stages' must be a list of strings.")
-            if not isinstance(process_data.get("inputs_outputs"), str): raise ValueError("'inputs_outputs' must be a string.")
-            if not isinstance(process_data.get("significance"), str): raise ValueError("'significance' must be a string.")
-
+            process_data = salvage(BIOLOGICAL_PROCESS_SCHEMA, process_data_json_string).value
 
             logging.info("Biological process JSON parsed and validated successfully.")
-            return jsonify(process_data) # Return the whole parsed object
+            cache_ai_result('biological_process', result)
+            return jsonify(process_data) # Return the validated object
 
         except json.JSONDecodeError as json_e:
             logging.error(f"Failed to parse bio process JSON response: {json_e}\nReceived: {process_data_json_string}")
@@ -1436,41 +2023,24 @@ def explain_biological_process():
 
     except Exception as e:
         logging.exception(f"Error during bio process explanation API call for user {current_user.email}: {e}")
-        block_reason_msg = ""
-        # ... (Standard block reason checking logic) ...
-        try:
-            if response and response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
-                 logging.warning(f"Bio process explanation potentially blocked: {block_reason}")
-                 block_reason_msg = f" Content may be blocked ({block_reason})."
-        except NameError: pass
-        except AttributeError: pass
-        return jsonify({"error": f"An internal error occurred during process explanation.{block_reason_msg} Details: {str(e)}"}), 500
+        return jsonify({"error": f"An internal error occurred during process explanation. Details: {str(e)}"}), ai_error_status(e)
 # === END NEW ROUTE ===
 
 # === NEW ROUTE for Flashcard Generation ===
-@app.route('/generate-flashcards', methods=['POST'])
-@login_required # Ensure user is logged in
-def generate_flashcards():
-    """Generates flashcard data (term-definition pairs) from text/topic."""
-    logging.info(f"Received request for /generate-flashcards from user: {current_user.email}")
-    if not request.is_json:
-        logging.error("Request is not JSON for flashcard generation")
-        return jsonify({"error": "Request must be JSON"}), 400
+FLASHCARDS_MIN = 5 # The prompt asks for 5 to 10 cards; below this, dropped cards are re-requested
+FLASHCARD_REPAIR_REQUESTS = int(os.getenv('FLASHCARD_REPAIR_REQUESTS', 1))
 
-    data = request.get_json()
-    source_text = data.get('source_text')
+# Invalid cards are dropped; the route re-requests only as many as were lost
+FLASHCARDS_SCHEMA = array(obj({"term": text(), "definition": text()}), drop_invalid=True)
 
-    if not source_text or not isinstance(source_text, str) or not source_text.strip():
-        logging.error("Missing or invalid 'source_text' for flashcards")
-        return jsonify({"error": "Please provide a topic or text to generate flashcards from."}), 400
-
-    try:
-        logging.info(f"Generating flashcards for: {source_text[:70]}...") # Log truncated input
 
-        # Prompt for generating flashcard data as JSON
-        prompt = f"""
-        Based on the following text or topic, identify 5 to 10 key terms, concepts, or important facts.
+def flashcards_prompt(source_text, count_description="5 to 10", avoid_terms=()):
+    """Builds the flashcard prompt; avoid_terms lists cards already made, for a request topping up dropped ones."""
+    avoid = ""
+    if avoid_terms:
+        avoid = "Do not repeat any of these terms, which already have flashcards: " + ", ".join(avoid_terms) + "."
+    return f"""
+        Based on the following text or topic, identify {count_description} key terms, concepts, or important facts.
         For each identified item, provide a concise definition, explanation, or associated key information suitable for a flashcard.
         The "term" should be relatively short. The "definition" should be clear and informative.
 
@@ -1479,6 +2049,7 @@ def generate_flashcards():
         - "definition": A string containing the concise definition or explanation for that term.
 
         Do not include any explanatory text, markdown, or anything else before or after the JSON list.
+        {avoid}
 
         Source Text/Topic:
         ---
@@ -1495,47 +2066,86 @@ def generate_flashcards():
         Now, generate the JSON list of flashcard data:
         """
 
+
+def salvage_flashcards(json_string):
+    """Returns (valid cards, number dropped) from a flashcard response."""
+    salvaged = salvage(FLASHCARDS_SCHEMA, json_string)
+    if salvaged.repaired or salvaged.dropped:
+        logging.info(f"[FLASHCARDS] Repaired {len(salvaged.repaired)} and dropped {len(salvaged.dropped)} card(s): "
+                     f"{salvaged.repaired + salvaged.dropped}")
+    return salvaged.value, len(salvaged.dropped)
+
+
+def top_up_flashcards(source_text, cards, dropped, generation_config):
+    """
+    Re-requests only the cards lost to validation (enough to reach FLASHCARDS_MIN), up to FLASHCARD_REPAIR_REQUESTS
+    times, and returns cards plus the new, non-duplicate ones. Failed top-ups are logged and skipped.
+    """
+    for _ in range(FLASHCARD_REPAIR_REQUESTS):
+        missing = min(dropped, FLASHCARDS_MIN - len(cards))
+        if missing <= 0:
+            break
+        logging.info(f"[FLASHCARDS] {len(cards)} valid cards after dropping {dropped}; re-requesting {missing}.")
+        terms = [card["term"] for card in cards]
+        try:
+            result = llm_gateway.generate('flashcards', flashcards_prompt(source_text, f"exactly {missing}", terms),
+                                          generation_config, store=False)
+            extra, dropped = salvage_flashcards(result.text)
+        except Exception as e:
+            logging.warning(f"[FLASHCARDS] Top-up request failed: {e}")
+            break
+        if not (result.cached or result.shared):
+            g.ai_served_without_upstream = False
+        llm_gateway.store_result('flashcards', result)
+        known = {term.lower() for term in terms}
+        cards = cards + [card for card in extra if card["term"].lower() not in known]
+    return cards
+
+
+@app.route('/generate-flashcards', methods=['POST'])
+@login_required # Ensure user is logged in
+def generate_flashcards():
+    """Generates flashcard data (term-definition pairs) from text/topic."""
+    logging.info(f"Received request for /generate-flashcards from user: {current_user.email}")
+    if not request.is_json:
+        logging.error("Request is not JSON for flashcard generation")
+        return jsonify({"error": "Request must be JSON"}), 400
+
+    data = request.get_json()
+    source_text = data.get('source_text')
+
+    if not source_text or not isinstance(source_text, str) or not source_text.strip():
+        logging.error("Missing or invalid 'source_text' for flashcards")
+        return jsonify({"error": "Please provide a topic or text to generate flashcards from."}), 400
+
+    try:
+        logging.info(f"Generating flashcards for: {source_text[:70]}...") # Log truncated input
+
+        prompt = flashcards_prompt(source_text)
+
         generation_config = genai.types.GenerationConfig(
             response_mime_type="application/json"
         )
-        response = model.generate_content(prompt, generation_config=generation_config)
+        result = generate_ai_text('flashcards', prompt, generation_config, store=False)
         logging.info("Response received from Gemini for flashcard data.")
-
-        flashcard_json_string = ""
-        if response.parts: flashcard_json_string = response.parts[0].text
-        elif hasattr(response, 'text'): flashcard_json_string = response.text
+        flashcard_json_string = result.text
 
         if not flashcard_json_string.strip():
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
+             if result.block_reason:
+                 block_reason = result.block_reason
                  logging.warning(f"Flashcard generation blocked: {block_reason}")
                  return jsonify({"error": f"Content blocked: {block_reason}. Try different text."}), 400
              else:
                  logging.warning("Received empty response string for flashcard JSON.")
                  return jsonify({"error": "AI returned an empty response for flashcards."}), 500
 
-        # Validate and parse the JSON
+        # Validate and parse the JSON, keeping the valid cards
         try:
-            flashcard_data = json.loads(flashcard_json_string)
-
-            required_keys = ["term", "definition"]
-            if not isinstance(flashcard_data, list):
-                raise ValueError("Generated JSON response is not a list.")
+            flashcard_data, dropped = salvage_flashcards(flashcard_json_string)
+            cache_ai_result('flashcards', result) # A cache hit is salvaged the same way again
+            if dropped:
+                flashcard_data = top_up_flashcards(source_text, flashcard_data, dropped, generation_config)
             # Allow empty list if AI genuinely finds no terms
-            # if not flashcard_data:
-            #     raise ValueError("Generated JSON list of flashcards is empty.")
-
-            for i, card in enumerate(flashcard_data):
-                item_num = i + 1
-                if not isinstance(card, dict):
-                    raise ValueError(f"Flashcard item {item_num} in JSON list is not an object.")
-                if not all(key in card for key in required_keys):
-                    missing = [key for key in required_keys if key not in card]
-                    raise ValueError(f"Flashcard item {item_num} is missing required key(s): {', '.join(missing)}.")
-                if not isinstance(card.get("term"), str) or not card.get("term","").strip():
-                     raise ValueError(f"Flashcard item {item_num} has invalid or empty 'term'.")
-                if not isinstance(card.get("definition"), str) or not card.get("definition","").strip():
-                     raise ValueError(f"Flashcard item {item_num} has invalid or empty 'definition'.")
 
             logging.info(f"Flashcard data JSON ({len(flashcard_data)} cards) parsed and validated successfully.")
             return jsonify({"flashcards": flashcard_data}) # Return the list
@@ -1549,16 +2159,7 @@ def generate_flashcards():
 
     except Exception as e:
         logging.exception(f"Error during flashcard generation API call for user {current_user.email}: {e}")
-        block_reason_msg = ""
-        # ... (Standard block reason checking logic) ...
-        try:
-            if response and response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
-                 logging.warning(f"Flashcard generation potentially blocked: {block_reason}")
-                 block_reason_msg = f" Content may be blocked ({block_reason})."
-        except NameError: pass
-        except AttributeError: pass
-        return jsonify({"error": f"An internal error occurred during flashcard generation.{block_reason_msg} Details: {str(e)}"}), 500
+        return jsonify({"error": f"An internal error occurred during flashcard generation. Details: {str(e)}"}), ai_error_status(e)
 # === END NEW ROUTE ===
 
 # === NEW ROUTE for Chatbot Messages ===
@@ -1607,15 +2208,14 @@ def chatbot_message():
         # response = chat_session.send_message(prompt)
 
         # For stateless:
-        response = model.generate_content(prompt)
-
-        ai_reply = ""
-        if response.parts: ai_reply = response.parts[0].text
-        elif hasattr(response, 'text'): ai_reply = response.text
+        if wants_stream():
+            return sse_response('chatbot', prompt, "I'm not sure how to respond to that right now. Can you try asking differently?")
+        result = generate_ai_text('chatbot', prompt)
+        ai_reply = result.text
 
         if not ai_reply.strip():
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
+             if result.block_reason:
+                 block_reason = result.block_reason
                  logging.warning(f"Chatbot reply generation blocked: {block_reason}")
                  ai_reply = f"Sorry, I can't respond to that due to content restrictions ({block_reason})."
              else:
@@ -1627,7 +2227,7 @@ def chatbot_message():
 
     except Exception as e:
         logging.exception(f"Error during chatbot message processing: {e}")
-        return jsonify({"reply": "Sorry, I encountered an error and can't respond right now."}), 500
+        return jsonify({"reply": "Sorry, I encountered an error and can't respond right now."}), ai_error_status(e)
 # === END NEW ROUTE ===
 
 
@@ -1649,13 +2249,439 @@ def load_simulation(sim_name):
         return "Simulation not found", 404
 
 
+def forget_loaded_index(index_path):
+    """Drops a deleted index from this worker's in-memory caches."""
+    vector_store_cache.invalidate(index_path)
+    lexical_index_cache.invalidate(index_path)
+
+
+# --- Shared Index Storage ---
+# Indexes are addressed by id ("<owner>/<name>"), never by path. With INDEX_STORAGE=directory (a mount every
+# app instance shares) or s3 (S3 or MinIO), any instance can answer questions about an index another one built:
+# FAISS_INDEX_DIR then holds this node's read-through cache of the shared indexes, capped at INDEX_CACHE_MB.
+index_storage = create_index_storage(
+    os.getenv('INDEX_STORAGE', 'node'),
+    directory=os.getenv('INDEX_STORAGE_DIR'),
+    s3_bucket=os.getenv('INDEX_S3_BUCKET'),
+    s3_prefix=os.getenv('INDEX_S3_PREFIX', 'faiss-indexes'),
+    s3_endpoint_url=os.getenv('INDEX_S3_ENDPOINT_URL'), # e.g. http://minio:9000
+    s3_region=os.getenv('INDEX_S3_REGION'),
+)
+index_cache = NodeIndexCache(
+    FAISS_INDEX_DIR,
+    index_storage,
+    max_bytes=int(os.getenv('INDEX_CACHE_MB', 1024)) * 1024 * 1024,
+    on_evict=forget_loaded_index,
+)
+
+
+# --- FAISS Index Disk Quotas ---
+# Every saved index is registered with its size and last access; a sweeper deletes the least recently
+# used ones once a user, or the disk as a whole, is over quota (0 disables a quota).
+index_registry = IndexRegistry(os.path.join(instance_path, "index_registry.db"), FAISS_INDEX_DIR)
+index_sweeper = IndexSweeper(
+    index_registry,
+    global_quota_bytes=int(os.getenv('FAISS_DISK_QUOTA_MB', 2048)) * 1024 * 1024,
+    per_user_quota_bytes=int(os.getenv('FAISS_USER_QUOTA_MB', 200)) * 1024 * 1024,
+    interval=int(os.getenv('FAISS_SWEEP_INTERVAL_SECONDS', 600)),
+    on_evict=forget_loaded_index,
+)
+
+
+# --- Response Cache Pre-Warming ---
+# Battle flows for every battle in the history page's dropdown, and the most requested biological processes and
+# visual descriptions, are generated ahead of time and regenerated shortly before they expire, so even the first
+# student to ask is served from cache.
+PREWARM_ENABLED = os.getenv('PREWARM_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+PREWARM_TOP_N = int(os.getenv('PREWARM_TOP_N', 20)) # Most requested inputs per endpoint to keep warm
+PREWARM_POPULAR_DAYS = int(os.getenv('PREWARM_POPULAR_DAYS', 7)) # Window for "most requested"
+
+
+@lru_cache(maxsize=1)
+def battle_choices():
+    """The battle names offered by the dropdown in templates/history.html, so the page stays the single list."""
+    with open(os.path.join(app.root_path, "templates", "history.html"), encoding="utf-8") as f:
+        page = f.read()
+    select = re.search(r'<select id="battle-select".*?</select>', page, re.DOTALL)
+    return re.findall(r'<option value="([^"]+)"', select.group(0)) if select else []
+
+
+def validate_biological_process(json_text):
+    salvage(BIOLOGICAL_PROCESS_SCHEMA, json_text)
+
+
+def prewarm_jobs():
+    json_config = genai.types.GenerationConfig(response_mime_type="application/json") # As in the route
+    jobs = [PrewarmJob('battle_flow', battle_flow_prompt(battle), None, None) for battle in battle_choices()]
+    jobs += [
+        PrewarmJob('biological_process', biological_process_prompt(process), json_config, validate_biological_process)
+        for process in prompt_popularity.top('biological_process', PREWARM_TOP_N, PREWARM_POPULAR_DAYS)
+    ]
+    jobs += [
+        PrewarmJob('visual_description', visual_description_prompt(topic), None, None)
+        for topic in prompt_popularity.top('visual_description', PREWARM_TOP_N, PREWARM_POPULAR_DAYS)
+    ]
+    return jobs
+
+
+cache_prewarmer = CachePrewarmer(
+    llm_gateway,
+    response_cache,
+    prewarm_jobs,
+    interval=int(os.getenv('PREWARM_INTERVAL_SECONDS', 3600)),
+    refresh_fraction=float(os.getenv('PREWARM_REFRESH_FRACTION', 0.1)), # Regenerate in the last 10% of an entry's TTL
+    max_calls=int(os.getenv('PREWARM_MAX_CALLS_PER_RUN', 50)),
+)
+
+
+ADMIN_EMAILS = {e.strip().lower() for e in os.getenv('ADMIN_EMAILS', '').split(',') if e.strip()}
+
+
+@app.cli.command('index-usage')
+@click.option('--sweep', is_flag=True, help='Delete indexes over quota before reporting.')
+def index_usage_command(sweep):
+    """Prints FAISS index disk usage per user."""
+    if sweep:
+        outcome = index_sweeper.sweep()
+        click.echo("Another process is sweeping; skipped." if outcome is None else f"Deleted {outcome[0]} index(es), freed {outcome[1]} bytes.")
+    else:
+        index_registry.reconcile()
+    report = index_registry.usage_report()
+    click.echo(f"{report['index_root']}: {report['total_indexes']} index(es), {report['total_bytes'] / 1024 / 1024:.1f} MB")
+    click.echo(f"  {report['total_references']} user reference(s); {report['bytes_without_sharing'] / 1024 / 1024:.1f} MB without sharing")
+    for user_id, usage in report['users'].items():
+        last_access = datetime.fromtimestamp(usage['last_access']).strftime('%Y-%m-%d %H:%M')
+        click.echo(f"  user {user_id}: {usage['indexes']} index(es), {usage['bytes'] / 1024 / 1024:.1f} MB, last used {last_access}")
+
+
+@app.cli.command('prewarm-cache')
+def prewarm_cache_command():
+    """Generates missing or soon-to-expire pre-warmed responses now (e.g. from cron with PREWARM_ENABLED=false)."""
+    if not AI_CACHE_ENABLED:
+        click.echo("AI_CACHE_ENABLED is off; nothing to pre-warm.")
+        return
+    outcome = cache_prewarmer.run_once()
+    click.echo("Another process is pre-warming; skipped." if outcome is None else f"Refreshed {outcome[0]} entries, {outcome[1]} failed.")
+
+
+@app.cli.command('benchmark-index')
+@click.option('--index', 'index_path', default=None, help='Benchmark with the vectors of this saved index.')
+@click.option('--synthetic', default=20000, show_default=True, help='Number of synthetic vectors when no --index is given.')
+@click.option('--queries', default=200, show_default=True)
+@click.option('-k', default=3, show_default=True)
+def benchmark_index_command(index_path, synthetic, queries, k):
+    """Compares recall@k, latency and memory of each FAISS index type against the exact flat index."""
+    if index_path:
+        index = open_vector_store(index_path, get_embeddings_client(), mmap=QA_INDEX_MMAP).index # Any model's vectors will do
+        vectors = index.reconstruct_n(0, index.ntotal)
+    else:
+        vectors = synthetic_vectors(synthetic)
+    rng = np.random.default_rng(1)
+    # Queries near stored vectors, like questions close to a passage of the document
+    sample = vectors[rng.integers(0, len(vectors), size=queries)]
+    query_vectors = sample + 0.1 * rng.normal(size=sample.shape).astype('float32')
+    click.echo(f"{len(vectors)} vectors of dim {vectors.shape[1]}, {queries} queries, k={k}")
+    click.echo(f"{'type':<8} {'recall@k':>8} {'p50 ms':>8} {'p95 ms':>8} {'file MB':>8} {'build s':>8} {'RSS +MB':>8} {'heap +MB':>8}")
+    for row in benchmark_index_types(vectors, query_vectors, k=k, nprobe=QA_IVF_NPROBE, mmap=QA_INDEX_MMAP):
+        if 'error' in row:
+            click.echo(f"{row['index_type']:<8} failed: {row['error']}")
+            continue
+        click.echo(
+            f"{row['index_type']:<8} {row['recall_at_k']:>8} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['file_mb']:>8} "
+            f"{row['build_seconds']:>8} {row['rss_delta_mb']:>8} {row['anon_delta_mb']:>8}"
+        )
+
+
+@app.cli.command('fit-local-embeddings')
+@click.option('--components', default=256, show_default=True, help='Dimensions of the fitted (LSA) embedding space.')
+@click.option('--output', default=LOCAL_EMBEDDING_MODEL_PATH, show_default=True)
+def fit_local_embeddings_command(components, output):
+    """Fits the local embedding backend's IDF weights and SVD projection on the chunks of every saved index."""
+    texts = []
+    for owner in os.listdir(FAISS_INDEX_DIR):
+        owner_dir = os.path.join(FAISS_INDEX_DIR, owner)
+        if owner.startswith('.') or not os.path.isdir(owner_dir):
+            continue
+        for index_id in os.listdir(owner_dir):
+            try:
+                with open(os.path.join(owner_dir, index_id, "index.pkl"), "rb") as f:
+                    docstore, index_to_docstore_id = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, ValueError) as e:
+                click.echo(f"Skipping {index_id}: {e}")
+                continue
+            texts.extend(docstore.search(doc_id).page_content for doc_id in index_to_docstore_id.values())
+    if not texts:
+        raise click.ClickException("No indexed chunks found to fit on; process some PDFs first.")
+    model = LocalHashedEmbeddings.fit(texts, n_components=components)
+    model.save(output)
+    click.echo(f"Fitted {model.model_name} on {len(texts)} chunks; saved to {output}.")
+    click.echo("Documents indexed before the refit are re-embedded the next time they are uploaded.")
+
+
+# --- Background PDF Ingestion ---
+# Extraction and embedding run on worker threads fed by a SQLite queue, so the upload request returns at once
+INGEST_UPLOAD_DIR = os.path.join(instance_path, "ingest_uploads")
+os.makedirs(INGEST_UPLOAD_DIR, exist_ok=True)
+ingest_queue = JobQueue(
+    os.path.join(instance_path, "ingest_jobs.db"),
+    max_attempts=int(os.getenv('INGEST_MAX_ATTEMPTS', 3)), # A job that keeps killing its worker is then marked failed
+)
+
+
+# Indexes are content-addressed and shared read-only by every user who uploads the same file.
+# Bump QA_INDEX_VERSION whenever extraction, chunking or the embedding model changes.
+QA_INDEX_VERSION = 3
+QA_DUPLICATE_THRESHOLD = float(os.getenv('QA_DUPLICATE_THRESHOLD', 0.85)) # Estimated Jaccard similarity above which a chunk is skipped
+# Concurrent uploads of the same document (in any worker) wait for one build instead of each embedding it
+index_build_flight = SingleFlight(os.path.join(instance_path, "index_builds"), wait_timeout=30 * 60, result_ttl=60 * 60)
+
+
+def embedding_model_tag(model_name):
+    return re.sub(r'[^A-Za-z0-9]+', '-', model_name).strip('-')
+
+
+def shared_index_id(content_sha256):
+    # Vectors from different embedding models can't be mixed, so the model is part of the index's identity
+    model_tag = embedding_model_tag(get_embeddings_client().model_name)
+    return f"{IndexRegistry.SHARED_OWNER}/{content_sha256}.v{QA_INDEX_VERSION}.{model_tag}"
+
+
+def index_matches_embeddings(index_id):
+    """
+    True if the index was embedded with the current backend's model, so questions can be searched in it.
+    Uses the model recorded in index_meta.json when this node has the index, otherwise the id's model tag.
+    """
+    model_name = get_embeddings_client().model_name
+    index_path = index_cache.local_path(index_id)
+    if os.path.isdir(index_path):
+        recorded = read_index_meta(index_path).get("model_name")
+        if recorded:
+            return recorded == model_name
+    return index_id.endswith("." + embedding_model_tag(model_name))
+
+
+def index_available(index_id):
+    """True if questions can be asked about the index (on this node, or in shared storage to be fetched)."""
+    if index_cache.is_shared:
+        return index_cache.exists(index_id)
+    index_path = index_cache.local_path(index_id)
+    return os.path.isdir(index_path) and index_registry.is_registered(index_path)
+
+
+def build_pdf_qa_index(upload_path, index_id, filename, user_id, report):
+    """Extracts, chunks and embeds a PDF into the index index_id (and publishes it) unless that index already exists."""
+    if index_cache.exists(index_id):
+        return {"chunks": None, "reused": True, "boilerplate_lines_removed": 0, "embeddings_saved": 0}
+    report('extracting', 0.05)
+    with open(upload_path, 'rb') as f:
+        extracted = extract_pdf_text(f.read(), filename, cache=extracted_text_cache)
+    if not extracted.text or not extracted.text.strip():
+        raise ValueError("Could not extract text from the PDF.")
+
+    report('cleaning', 0.15)
+    # Running headers/footers would otherwise pad every chunk and skew retrieval towards them
+    pages, boilerplate_lines = strip_repeated_lines(split_pages(extracted))
+
+    report('chunking', 0.2)
+    chunks = chunk_pages(pages, extracted.first_page + 1, QA_CHUNK_TOKENS, QA_CHUNK_OVERLAP_TOKENS)
+    if not chunks:
+        raise ValueError("Could not split PDF text into chunks.")
+    text_chunks, kept, duplicate_chunks = drop_near_duplicates([c.text for c in chunks], threshold=QA_DUPLICATE_THRESHOLD)
+    metadatas = [
+        {"page_start": chunks[i].page_start, "page_end": chunks[i].page_end, "heading": chunks[i].heading}
+        for i in kept
+    ]
+    logging.info(
+        f"[PDF_QA_PROCESS] {filename}: removed {boilerplate_lines} header/footer lines; "
+        f"skipped {duplicate_chunks} near-duplicate chunks (embeddings saved), {len(text_chunks)} to embed."
+    )
+
+    report('embedding', 0.25)
+    index_path = index_cache.local_path(index_id)
+    # Embedding dominates ingestion time, so it covers most of the progress bar
+    create_and_save_vector_store(
+        text_chunks, index_path, progress=lambda done: report('embedding', 0.25 + 0.7 * done), metadatas=metadatas
+    )
+    index_registry.record(index_path, user_id)
+    index_cache.publish(index_id) # Other app instances can now fetch it
+    return {
+        "chunks": len(text_chunks),
+        "reused": False,
+        "boilerplate_lines_removed": boilerplate_lines,
+        "embeddings_saved": duplicate_chunks,
+    }
+
+
+def run_pdf_ingest_job(payload, report):
+    """Job handler: builds (or reuses) the shared index for an uploaded PDF and adds the uploader's reference to it."""
+    upload_path, index_id, filename, user_id = payload['upload_path'], payload['index_id'], payload['filename'], payload['user_id']
+    outcome, shared = index_build_flight.do(
+        index_id, lambda: build_pdf_qa_index(upload_path, index_id, filename, user_id, report)
+    )
+    index_registry.add_reference(user_id, index_cache.local_path(index_id), filename)
+    try:
+        os.remove(upload_path)
+    except OSError:
+        pass
+    reused = shared or outcome['reused']
+    logging.info(f"[PDF_QA_PROCESS] PDF '{filename}' {'reused existing' if reused else 'processed into'} index {index_id}")
+    return {**outcome, "index_id": index_id, "pdf_filename": filename, "reused": reused}
+
+
+def purge_old_ingest_jobs():
+    """Drops finished jobs past their retention along with any upload file they left behind."""
+    for payload in ingest_queue.purge_finished():
+        try:
+            os.remove(payload['upload_path'])
+        except (OSError, KeyError):
+            pass
+
+
+ingest_workers = JobWorkerPool(
+    ingest_queue,
+    {'pdf_qa': run_pdf_ingest_job},
+    num_threads=int(os.getenv('INGEST_WORKER_THREADS', 2)),
+)
+purge_old_ingest_jobs()
+
+
+@app.before_request
+def start_background_workers():
+    # Started by the first request rather than at import, so CLI commands and scripts importing the app don't
+    # spawn threads, and under gunicorn --preload they start in each worker rather than in the master (threads
+    # don't survive the fork); a restarted server still picks up queued jobs on its first request
+    ingest_workers.start()
+    if not index_cache.is_shared:
+        # With shared storage the node cache bounds local disk instead; expire old objects with a bucket lifecycle rule
+        index_sweeper.start()
+    if PREWARM_ENABLED and AI_CACHE_ENABLED:
+        cache_prewarmer.start()
+
+
+# --- Processed PDF Documents ---
+# Every user keeps a list of the PDFs they have processed; selecting some of them is instant because their
+# indexes already exist, and questions are answered from all selected documents at once.
+QA_MAX_SELECTED_DOCUMENTS = int(os.getenv('QA_MAX_SELECTED_DOCUMENTS', 5))
+
+
+def remember_pdf_document(user_id, index_id, filename):
+    """Adds (or refreshes) the user's record of a processed PDF and returns it."""
+    document = PdfDocument.query.filter_by(user_id=user_id, index_id=index_id).first()
+    if document is None:
+        document = PdfDocument(user_id=user_id, index_id=index_id, filename=filename)
+        db.session.add(document)
+    else:
+        document.filename = filename
+        document.last_used_at = datetime.utcnow()
+    db.session.commit()
+    return document
+
+
+def pdf_document_available(document):
+    """
+    False once the quota sweeper has deleted the document's index, or after the embedding model changed
+    (EMBEDDING_BACKEND or a refit); either way the user has to upload it again.
+    """
+    return index_available(document.index_id) and index_matches_embeddings(document.index_id)
+
+
+def upgrade_pdf_document_index_ids():
+    """
+    Rewrites documents saved as absolute index paths (under FAISS_INDEX_DIR) to index ids. Rows pointing
+    anywhere else can't be served any more and are dropped; their users have to upload the PDF again.
+    """
+    upgraded = dropped = 0
+    old_style = db.or_(PdfDocument.index_id.startswith('/'), PdfDocument.index_id.contains('\\')) # POSIX or Windows path
+    for document in PdfDocument.query.filter(old_style).all():
+        try:
+            relative = os.path.relpath(document.index_id, FAISS_INDEX_DIR).replace(os.sep, '/')
+            document.index_id = validate_index_id(relative)
+            upgraded += 1
+        except ValueError:
+            db.session.delete(document)
+            dropped += 1
+    if upgraded or dropped:
+        db.session.commit()
+        logging.info(f"[PDF_QA] Upgraded {upgraded} document(s) from index paths to index ids, dropped {dropped}.")
+
+
+def selected_pdf_documents():
+    """The current user's selected documents, in the order they were selected."""
+    document_ids = session.get('pdf_qa_document_ids') or []
+    if not document_ids:
+        return []
+    documents = PdfDocument.query.filter(
+        PdfDocument.user_id == current_user.id, PdfDocument.id.in_(document_ids)
+    ).all()
+    return sorted(documents, key=lambda d: document_ids.index(d.id))
+
+
+@app.route('/pdf-documents')
+@login_required
+def list_pdf_documents():
+    """Lists the user's processed PDFs, most recently used first, flagging selected and no longer indexed ones."""
+    selected = set(session.get('pdf_qa_document_ids') or [])
+    documents = PdfDocument.query.filter_by(user_id=current_user.id).order_by(PdfDocument.last_used_at.desc()).all()
+    return jsonify({
+        "success": True,
+        "max_selected": QA_MAX_SELECTED_DOCUMENTS,
+        "documents": [
+            {
+                "id": d.id,
+                "filename": d.filename,
+                "created_at": d.created_at.isoformat(),
+                "available": pdf_document_available(d),
+                "selected": d.id in selected,
+            }
+            for d in documents
+        ],
+    })
+
+
+@app.route('/select-pdf-documents', methods=['POST'])
+@login_required
+def select_pdf_documents():
+    """Makes the given processed PDFs the ones questions are answered from."""
+    data = request.get_json(silent=True) or {}
+    document_ids = data.get('document_ids')
+    if not isinstance(document_ids, list) or not document_ids or not all(isinstance(i, int) for i in document_ids):
+        return jsonify({"success": False, "error": "Select at least one document."}), 400
+    document_ids = list(dict.fromkeys(document_ids))
+    if len(document_ids) > QA_MAX_SELECTED_DOCUMENTS:
+        return jsonify({"success": False, "error": f"Select at most {QA_MAX_SELECTED_DOCUMENTS} documents."}), 400
+
+    documents = PdfDocument.query.filter(
+        PdfDocument.user_id == current_user.id, PdfDocument.id.in_(document_ids)
+    ).all()
+    if len(documents) != len(document_ids):
+        return jsonify({"success": False, "error": "Document not found."}), 404
+    missing = [d.filename for d in documents if not pdf_document_available(d)]
+    if missing:
+        return jsonify({
+            "success": False,
+            "error": f"No longer indexed, please upload again: {', '.join(missing)}",
+        }), 409
+
+    now = datetime.utcnow()
+    for document in documents:
+        # The per-user quota may have dropped this user's reference while others kept the shared index alive
+        index_registry.add_reference(current_user.id, index_cache.local_path(document.index_id), document.filename)
+        document.last_used_at = now
+    db.session.commit()
+    session['pdf_qa_document_ids'] = document_ids
+    logging.info(f"[PDF_QA_SELECT] User {current_user.email} selected {len(document_ids)} document(s).")
+    documents.sort(key=lambda d: document_ids.index(d.id))
+    return jsonify({
+        "success": True,
+        "documents": [{"id": d.id, "filename": d.filename} for d in documents],
+    })
+
+
 # === Process Uploaded PDF for Q&A Route ===
 @app.route('/process-pdf-for-qa', methods=['POST'])
 @login_required
 def process_pdf_for_qa():
-    # ... (This route's logic remains largely the same, as it calls create_and_save_vector_store) ...
-    # Ensure it's complete as per Phase 21, Step 2 from previous instructions.
-    # The key change is that create_and_save_vector_store now handles the API key for embeddings.
+    # Validates and stores the upload, then queues it; poll /pdf-qa-status/<job_id> for progress.
     logging.info(f"Attempting to process PDF for Q&A. User: {current_user.email}")
     if 'pdf_file' not in request.files:
         logging.error("[PDF_QA_PROCESS] No 'pdf_file' in request.files")
@@ -1668,65 +2694,157 @@ def process_pdf_for_qa():
         logging.error(f"[PDF_QA_PROCESS] Invalid file type: {pdf_file.filename}")
         return jsonify({"success": False, "error": "Invalid file type. Please upload a PDF."}), 400
     try:
-        file_content_for_hash = pdf_file.read(); pdf_file.seek(0)
-        m = hashlib.md5(); m.update(file_content_for_hash[:4096]); m.update(str(current_user.id).encode()); pdf_file_id = m.hexdigest()
-        user_index_dir = os.path.join(FAISS_INDEX_DIR, str(current_user.id)); os.makedirs(user_index_dir, exist_ok=True)
-        index_path = os.path.join(user_index_dir, pdf_file_id)
-        logging.info(f"[PDF_QA_PROCESS] Preparing to process PDF: {pdf_file.filename}. Index: {index_path}")
-        raw_text = get_pdf_text_from_file_storage(pdf_file)
-        if not raw_text or not raw_text.strip():
-            logging.error(f"[PDF_QA_PROCESS] No text extracted from PDF: {pdf_file.filename}")
-            return jsonify({"success": False, "error": "Could not extract text from the PDF."}), 400
-        text_chunks = get_text_chunks_langchain(raw_text)
-        if not text_chunks:
-            logging.error(f"[PDF_QA_PROCESS] Could not split PDF text into chunks: {pdf_file.filename}")
-            return jsonify({"success": False, "error": "Could not split PDF text into chunks."}), 400
-        create_and_save_vector_store(text_chunks, index_path) # This now uses API_KEY internally
-        session['current_pdf_qa_index_path'] = index_path
-        session['current_pdf_filename'] = pdf_file.filename
-        logging.info(f"[PDF_QA_PROCESS] PDF '{pdf_file.filename}' processed. Index: {index_path}")
-        return jsonify({"success": True, "message": f"PDF '{pdf_file.filename}' processed.", "pdf_filename": pdf_file.filename})
+        file_content = pdf_file.read()
+        content_sha256 = sha256_bytes(file_content)
+        index_id = shared_index_id(content_sha256)
+        if index_available(index_id):
+            # Someone (possibly this user) already indexed this exact file: just reference it
+            index_registry.add_reference(current_user.id, index_cache.local_path(index_id), pdf_file.filename)
+            document = remember_pdf_document(current_user.id, index_id, pdf_file.filename)
+            session['pdf_qa_document_ids'] = [document.id]
+            logging.info(f"[PDF_QA_PROCESS] Reusing shared index for '{pdf_file.filename}': {index_id}")
+            return jsonify({
+                "success": True,
+                "message": f"PDF '{pdf_file.filename}' processed.",
+                "pdf_filename": pdf_file.filename,
+                "document_id": document.id,
+                "reused": True,
+            })
+
+        upload_path = os.path.join(INGEST_UPLOAD_DIR, f"{current_user.id}-{content_sha256}.pdf")
+        with open(upload_path, 'wb') as f:
+            f.write(file_content)
+
+        job_id = ingest_queue.enqueue(
+            'pdf_qa',
+            {"upload_path": upload_path, "index_id": index_id, "filename": pdf_file.filename, "user_id": current_user.id},
+            user_id=current_user.id,
+        )
+        ingest_workers.notify()
+        logging.info(f"[PDF_QA_PROCESS] Queued PDF '{pdf_file.filename}' as job {job_id}. Index: {index_id}")
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "status_url": url_for('pdf_qa_status', job_id=job_id),
+            "message": f"PDF '{pdf_file.filename}' queued for processing.",
+            "pdf_filename": pdf_file.filename,
+        }), 202
     except Exception as e:
-        logging.exception(f"[PDF_QA_PROCESS] Error processing PDF (User: {current_user.email}, File: {pdf_file.filename if 'pdf_file' in locals() and pdf_file else 'N/A'}): {e}")
+        logging.exception(f"[PDF_QA_PROCESS] Error queueing PDF (User: {current_user.email}, File: {pdf_file.filename}): {e}")
         return jsonify({"success": False, "error": f"An error occurred processing the PDF: {str(e)}"}), 500
 
 
-# === Ask Questions about the Processed PDF Route (MODIFIED) ===
+# === PDF Q&A Ingestion Progress Route ===
+@app.route('/pdf-qa-status/<job_id>')
+@login_required
+def pdf_qa_status(job_id):
+    job = ingest_queue.get(job_id)
+    if job is None or job['user_id'] != current_user.id:
+        return jsonify({"success": False, "error": "Processing job not found."}), 404
+
+    document = None
+    if job['status'] == 'done':
+        # Only a finished index becomes the active document for questions
+        document = remember_pdf_document(current_user.id, job['result']['index_id'], job['result']['pdf_filename'])
+        session['pdf_qa_document_ids'] = [document.id]
+    elif job['status'] == 'failed':
+        return jsonify({
+            "success": False, "status": "failed", "stage": job['stage'],
+            "error": f"An error occurred processing the PDF: {job['error']}",
+        })
+
+    status = {
+        "success": True,
+        "status": job['status'],
+        "stage": job['stage'],
+        "progress": job['progress'],
+        "pdf_filename": job['payload']['filename'],
+    }
+    if job['status'] == 'done':
+        status["embeddings_saved"] = job['result'].get('embeddings_saved', 0)
+        status["document_id"] = document.id
+    return jsonify(status)
+
+
+def answer_pdf_question(index_paths, user_question):
+    """Retrieves the relevant chunks of the selected indexes and asks the QA chain; returns {"reply", "pages", "sources"}."""
+    # Indexes are cached per worker; only deserialized on first use or change
+    relevant_docs, retrieval_mode = retrieve_relevant_chunks(index_paths, user_question)
+    logging.info(f"[PDF_QA_ASK] Retrieved chunks from {len(index_paths)} index(es) ({retrieval_mode}) for question: {user_question[:50]}...")
+    if not relevant_docs:
+        logging.warning(f"[PDF_QA_ASK] No relevant documents found for: {user_question[:50]}...")
+        return {"reply": "I couldn't find relevant information in the document to answer that.", "pages": [], "sources": []}
+
+    logging.info(f"[PDF_QA_ASK] Found {len(relevant_docs)} relevant chunks (~{sum(count_tokens(d.page_content) for d in relevant_docs)} tokens).")
+    chain = get_conversational_qa_chain() # Built once per worker; uses API_KEY internally for its LLM
+    response = chain({"input_documents": relevant_docs, "question": user_question}, return_only_outputs=True)
+    return {
+        "reply": response.get("output_text", "Sorry, I encountered an issue generating a response."),
+        "pages": source_pages(relevant_docs),
+        "sources": cited_sources(relevant_docs),
+    }
+
+
+def with_source_filenames(answer, documents):
+    """Replaces index paths in an answer's sources with this user's names for those documents (answers are shared)."""
+    filenames = {os.path.basename(document.index_id): document.filename for document in documents}
+    return {
+        **answer,
+        "sources": [
+            {"filename": filenames.get(os.path.basename(source['index_path']), "document"), "pages": source['pages']}
+            for source in answer.get('sources', [])
+        ],
+    }
+
+
+# === Ask Questions about the Selected PDFs Route ===
 @app.route('/ask-pdf-question', methods=['POST'])
 @login_required
 def ask_pdf_question():
     logging.info(f"Attempting to answer PDF question. User: {current_user.email}")
     if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
     data = request.get_json(); user_question = data.get('question')
-    index_path = session.get('current_pdf_qa_index_path')
-
-    if not index_path or not os.path.exists(index_path):
-        logging.error("[PDF_QA_ASK] No active PDF index found or path invalid.")
-        return jsonify({"reply": "No PDF processed or session expired. Please upload PDF first."}), 400
     if not user_question or not user_question.strip(): return jsonify({"reply": "Please ask a question."}), 400
 
     try:
-        # vvvvv MODIFICATION: Explicitly pass api_key vvvvv
-        embeddings = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            google_api_key=API_KEY # Use the API_KEY loaded from .env
+        documents, index_paths = [], []
+        for document in selected_pdf_documents():
+            try:
+                # Downloads the index from shared storage if another app instance built it
+                index_path = index_cache.fetch(document.index_id)
+            except IndexNotFound:
+                logging.warning(f"[PDF_QA_ASK] Index {document.index_id} of '{document.filename}' no longer exists.")
+                continue
+            if not index_matches_embeddings(document.index_id):
+                logging.warning(f"[PDF_QA_ASK] Index {document.index_id} of '{document.filename}' was built with another embedding model.")
+                continue
+            index_paths.append(index_path)
+            documents.append(document)
+        if not documents:
+            logging.error("[PDF_QA_ASK] No selected PDF index found.")
+            return jsonify({"reply": "No PDF processed or session expired. Please upload PDF first."}), 400
+
+        for index_path in index_paths:
+            index_registry.touch(index_path, current_user.id) # Keeps indexes in use away from the quota sweeper
+        cache_key = make_cache_key(
+            f"pdf_qa:{QA_MODEL_NAME}", normalize_question(user_question),
+            # Shared index dirs are named by content hash, so the same selection in any order shares answers
+            {"index": ",".join(sorted(os.path.basename(p) for p in index_paths)), "context_tokens": QA_CONTEXT_TOKENS},
         )
-        # ^^^^^ END MODIFICATION ^^^^^
-        vector_store = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
-        logging.info(f"[PDF_QA_ASK] FAISS index loaded from {index_path} for question: {user_question[:50]}...")
-
-        relevant_docs = vector_store.similarity_search(user_question, k=3)
-        if not relevant_docs:
-            logging.warning(f"[PDF_QA_ASK] No relevant documents found for: {user_question[:50]}...")
-            return jsonify({"reply": "I couldn't find relevant information in the document to answer that."})
-
-        logging.info(f"[PDF_QA_ASK] Found {len(relevant_docs)} relevant chunks.")
-        chain = get_conversational_qa_chain() # This now uses API_KEY internally for its LLM
-        response = chain({"input_documents": relevant_docs, "question": user_question}, return_only_outputs=True)
-
-        ai_reply = response.get("output_text", "Sorry, I encountered an issue generating a response.")
-        logging.info(f"[PDF_QA_ASK] AI reply: {ai_reply[:100]}...")
-        return jsonify({"reply": ai_reply})
+        cached = qa_cache.get(cache_key) if AI_CACHE_ENABLED else None
+        if cached is not None:
+            logging.info(f"[PDF_QA_ASK] Answer served from cache for question: {user_question[:50]}...")
+            return jsonify({**with_source_filenames(json.loads(cached), documents), "cached": True})
+
+        # Students asking the same question at the same moment share one retrieval + generation
+        answer, shared = single_flight.do(cache_key, lambda: answer_pdf_question(index_paths, user_question))
+        if AI_CACHE_ENABLED and not shared:
+            qa_cache.set(cache_key, json.dumps(answer), endpoint="pdf_qa_answer")
+        logging.info(f"[PDF_QA_ASK] AI reply: {answer['reply'][:100]}...")
+        return jsonify(with_source_filenames(answer, documents))
+    except IndexMissing as e: # Deleted by the sweeper or the node cache between fetch and load
+        logging.warning(f"[PDF_QA_ASK] {e}")
+        return jsonify({"reply": "A selected PDF is no longer available. Please upload it again."}), 400
     except Exception as e:
         logging.exception(f"[PDF_QA_ASK] Error answering PDF question (User: {current_user.email}): {e}")
         # Check if the error is related to authentication specifically
@@ -1735,11 +2853,37 @@ def ask_pdf_question():
         return jsonify({"reply": f"An error occurred answering: {str(e)}"}), 500
 
 
+@app.route('/ai-cache-stats')
+@login_required
+def ai_cache_stats():
+    """Reports response cache hit/miss counters and the gateway circuit state for this worker."""
+    return jsonify({
+        "enabled": AI_CACHE_ENABLED,
+        "circuit": llm_gateway.breaker.state,
+        **response_cache.stats(),
+        "pdf_qa": qa_cache.stats(),
+    })
+
+
+@app.route('/admin/index-usage')
+@login_required
+def admin_index_usage():
+    """Reports FAISS index disk usage overall and per user (accounts listed in ADMIN_EMAILS only)."""
+    if current_user.email.lower() not in ADMIN_EMAILS:
+        abort(403)
+    return jsonify({
+        "global_quota_bytes": index_sweeper.global_quota_bytes,
+        "per_user_quota_bytes": index_sweeper.per_user_quota_bytes,
+        **index_registry.usage_report(),
+    })
+
+
 # Create database tables if they don't exist
 with app.app_context():
     try:
         db.create_all()
         logging.info("Database tables checked/created.")
+        upgrade_pdf_document_index_ids()
     except Exception as e:
         logging.error(f"Error creating database tables: {e}")
 
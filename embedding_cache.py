@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from array import array
+from contextlib import contextmanager
+
+from langchain_core.embeddings import Embeddings
+
+from response_cache import make_cache_key, normalize_question
+
+
+# --- Persistent embedding cache keyed by (embedding model, chunk text hash) ---
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """SQLite table of float32 vectors, shared by every worker on the host."""
+
+    SQLITE_MAX_PARAMS = 900 # Stay under SQLite's default limit on "?" placeholders per statement
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                       model TEXT NOT NULL,
+                       text_hash TEXT NOT NULL,
+                       vector BLOB NOT NULL,
+                       created_at REAL NOT NULL,
+                       PRIMARY KEY (model, text_hash)
+                   )"""
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get_many(self, model, hashes):
+        """Returns {text_hash: vector} for the hashes that are stored."""
+        found = {}
+        hashes = list(hashes)
+        with self._connect() as conn:
+            for i in range(0, len(hashes), self.SQLITE_MAX_PARAMS):
+                batch = hashes[i:i + self.SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch],
+                )
+                for h, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[h] = vector.tolist()
+        return found
+
+    def put_many(self, model, items):
+        """Stores (text_hash, vector) pairs."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, created_at) VALUES (?, ?, ?, ?)",
+                [(model, h, array("f", vector).tobytes(), now) for h, vector in items],
+            )
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps a LangChain embeddings client so document chunks that were embedded before
+    (by any user, on any day) are read from the local store; only misses go upstream, in batches.
+    With a query_cache (a ResponseCache), question embeddings are also reused, keyed by normalized question text.
+    """
+
+    def __init__(self, inner, store, model_name, batch_size=100, query_cache=None):
+        self.inner = inner
+        self.store = store
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.query_cache = query_cache
+
+    def embed_documents(self, texts):
+        hashes = [text_hash(t) for t in texts]
+        try:
+            cached = self.store.get_many(self.model_name, set(hashes))
+        except sqlite3.Error as e:
+            logging.warning(f"[EMBEDDING_CACHE] Lookup failed, embedding everything upstream: {e}")
+            cached = {}
+
+        missing = {} # hash -> text, de-duplicated
+        for h, t in zip(hashes, texts):
+            if h not in cached:
+                missing.setdefault(h, t)
+        logging.info(f"[EMBEDDING_CACHE] {len(texts) - len(missing)} of {len(texts)} chunk embeddings served locally; {len(missing)} to embed.")
+
+        missing_items = list(missing.items())
+        for i in range(0, len(missing_items), self.batch_size):
+            batch = missing_items[i:i + self.batch_size]
+            vectors = self.inner.embed_documents([t for _, t in batch])
+            fresh = [(h, v) for (h, _), v in zip(batch, vectors)]
+            cached.update(fresh)
+            try:
+                self.store.put_many(self.model_name, fresh)
+            except sqlite3.Error as e:
+                logging.warning(f"[EMBEDDING_CACHE] Could not store {len(fresh)} embeddings: {e}")
+
+        return [cached[h] for h in hashes]
+
+    def embed_query(self, text):
+        if self.query_cache is None:
+            return self.inner.embed_query(text)
+        key = make_cache_key(self.model_name, normalize_question(text), {"task": "query"})
+        cached = self.query_cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+        vector = self.inner.embed_query(text)
+        self.query_cache.set(key, json.dumps(vector), endpoint="query_embedding")
+        return vector
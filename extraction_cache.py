@@ -0,0 +1,99 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+
+# --- Content-addressed cache of extracted upload text ---
+
+def sha256_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ExtractedTextCache:
+    """
+    Stores extracted text as gzip'd JSON files named by the SHA-256 of the uploaded bytes,
+    so the same PDF uploaded to any route is parsed only once.
+    Total size on disk is bounded; the least recently used files are evicted first.
+    """
+
+    def __init__(self, cache_dir, max_bytes=500 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._approx_bytes = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json.gz")
+
+    def _entries(self):
+        """Yields (path, size, last_used) for every cached file."""
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json.gz"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def get(self, key):
+        """Returns the cached dict for key, or None."""
+        path = self._path(key)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path) # mtime doubles as "last used" for eviction
+            return value
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"[EXTRACTION_CACHE] Dropping unreadable entry {key[:12]}: {e}")
+            try: os.remove(path)
+            except OSError: pass
+            return None
+
+    def set(self, key, value):
+        """Writes value atomically and evicts old entries if the cache is over its size budget."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                f.write(json.dumps(value).encode("utf-8"))
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            logging.warning(f"[EXTRACTION_CACHE] Could not store entry {key[:12]}: {e}")
+            return
+
+        with self._lock:
+            self._approx_bytes += size
+            over_budget = self._approx_bytes > self.max_bytes
+        if over_budget:
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda e: e[2])
+            total = sum(size for _, size, _ in entries)
+            target = int(self.max_bytes * 0.9) # Leave headroom so we don't evict on every write
+            removed = 0
+            for path, size, _ in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    removed += 1
+                except OSError:
+                    pass
+            self._approx_bytes = total
+        if removed:
+            logging.info(f"[EXTRACTION_CACHE] Evicted {removed} entries; {total} bytes remain.")
@@ -0,0 +1,238 @@
+import json
+import logging
+import math
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+import uuid
+
+import faiss
+import numpy as np
+
+
+# --- Quantized, memory-mapped FAISS index formats for PDF Q&A ---
+
+INDEX_META_FILENAME = "index_meta.json"
+INDEX_TYPES = ("flat", "sq8", "ivf_sq8", "ivf_pq")
+
+
+class IncompatibleIndex(ValueError):
+    """The index was built with a different embedding model than the one questions would be embedded with."""
+
+
+def choose_index_type(num_vectors, requested="auto", quantize_min_vectors=2000, pq_min_vectors=20000):
+    """
+    Picks the index type for a document with num_vectors chunks. "auto" keeps small documents exact (flat),
+    uses 8-bit scalar quantization (4x smaller, no real training cost) for medium ones, and IVF + product
+    quantization (~32x smaller, needs enough vectors to train its codebooks) for very large corpora.
+    An explicitly requested IVF type falls back to what "auto" would pick when there are fewer than
+    pq_min_vectors vectors to train its clustering on, instead of failing the ingest.
+    """
+    if requested not in INDEX_TYPES + ("auto",):
+        raise ValueError(f"Unknown FAISS index type '{requested}'; expected one of {INDEX_TYPES} or 'auto'.")
+    if requested.startswith("ivf") and num_vectors < pq_min_vectors:
+        fallback = "flat" if num_vectors < quantize_min_vectors else "sq8"
+        logging.warning(f"[FAISS] {num_vectors} vectors are too few to train {requested} (needs {pq_min_vectors}); using {fallback}.")
+        return fallback
+    if requested != "auto":
+        return requested
+    if num_vectors < quantize_min_vectors:
+        return "flat"
+    if num_vectors < pq_min_vectors:
+        return "sq8"
+    return "ivf_pq"
+
+
+def factory_string(index_type, num_vectors, dim):
+    """Returns the faiss.index_factory description for an index type sized for num_vectors."""
+    nlist = max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39)) # faiss wants ~39 training points per list
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "sq8":
+        return "SQ8"
+    if index_type == "ivf_sq8":
+        return f"IVF{nlist},SQ8"
+    if index_type == "ivf_pq":
+        m = next(m for m in (dim // 8, dim // 12, dim // 16, 8, 4, 2, 1) if m and dim % m == 0) # Sub-quantizers must divide dim
+        nbits = 8 if num_vectors >= 256 * 39 else 4 # Smaller codebooks when there is too little data to train 256 centroids
+        return f"IVF{nlist},PQ{m}x{nbits}"
+    raise ValueError(f"Unknown FAISS index type '{index_type}'.")
+
+
+def build_faiss_index(vectors, index_type):
+    """Trains (where needed) and fills a faiss index of the given type from an (n, dim) float32 array."""
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    index = faiss.index_factory(vectors.shape[1], factory_string(index_type, len(vectors), vectors.shape[1]))
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def build_vector_store(texts, vectors, embeddings, index_type="flat", metadatas=None):
+    """Builds a LangChain FAISS store over precomputed vectors with the requested index type."""
+    from langchain_community.docstore.in_memory import InMemoryDocstore # Lazy: the index code and benchmark only need faiss
+    from langchain_community.vectorstores import FAISS
+    from langchain_core.documents import Document
+    index = build_faiss_index(np.array(vectors, dtype="float32"), index_type)
+    ids = [str(uuid.uuid4()) for _ in texts]
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=text, metadata=(metadatas[i] if metadatas else {}))
+        for i, (doc_id, text) in enumerate(zip(ids, texts))
+    })
+    return FAISS(embeddings, index, docstore, dict(enumerate(ids)))
+
+
+def save_vector_store(vector_store, index_path, index_type, model_name=None):
+    """
+    Saves in LangChain's layout (index.faiss + index.pkl) plus a small metadata file naming the index type and
+    the embedding model (and dimension) of its vectors.
+    """
+    vector_store.save_local(index_path)
+    with open(os.path.join(index_path, INDEX_META_FILENAME), "w") as f:
+        json.dump({
+            "index_type": index_type, "num_vectors": vector_store.index.ntotal, "dim": vector_store.index.d,
+            "model_name": model_name,
+        }, f)
+
+
+def read_index_meta(index_path):
+    try:
+        with open(os.path.join(index_path, INDEX_META_FILENAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"index_type": "flat"} # Saved by FAISS.from_texts before index types existed
+
+
+def read_faiss_index(index_file, index_type, mmap=True):
+    """
+    Opens a saved faiss index. With mmap the vector codes stay in the page cache, shared by every worker
+    that opens the same file, instead of being copied into each process's heap.
+    """
+    if not mmap:
+        return faiss.read_index(index_file)
+    if index_type.startswith("ivf"):
+        flags = faiss.IO_FLAG_MMAP # Inverted lists become mmap-backed
+    else:
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) # Flat code arrays (faiss >= 1.8)
+    try:
+        return faiss.read_index(index_file, flags | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError as e:
+        logging.warning(f"[FAISS] Could not memory-map {index_file}, reading it into memory: {e}")
+        return faiss.read_index(index_file)
+
+
+def open_vector_store(index_path, embeddings, mmap=True, nprobe=16, model_name=None):
+    """
+    Loads a store saved by save_vector_store (or LangChain's save_local), memory-mapping the index file.
+    With model_name, raises IncompatibleIndex if the metadata records a different embedding model.
+    """
+    meta = read_index_meta(index_path)
+    if model_name and meta.get("model_name") and meta["model_name"] != model_name:
+        raise IncompatibleIndex(f"{index_path} was embedded with {meta['model_name']}, not {model_name}.")
+    index_type = meta["index_type"]
+    from langchain_community.vectorstores import FAISS
+    index = read_faiss_index(os.path.join(index_path, "index.faiss"), index_type, mmap=mmap)
+    if index_type.startswith("ivf"):
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+# --- Benchmark: recall@k, latency and memory of each index type against exact search ---
+
+def _memory_kb():
+    """Returns (rss, anonymous) in KB for this process; anonymous excludes file-backed (mmap'd) pages, which workers share."""
+    usage = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":"):
+                    usage[parts[0][:-1]] = int(parts[1])
+    except OSError:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss, rss
+    return usage.get("Rss", 0), usage.get("Anonymous", 0)
+
+
+def _measure_index(index_file, index_type, mmap, queries, k, nprobe, result_queue):
+    """Runs in a fresh process so each index type's memory is measured from the same baseline."""
+    rss_before, anon_before = _memory_kb()
+    index = read_faiss_index(index_file, index_type, mmap=mmap)
+    if index_type.startswith("ivf"):
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    latencies = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(ids[0].tolist())
+    rss_after, anon_after = _memory_kb()
+    result_queue.put({
+        "latencies_ms": latencies,
+        "found": found,
+        "rss_delta_mb": round((rss_after - rss_before) / 1024, 1),
+        "anon_delta_mb": round((anon_after - anon_before) / 1024, 1),
+    })
+
+
+def benchmark_index_types(vectors, queries, index_types=INDEX_TYPES, k=3, nprobe=16, mmap=True):
+    """
+    Builds each index type over vectors and measures it against exact (brute-force) search.
+    Returns one dict per type: recall@k, p50/p95 latency, file size, build time and memory growth
+    (total RSS and anonymous, i.e. per-worker, memory) after loading the index and running every query in a fresh process.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for index_type in index_types:
+            started = time.perf_counter()
+            try:
+                index = build_faiss_index(vectors, index_type)
+            except RuntimeError as e:
+                rows.append({"index_type": index_type, "error": str(e)})
+                continue
+            build_seconds = time.perf_counter() - started
+            index_file = os.path.join(work_dir, f"{index_type}.faiss")
+            faiss.write_index(index, index_file)
+            del index
+
+            result_queue = context.Queue()
+            worker = context.Process(target=_measure_index, args=(index_file, index_type, mmap, queries, k, nprobe, result_queue))
+            worker.start()
+            measured = result_queue.get()
+            worker.join()
+
+            recall = np.mean([len(set(found) & set(expected)) / k for found, expected in zip(measured["found"], truth.tolist())])
+            latencies = sorted(measured["latencies_ms"])
+            rows.append({
+                "index_type": index_type,
+                "recall_at_k": round(float(recall), 3),
+                "p50_ms": round(latencies[len(latencies) // 2], 3),
+                "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+                "file_mb": round(os.path.getsize(index_file) / 1024 / 1024, 2),
+                "build_seconds": round(build_seconds, 2),
+                "rss_delta_mb": measured["rss_delta_mb"],
+                "anon_delta_mb": measured["anon_delta_mb"],
+            })
+    return rows
+
+
+def synthetic_vectors(num_vectors, dim=768, num_clusters=50, seed=0):
+    """Clustered random vectors shaped roughly like text embeddings, for benchmarking without an index."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_clusters, dim)).astype("float32")
+    labels = rng.integers(0, num_clusters, size=num_vectors)
+    return centers[labels] + 0.3 * rng.normal(size=(num_vectors, dim)).astype("float32")
@@ -0,0 +1,316 @@
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl # POSIX only; elsewhere sweeps aren't coordinated across processes
+except ImportError:
+    fcntl = None
+
+
+# --- Registry and quota-based garbage collection of saved FAISS indexes ---
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class IndexRegistry:
+    """
+    Records every saved index under index_root with its size and last access time, plus which users
+    reference it, so disk usage can be reported and capped without walking the index directory on each
+    request. Indexes live at <index_root>/<owner>/<index_id>, where owner is "shared" for content-addressed
+    indexes used by many users (or a user id for indexes built before sharing existed).
+    """
+
+    SHARED_OWNER = "shared"
+
+    TOUCH_INTERVAL = 60 # Seconds; last_access is only rewritten this often per index
+
+    def __init__(self, db_path, index_root):
+        self.db_path = db_path
+        self.index_root = index_root
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS indexes (
+                       path TEXT PRIMARY KEY,
+                       user_id TEXT NOT NULL,
+                       size_bytes INTEGER NOT NULL,
+                       created_at REAL NOT NULL,
+                       last_access REAL NOT NULL
+                   )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_indexes_last_access ON indexes(last_access)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS index_refs (
+                       user_id TEXT NOT NULL,
+                       path TEXT NOT NULL,
+                       filename TEXT,
+                       created_at REAL NOT NULL,
+                       last_access REAL NOT NULL,
+                       PRIMARY KEY (user_id, path)
+                   )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_index_refs_path ON index_refs(path)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, index_path, user_id):
+        """Registers (or re-measures) an index that was just written; user_id is who built it."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO indexes (path, user_id, size_bytes, created_at, last_access) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET size_bytes = excluded.size_bytes, last_access = excluded.last_access",
+                (index_path, str(user_id), directory_size(index_path), now, now),
+            )
+
+    def is_registered(self, index_path):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM indexes WHERE path = ?", (index_path,)).fetchone() is not None
+
+    def add_reference(self, user_id, index_path, filename=None):
+        """Records that user_id uses index_path (re-uploading the same document just refreshes the reference)."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO index_refs (user_id, path, filename, created_at, last_access) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id, path) DO UPDATE SET filename = excluded.filename, last_access = excluded.last_access",
+                (str(user_id), index_path, filename, now, now),
+            )
+            conn.execute("UPDATE indexes SET last_access = ? WHERE path = ?", (now, index_path))
+
+    def has_reference(self, user_id, index_path):
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT 1 FROM index_refs WHERE user_id = ? AND path = ?", (str(user_id), index_path)
+            ).fetchone() is not None
+
+    def touch(self, index_path, user_id=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE indexes SET last_access = ? WHERE path = ? AND last_access < ?",
+                (now, index_path, now - self.TOUCH_INTERVAL),
+            )
+            if user_id is not None:
+                conn.execute(
+                    "UPDATE index_refs SET last_access = ? WHERE user_id = ? AND path = ? AND last_access < ?",
+                    (now, str(user_id), index_path, now - self.TOUCH_INTERVAL),
+                )
+
+    def drop_references(self, refs):
+        """Deletes (user_id, path) references."""
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM index_refs WHERE user_id = ? AND path = ?", refs)
+
+    def forget(self, index_path):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM indexes WHERE path = ?", (index_path,))
+            conn.execute("DELETE FROM index_refs WHERE path = ?", (index_path,))
+
+    def entries(self):
+        """Returns all registered indexes as dicts (with a ref_count), least recently used first."""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT i.*, (SELECT COUNT(*) FROM index_refs r WHERE r.path = i.path) AS ref_count "
+                "FROM indexes i ORDER BY i.last_access"
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def references(self):
+        """Returns every user reference joined with its index size, least recently used first."""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT r.user_id, r.path, r.filename, r.last_access, i.size_bytes "
+                "FROM index_refs r JOIN indexes i ON i.path = r.path ORDER BY r.last_access"
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def reconcile(self):
+        """Registers index directories found on disk but not in the table, and drops rows whose directory is gone."""
+        known = {e["path"] for e in self.entries()}
+        on_disk = set()
+        if os.path.isdir(self.index_root):
+            for user_id in os.listdir(self.index_root):
+                user_dir = os.path.join(self.index_root, user_id)
+                if user_id.startswith(".") or not os.path.isdir(user_dir): # e.g. indexes still being built
+                    continue
+                for index_id in os.listdir(user_dir):
+                    path = os.path.join(user_dir, index_id)
+                    if os.path.isdir(path):
+                        on_disk.add(path)
+
+        added = on_disk - known
+        removed = known - on_disk
+        with self._connect() as conn:
+            for path in added:
+                mtime = os.path.getmtime(path)
+                owner = os.path.basename(os.path.dirname(path))
+                conn.execute(
+                    "INSERT OR IGNORE INTO indexes (path, user_id, size_bytes, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (path, owner, directory_size(path), mtime, mtime),
+                )
+                if owner != self.SHARED_OWNER: # Per-user index from before sharing: its owner is its only user
+                    conn.execute(
+                        "INSERT OR IGNORE INTO index_refs (user_id, path, created_at, last_access) VALUES (?, ?, ?, ?)",
+                        (owner, path, mtime, mtime),
+                    )
+            conn.executemany("DELETE FROM indexes WHERE path = ?", [(p,) for p in removed])
+            conn.executemany("DELETE FROM index_refs WHERE path = ?", [(p,) for p in removed])
+        if added or removed:
+            logging.info(f"[INDEX_GC] Reconciled registry: {len(added)} untracked index(es) added, {len(removed)} missing removed.")
+
+    def usage_report(self):
+        """Summarises disk usage overall and per user (a shared index counts towards every user referencing it)."""
+        entries = self.entries()
+        per_user = {}
+        for ref in self.references():
+            usage = per_user.setdefault(ref["user_id"], {"indexes": 0, "bytes": 0, "last_access": 0})
+            usage["indexes"] += 1
+            usage["bytes"] += ref["size_bytes"]
+            usage["last_access"] = max(usage["last_access"], ref["last_access"])
+        total_bytes = sum(e["size_bytes"] for e in entries)
+        return {
+            "index_root": self.index_root,
+            "total_indexes": len(entries),
+            "total_bytes": total_bytes,
+            "total_references": sum(e["ref_count"] for e in entries),
+            # What the same uploads would take if every user had a private copy
+            "bytes_without_sharing": sum(e["size_bytes"] * max(1, e["ref_count"]) for e in entries),
+            "unreferenced_indexes": sum(1 for e in entries if e["ref_count"] == 0),
+            "users": dict(sorted(per_user.items(), key=lambda item: item[1]["bytes"], reverse=True)),
+        }
+
+    def plan_evictions(self, global_quota_bytes, per_user_quota_bytes, protect_newer_than=0):
+        """
+        Returns (references to drop, index entries to delete), least recently used first (a quota of 0 means unlimited).
+        A user over per_user_quota_bytes loses their oldest references; the index files themselves are only deleted
+        while the total is over global_quota_bytes, unreferenced indexes before referenced ones.
+        Anything accessed within the last protect_newer_than seconds is never chosen.
+        """
+        cutoff = time.time() - protect_newer_than
+        drop_refs = []
+
+        if per_user_quota_bytes:
+            per_user = {}
+            for ref in self.references():
+                per_user.setdefault(ref["user_id"], []).append(ref)
+            for user_refs in per_user.values():
+                used = sum(r["size_bytes"] for r in user_refs)
+                for r in user_refs: # Already oldest first
+                    if used <= per_user_quota_bytes:
+                        break
+                    if r["last_access"] < cutoff:
+                        drop_refs.append((r["user_id"], r["path"]))
+                        used -= r["size_bytes"]
+
+        evict = []
+        if global_quota_bytes:
+            entries = self.entries()
+            remaining_refs = {}
+            for e in entries:
+                remaining_refs[e["path"]] = e["ref_count"]
+            for _, path in drop_refs:
+                remaining_refs[path] -= 1
+            used = sum(e["size_bytes"] for e in entries)
+            # Stable sort keeps LRU order within the unreferenced and referenced groups
+            for e in sorted(entries, key=lambda e: remaining_refs[e["path"]] > 0):
+                if used <= global_quota_bytes:
+                    break
+                if e["last_access"] < cutoff:
+                    evict.append(e)
+                    used -= e["size_bytes"]
+        return drop_refs, evict
+
+
+class IndexSweeper:
+    """
+    Background thread that periodically reconciles the registry with disk and deletes the least recently
+    used indexes over quota. A lock file ensures only one worker process sweeps at a time.
+    on_evict(path) is called after each deletion (e.g. to drop the index from in-memory caches).
+    """
+
+    def __init__(self, registry, global_quota_bytes=0, per_user_quota_bytes=0, interval=600,
+                 protect_newer_than=15 * 60, on_evict=None):
+        self.registry = registry
+        self.global_quota_bytes = global_quota_bytes
+        self.per_user_quota_bytes = per_user_quota_bytes
+        self.interval = interval
+        self.protect_newer_than = protect_newer_than # Don't pull an index out from under an active Q&A session
+        self.on_evict = on_evict
+        self._lock_path = registry.db_path + ".sweep.lock"
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Starts the thread (once; later calls do nothing)."""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="index-sweeper", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.exception(f"[INDEX_GC] Sweep failed: {e}")
+            time.sleep(self.interval)
+
+    def sweep(self):
+        """Runs one reconcile + eviction pass; returns (indexes deleted, bytes freed), or None if another process is sweeping."""
+        if fcntl is None:
+            return self._sweep()
+        with open(self._lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                return self._sweep()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sweep(self):
+        self.registry.reconcile()
+        drop_refs, victims = self.registry.plan_evictions(
+            self.global_quota_bytes, self.per_user_quota_bytes, self.protect_newer_than
+        )
+        if drop_refs:
+            self.registry.drop_references(drop_refs)
+            logging.info(f"[INDEX_GC] Dropped {len(drop_refs)} reference(s) from users over quota.")
+        freed = 0
+        for e in victims:
+            shutil.rmtree(e["path"], ignore_errors=True)
+            self.registry.forget(e["path"])
+            freed += e["size_bytes"]
+            if self.on_evict:
+                self.on_evict(e["path"])
+        if victims:
+            logging.info(f"[INDEX_GC] Deleted {len(victims)} index(es), freeing {freed} bytes.")
+        return len(victims), freed
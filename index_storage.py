@@ -0,0 +1,248 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from index_registry import directory_size
+
+
+# --- Shared storage for saved FAISS indexes, with a node-local read-through cache ---
+
+_INDEX_ID_RE = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*/[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+
+
+def validate_index_id(index_id):
+    """Index ids are "<owner>/<name>" (e.g. "shared/<sha256>.v3.<model>"); anything else could escape the cache root."""
+    if not isinstance(index_id, str) or not _INDEX_ID_RE.match(index_id) or ".." in index_id:
+        raise ValueError(f"Invalid index id '{index_id}'.")
+    return index_id
+
+
+class IndexNotFound(LookupError):
+    pass
+
+
+class DirectoryIndexStorage:
+    """Keeps indexes in a directory every app instance mounts (e.g. NFS), as <root>/<index_id>/<files>."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def __repr__(self):
+        return f"DirectoryIndexStorage({self.root!r})"
+
+    def exists(self, index_id):
+        return os.path.isdir(os.path.join(self.root, index_id))
+
+    def upload(self, local_dir, index_id):
+        target = os.path.join(self.root, index_id)
+        staging = os.path.join(self.root, ".incoming", f"{os.path.basename(index_id)}-{uuid.uuid4().hex[:8]}")
+        shutil.copytree(local_dir, staging) # Copy beside the target, then rename, so readers never see a partial index
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(staging, target)
+        except OSError:
+            if not os.path.isdir(target): # Otherwise another node published the same content-addressed index first
+                raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def download(self, index_id, local_dir):
+        source = os.path.join(self.root, index_id)
+        if not os.path.isdir(source):
+            raise IndexNotFound(index_id)
+        shutil.copytree(source, local_dir)
+
+    def delete(self, index_id):
+        shutil.rmtree(os.path.join(self.root, index_id), ignore_errors=True)
+
+
+class S3IndexStorage:
+    """
+    Keeps indexes in an S3-compatible bucket (AWS S3, MinIO, ...) as <prefix>/<index_id>/<file>. A marker
+    object is written after the index files, so an index counts as present only once fully uploaded.
+    Credentials come from the usual AWS environment variables or config files.
+    """
+
+    MARKER = "_COMPLETE"
+
+    def __init__(self, bucket, prefix="faiss-indexes", endpoint_url=None, region_name=None):
+        import boto3 # Only needed when this backend is selected
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or None, region_name=region_name or None)
+
+    def __repr__(self):
+        return f"S3IndexStorage(s3://{self.bucket}/{self.prefix})"
+
+    def _key(self, index_id, name=""):
+        return "/".join(part for part in (self.prefix, index_id, name) if part)
+
+    def _keys(self, index_id):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(index_id) + "/"):
+            for item in page.get("Contents", []):
+                yield item["Key"]
+
+    def exists(self, index_id):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(index_id, self.MARKER))
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def upload(self, local_dir, index_id):
+        for name in sorted(os.listdir(local_dir)):
+            self.client.upload_file(os.path.join(local_dir, name), self.bucket, self._key(index_id, name))
+        self.client.put_object(Bucket=self.bucket, Key=self._key(index_id, self.MARKER), Body=b"")
+
+    def download(self, index_id, local_dir):
+        if not self.exists(index_id):
+            raise IndexNotFound(index_id)
+        os.makedirs(local_dir)
+        for key in self._keys(index_id):
+            name = key.rsplit("/", 1)[1]
+            if name != self.MARKER:
+                self.client.download_file(self.bucket, key, os.path.join(local_dir, name))
+
+    def delete(self, index_id):
+        keys = sorted(self._keys(index_id), key=lambda key: not key.endswith(self.MARKER)) # Marker first: stops new readers
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": [{"Key": key} for key in keys[start:start + 1000]]}
+            )
+
+
+def create_index_storage(backend, directory=None, s3_bucket=None, s3_prefix="faiss-indexes", s3_endpoint_url=None,
+                         s3_region=None):
+    """Returns the shared storage for a backend name, or None for "node" (indexes only on this node's disk)."""
+    if backend == "node":
+        return None
+    if backend == "directory":
+        if not directory:
+            raise ValueError("INDEX_STORAGE=directory needs INDEX_STORAGE_DIR.")
+        return DirectoryIndexStorage(directory)
+    if backend == "s3":
+        if not s3_bucket:
+            raise ValueError("INDEX_STORAGE=s3 needs INDEX_S3_BUCKET.")
+        return S3IndexStorage(s3_bucket, s3_prefix, s3_endpoint_url, s3_region)
+    raise ValueError(f"Unknown index storage '{backend}'; expected 'node', 'directory' or 's3'.")
+
+
+class NodeIndexCache:
+    """
+    Maps index ids to directories under root, this node's copy of each index. With shared storage, missing
+    indexes are downloaded on first use (read-through), new ones are published after they are built, and the
+    least recently used local copies are deleted once the cache exceeds max_bytes (they can always be fetched
+    again). Without shared storage root is the only copy: nothing is downloaded or evicted here, and the
+    registry's quota sweeper manages the disk instead.
+    """
+
+    def __init__(self, root, storage=None, max_bytes=0, protect_newer_than=5 * 60, on_evict=None, fetch_lock_stripes=64):
+        self.root = root
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.protect_newer_than = protect_newer_than # Copies used this recently may be open by a request right now
+        self.on_evict = on_evict
+        self._fetch_locks = [threading.Lock() for _ in range(fetch_lock_stripes)] # Fixed size, however many indexes
+        os.makedirs(root, exist_ok=True)
+
+    @property
+    def is_shared(self):
+        return self.storage is not None
+
+    def local_path(self, index_id):
+        return os.path.join(self.root, validate_index_id(index_id))
+
+    def exists(self, index_id):
+        """True if the index is on this node or in shared storage."""
+        if os.path.isdir(self.local_path(index_id)):
+            return True
+        return self.is_shared and self.storage.exists(index_id)
+
+    def fetch(self, index_id):
+        """Returns the local directory of an index, downloading it from shared storage if this node lacks it."""
+        path = self.local_path(index_id)
+        if os.path.isdir(path):
+            self._touch(path)
+            return path
+        if not self.is_shared:
+            raise IndexNotFound(index_id)
+        fetch_lock = self._fetch_locks[hash(index_id) % len(self._fetch_locks)]
+        with fetch_lock: # Concurrent questions on a cold index download it once
+            if os.path.isdir(path):
+                return path
+            staging = os.path.join(self.root, ".downloading", f"{os.path.basename(index_id)}-{uuid.uuid4().hex[:8]}")
+            os.makedirs(os.path.dirname(staging), exist_ok=True)
+            started = time.monotonic()
+            try:
+                self.storage.download(index_id, staging)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    os.rename(staging, path)
+                except OSError:
+                    if not os.path.isdir(path): # Another worker process on this node fetched it first
+                        raise
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            logging.info(f"[INDEX_CACHE] Fetched {index_id} from {self.storage!r} in {time.monotonic() - started:.1f}s.")
+        self.evict(keep={path})
+        return path
+
+    def publish(self, index_id):
+        """Uploads a freshly built local index to shared storage (no-op without shared storage)."""
+        if not self.is_shared:
+            return
+        path = self.local_path(index_id)
+        if not self.storage.exists(index_id):
+            self.storage.upload(path, index_id)
+            logging.info(f"[INDEX_CACHE] Published {index_id} to {self.storage!r}.")
+        self.evict(keep={path})
+
+    def _touch(self, path):
+        try:
+            os.utime(path) # Directory mtime doubles as the last-use time for LRU eviction
+        except OSError:
+            pass
+
+    def _local_entries(self):
+        entries = []
+        for owner in os.listdir(self.root):
+            owner_dir = os.path.join(self.root, owner)
+            if owner.startswith(".") or not os.path.isdir(owner_dir):
+                continue
+            for name in os.listdir(owner_dir):
+                path = os.path.join(owner_dir, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path, directory_size(path)))
+                except OSError:
+                    pass
+        return entries
+
+    def evict(self, keep=()):
+        """Deletes least recently used local copies until the cache fits max_bytes; returns bytes freed."""
+        if not self.is_shared or not self.max_bytes:
+            return 0
+        entries = sorted(self._local_entries())
+        total = sum(size for _, _, size in entries)
+        freed = 0
+        now = time.time()
+        for last_used, path, size in entries:
+            if total - freed <= self.max_bytes:
+                break
+            if path in keep or now - last_used < self.protect_newer_than:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            freed += size
+            if self.on_evict:
+                self.on_evict(path)
+        if freed:
+            logging.info(f"[INDEX_CACHE] Evicted {freed} bytes of local index copies (limit {self.max_bytes}).")
+        return freed
@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+# --- SQLite-backed background job queue for PDF ingestion ---
+
+class JobQueue:
+    """
+    A small durable job queue in a SQLite file, shared by every worker on the host.
+    Jobs move queued -> running -> done | failed and carry a stage name and a 0..1 progress value.
+    An orphaned job (its worker crashed or hung) is claimed again, up to max_attempts times in all.
+    """
+
+    def __init__(self, db_path, stale_after=30 * 60, keep_finished_for=24 * 3600, max_attempts=3):
+        self.db_path = db_path
+        self.stale_after = stale_after # Running jobs not updated for this long are assumed orphaned
+        self.max_attempts = max_attempts
+        self.keep_finished_for = keep_finished_for
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                       id TEXT PRIMARY KEY,
+                       kind TEXT NOT NULL,
+                       user_id INTEGER,
+                       payload TEXT NOT NULL,
+                       status TEXT NOT NULL,
+                       stage TEXT NOT NULL,
+                       progress REAL NOT NULL DEFAULT 0,
+                       result TEXT,
+                       error TEXT,
+                       attempts INTEGER NOT NULL DEFAULT 0,
+                       created_at REAL NOT NULL,
+                       updated_at REAL NOT NULL
+                   )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None) # Explicit transactions below
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, kind, payload, user_id=None):
+        """Adds a job and returns its id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, user_id, payload, status, stage, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', 'queued', ?, ?)",
+                (job_id, kind, user_id, json.dumps(payload), now, now),
+            )
+        return job_id
+
+    def claim(self):
+        """
+        Atomically takes the oldest queued (or orphaned running) job, or returns None. Orphaned jobs that have
+        used up max_attempts are marked failed instead, so a job that kills its worker isn't retried forever.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE") # Serialise claimers across processes
+            try:
+                while True:
+                    row = conn.execute(
+                        "SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND updated_at < ?) "
+                        "ORDER BY created_at LIMIT 1",
+                        (now - self.stale_after,),
+                    ).fetchone()
+                    if row is None or row["attempts"] < self.max_attempts:
+                        break
+                    conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                        (f"Gave up after {row['attempts']} attempts: the job's worker stopped responding.", now, row["id"]),
+                    )
+                    logging.warning(f"[JOBS] Job {row['id']} abandoned after {row['attempts']} attempts.")
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', stage = 'starting', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (now, row["id"]),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def update(self, job_id, stage, progress):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET stage = ?, progress = ?, updated_at = ? WHERE id = ?",
+                (stage, progress, time.time(), job_id),
+            )
+
+    def finish(self, job_id, result):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', stage = 'done', progress = 1, result = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(result), time.time(), job_id),
+            )
+
+    def fail(self, job_id, error):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                (str(error), time.time(), job_id),
+            )
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def purge_finished(self):
+        """Deletes finished jobs older than keep_finished_for and returns their payloads."""
+        cutoff = time.time() - self.keep_finished_for
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT payload FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,)
+            ).fetchall()
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,))
+        return [json.loads(r["payload"]) for r in rows]
+
+
+class JobWorkerPool:
+    """
+    Daemon threads in each web worker that pull jobs from the queue and run the handler registered
+    for the job's kind. A handler is called as handler(payload, report) where report(stage, progress)
+    records progress, and returns a JSON-serialisable result.
+    """
+
+    def __init__(self, queue, handlers, num_threads=2, poll_interval=1.0):
+        self.queue = queue
+        self.handlers = handlers
+        self.num_threads = num_threads
+        self.poll_interval = poll_interval
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Starts the threads (once; later calls do nothing)."""
+        if self._threads:
+            return
+        with self._start_lock:
+            if self._threads:
+                return
+            self._spawn()
+
+    def _spawn(self):
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"[JOBS] Started {self.num_threads} background job worker thread(s).")
+
+    def notify(self):
+        """Wakes an idle worker in this process straight away (other processes find the job by polling)."""
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                job = self.queue.claim()
+            except sqlite3.Error as e:
+                logging.warning(f"[JOBS] Could not claim a job: {e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._execute(job)
+
+    def _execute(self, job):
+        job_id = job["id"]
+        handler = self.handlers.get(job["kind"])
+        logging.info(f"[JOBS] Running {job['kind']} job {job_id} (attempt {job['attempts'] + 1}).")
+
+        def report(stage, progress):
+            self.queue.update(job_id, stage, round(progress, 3))
+
+        try:
+            if handler is None:
+                raise ValueError(f"No handler registered for job kind '{job['kind']}'.")
+            result = handler(job["payload"], report)
+            self.queue.finish(job_id, result)
+            logging.info(f"[JOBS] Job {job_id} finished.")
+        except Exception as e:
+            logging.exception(f"[JOBS] Job {job_id} failed: {e}")
+            self.queue.fail(job_id, e)
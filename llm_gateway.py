@@ -0,0 +1,286 @@
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+
+from response_cache import make_cache_key
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError: # google-api-core ships with google-generativeai, but keep the gateway importable without it
+    google_exceptions = None
+
+
+# --- Central gateway for every Gemini call ---
+
+AIResult = namedtuple('AIResult', ['text', 'block_reason', 'cached', 'shared', 'cache_key'])
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class LLMGatewayError(RuntimeError):
+    """Base class for failures raised by the gateway itself rather than by the model."""
+    status_code = 500
+
+
+class UpstreamTimeoutError(LLMGatewayError):
+    """The endpoint's deadline passed before Gemini answered."""
+    status_code = 504
+
+
+class CircuitOpenError(LLMGatewayError):
+    """Upstream is failing repeatedly, so calls are rejected without trying."""
+    status_code = 503
+
+
+class GatewayBusyError(LLMGatewayError):
+    """Too many upstream calls already in flight and none freed up before the deadline."""
+    status_code = 503
+
+
+class ContentBlockedError(LLMGatewayError):
+    """A streamed generation produced no text because the prompt was blocked."""
+    status_code = 400
+
+    def __init__(self, block_reason):
+        super().__init__(f"Content blocked due to: {block_reason}.")
+        self.block_reason = block_reason
+
+
+def is_retryable(error):
+    """True for rate limits, 5xx and transport timeouts; False for bad requests and blocked content."""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if google_exceptions is not None and isinstance(error, google_exceptions.RetryError):
+        return True
+    code = getattr(error, 'code', None)
+    try:
+        return int(code) in RETRYABLE_STATUS_CODES
+    except (TypeError, ValueError):
+        return False
+
+
+class CircuitBreaker:
+    """
+    Classic closed -> open -> half-open breaker.
+    After failure_threshold consecutive upstream failures it rejects calls for
+    reset_timeout seconds, then lets a single trial call through.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                raise CircuitOpenError("AI service is temporarily unavailable. Please try again shortly.")
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    logging.warning(f"[LLM_GATEWAY] Circuit opened after {self._failures} consecutive failures.")
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class LLMGateway:
+    """
+    Wraps the shared GenerativeModel so every route gets the same behaviour:
+    response cache, single-flight coalescing, per-endpoint deadlines, jittered
+    retries on 429/5xx, a circuit breaker and a bound on concurrent upstream calls.
+    Streams have a separate bound (max_streams), since their pace is set by the client.
+    """
+
+    def __init__(self, model, model_name, cache=None, single_flight=None, deadlines=None,
+                 default_deadline=30, max_retries=2, backoff_base=0.5, backoff_cap=8,
+                 max_concurrency=8, max_streams=4, breaker=None):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache
+        self.single_flight = single_flight
+        self.deadlines = dict(deadlines or {})
+        self.default_deadline = default_deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._stream_slots = threading.BoundedSemaphore(max_streams)
+
+    def deadline_for(self, endpoint):
+        return self.deadlines.get(endpoint, self.default_deadline)
+
+    def generate(self, endpoint, prompt, generation_config=None, store=True):
+        """
+        Returns an AIResult for prompt.
+        Set store=False for structured output so it is only cached (via store_result) after validation.
+        """
+        cache_key = make_cache_key(self.model_name, prompt, generation_config)
+        if self.cache is not None:
+            cached_text = self.cache.get(cache_key)
+            if cached_text is not None:
+                logging.info(f"[AI_CACHE] Cache hit for '{endpoint}'.")
+                return AIResult(cached_text, None, True, False, cache_key)
+
+        def call_upstream():
+            return self._call_with_retries(endpoint, prompt, generation_config)
+
+        if self.single_flight is not None:
+            outcome, shared = self.single_flight.do(cache_key, call_upstream)
+        else:
+            outcome, shared = call_upstream(), False
+        if shared:
+            logging.info(f"[SINGLE_FLIGHT] Reused in-flight result for '{endpoint}'.")
+
+        result = AIResult(outcome["text"], outcome["block_reason"], False, shared, cache_key)
+        if store:
+            self.store_result(endpoint, result)
+        return result
+
+    def refresh(self, endpoint, prompt, generation_config=None):
+        """
+        Calls Gemini even if prompt is cached, to regenerate an entry before it expires. Returns an AIResult;
+        like generate(store=False), the result is only cached via store_result.
+        """
+        cache_key = make_cache_key(self.model_name, prompt, generation_config)
+        outcome = self._call_with_retries(endpoint, prompt, generation_config)
+        return AIResult(outcome["text"], outcome["block_reason"], False, False, cache_key)
+
+    def stream(self, endpoint, prompt, generation_config=None):
+        """
+        Yields text chunks as Gemini produces them (stream=True).
+        Cache hits come back as a single chunk and complete streams are stored in the cache.
+        Streams are neither retried nor coalesced, since earlier chunks may already be on the client.
+        A stream holds one of max_streams slots until the generator finishes, which happens at the pace the
+        client reads. Those slots are separate from the max_concurrency slots of generate() and refresh(), so
+        slow or stalled readers can exhaust only the streaming slots, never block the non-streamed routes.
+        """
+        cache_key = make_cache_key(self.model_name, prompt, generation_config)
+        if self.cache is not None:
+            cached_text = self.cache.get(cache_key)
+            if cached_text is not None:
+                logging.info(f"[AI_CACHE] Cache hit for streamed '{endpoint}'.")
+                yield cached_text
+                return
+
+        deadline = time.monotonic() + self.deadline_for(endpoint)
+        if not self._stream_slots.acquire(timeout=self.deadline_for(endpoint)):
+            raise GatewayBusyError("AI service is busy. Please try again shortly.")
+        pieces = []
+        try:
+            self.breaker.before_call()
+            try:
+                response = self.model.generate_content(
+                    prompt,
+                    generation_config=generation_config,
+                    stream=True,
+                    request_options={"timeout": max(deadline - time.monotonic(), 1)},
+                )
+                for chunk in response:
+                    text = chunk.parts[0].text if chunk.parts else ""
+                    if text:
+                        pieces.append(text)
+                        yield text
+            except GeneratorExit: # Client went away mid-stream; upstream itself was fine
+                self.breaker.record_success()
+                raise
+            except Exception as e:
+                if is_retryable(e):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+        finally:
+            self._stream_slots.release()
+
+        full_text = "".join(pieces)
+        if not full_text.strip():
+            if response.prompt_feedback and response.prompt_feedback.block_reason:
+                raise ContentBlockedError(str(response.prompt_feedback.block_reason))
+        elif self.cache is not None:
+            self.cache.set(cache_key, full_text, endpoint=endpoint)
+
+    def store_result(self, endpoint, result):
+        """Stores a fresh, non-empty result in the response cache."""
+        if self.cache is not None and not result.cached and result.text.strip():
+            self.cache.set(result.cache_key, result.text, endpoint=endpoint)
+
+    def _call_with_retries(self, endpoint, prompt, generation_config):
+        deadline = time.monotonic() + self.deadline_for(endpoint)
+        attempt = 0
+        while True:
+            try:
+                outcome = self._call_once(prompt, generation_config, deadline)
+            except LLMGatewayError:
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    self.breaker.record_success() # Upstream answered; the request itself was bad
+                    raise
+                self.breaker.record_failure()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise UpstreamTimeoutError(f"AI service did not respond within {self.deadline_for(endpoint)}s.") from e
+                if attempt >= self.max_retries:
+                    raise
+                delay = min(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)), remaining)
+                logging.warning(f"[LLM_GATEWAY] '{endpoint}' attempt {attempt + 1} failed ({e}); retrying in {delay:.2f}s.")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return outcome
+
+    def _call_once(self, prompt, generation_config, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+            raise GatewayBusyError("AI service is busy. Please try again shortly.")
+        try:
+            self.breaker.before_call()
+            response = self.model.generate_content(
+                prompt,
+                generation_config=generation_config,
+                request_options={"timeout": max(deadline - time.monotonic(), 1)},
+            )
+        finally:
+            self._slots.release()
+        return extract_outcome(response)
+
+
+def extract_outcome(response):
+    """Pulls the text (or the block reason when there is none) out of a GenerateContentResponse."""
+    text = ""
+    if response.parts: text = response.parts[0].text
+    elif hasattr(response, 'text'): text = response.text
+
+    block_reason = None
+    if not text.strip() and response.prompt_feedback and response.prompt_feedback.block_reason:
+        block_reason = str(response.prompt_feedback.block_reason)
+    return {"text": text, "block_reason": block_reason}
@@ -0,0 +1,212 @@
+import io
+import logging
+import os
+import signal
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from pypdf import PdfReader
+
+from extraction_cache import sha256_bytes
+
+
+# --- Shared text extraction for every upload path ---
+
+PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', 40)) # Below this one worker handles the whole file
+PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', 25))
+MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', 1000))
+CPU_SECONDS_PER_DOCUMENT = int(os.getenv('PDF_CPU_SECONDS_PER_DOCUMENT', 60))
+WALL_SECONDS_PER_DOCUMENT = int(os.getenv('PDF_WALL_SECONDS_PER_DOCUMENT', 120))
+MAX_WORKERS = int(os.getenv('PDF_EXTRACTION_WORKERS', max(1, min(4, (os.cpu_count() or 2) - 1))))
+
+# text: all pages joined with "\n"; page_offsets[i]: index in text where page (first_page + i) starts
+ExtractedText = namedtuple('ExtractedText', ['text', 'page_offsets', 'first_page', 'page_count', 'total_pages', 'sha256'])
+
+
+class PdfExtractionError(IOError):
+    """The PDF could not be read, or used more CPU/wall time than a single document is allowed."""
+
+
+class _CpuBudgetExceeded(BaseException):
+    """BaseException, so per-page "except Exception" handlers (ours or pypdf's) can't swallow it."""
+
+
+_HAS_CPU_TIMER = hasattr(signal, 'SIGPROF') and hasattr(signal, 'setitimer') # Not on Windows
+
+
+def _on_cpu_budget_exceeded(signum, frame):
+    raise _CpuBudgetExceeded()
+
+
+def _open_reader(data):
+    reader = PdfReader(io.BytesIO(data))
+    if reader.is_encrypted:
+        try: reader.decrypt('')
+        except Exception as e: logging.warning(f"Could not decrypt PDF: {e}. Extraction might fail.")
+    return reader
+
+
+def _run_with_cpu_budget(cpu_seconds, fn, *args):
+    """
+    Runs fn in a pool process, aborting it once it has used cpu_seconds of CPU time (SIGPROF). Where the
+    platform has no CPU timer, only the wall-clock cap in extract_pdf_text applies.
+    """
+    if not _HAS_CPU_TIMER:
+        return fn(*args)
+    previous = signal.signal(signal.SIGPROF, _on_cpu_budget_exceeded)
+    signal.setitimer(signal.ITIMER_PROF, cpu_seconds)
+    try:
+        return fn(*args)
+    except _CpuBudgetExceeded:
+        raise PdfExtractionError(f"PDF extraction exceeded its CPU budget of {cpu_seconds}s.")
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, previous)
+
+
+def _count_pages(data):
+    started = time.process_time()
+    return len(_open_reader(data).pages), time.process_time() - started
+
+
+def _extract_page_range(data, start, stop):
+    reader = _open_reader(data)
+    texts = []
+    for i in range(start, stop):
+        try:
+            texts.append(reader.pages[i].extract_text() or "")
+        except _CpuBudgetExceeded:
+            raise # The timer is one-shot: carrying on would leave the rest of the range uncapped
+        except Exception as page_e:
+            logging.warning(f"Could not extract text from page {i+1}: {page_e}")
+            texts.append("")
+    return texts
+
+
+def _budgeted_count_pages(data, cpu_seconds):
+    """Returns (page count, CPU seconds used), so the rest of the document's budget can be split over its batches."""
+    return _run_with_cpu_budget(cpu_seconds, _count_pages, data)
+
+
+def _budgeted_extract_page_range(data, start, stop, cpu_seconds):
+    return _run_with_cpu_budget(cpu_seconds, _extract_page_range, data, start, stop)
+
+
+_worker_slots = threading.BoundedSemaphore(MAX_WORKERS) # Extraction processes across all concurrent documents
+
+
+class _DocumentWorkers:
+    """
+    The worker processes extracting one document, holding one slot of _worker_slots each. Documents get their
+    own processes so that stopping a runaway document (a running task can't be cancelled, only killed) never
+    breaks another request's extraction.
+    """
+
+    def __init__(self, deadline):
+        if not _worker_slots.acquire(timeout=max(0, deadline - time.monotonic())):
+            raise FutureTimeoutError()
+        self.slots = 1
+        self.pool = ProcessPoolExecutor(max_workers=1)
+
+    def grow(self, wanted):
+        """Takes up to wanted workers in all, as far as free slots allow; call only while the pool is idle."""
+        extra = 0
+        while self.slots + extra < wanted and _worker_slots.acquire(blocking=False):
+            extra += 1
+        if extra:
+            self.pool.shutdown(wait=True)
+            self.slots += extra
+            self.pool = ProcessPoolExecutor(max_workers=self.slots)
+
+    def close(self, terminate=False):
+        """Shuts the processes down; terminate=True kills them first, for tasks still running past the deadline."""
+        if terminate:
+            for process in list((getattr(self.pool, '_processes', None) or {}).values()):
+                process.terminate()
+        self.pool.shutdown(wait=not terminate, cancel_futures=True)
+        for _ in range(self.slots):
+            _worker_slots.release()
+        self.slots = 0
+
+
+def decode_text_bytes(data, filename="upload"):
+    """Decodes an uploaded .txt file as UTF-8, falling back to latin-1."""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        logging.warning(f"UTF-8 decode failed for {filename}, trying latin-1")
+        return data.decode('latin-1', errors='ignore')
+
+
+def extract_pdf_text(data, filename="upload", page_range=None, max_pages=MAX_PAGES, cache=None):
+    """
+    Extracts text from PDF bytes in a pool of worker processes.
+    Large documents are split into page batches extracted in parallel; every batch runs under a
+    CPU-time cap and the whole document under a wall-clock cap, so a pathological PDF cannot pin
+    a web worker. page_range is an optional 0-based (start, stop) slice; at most max_pages are read.
+    With an ExtractedTextCache, repeat uploads of the same bytes skip parsing entirely.
+    """
+    digest = sha256_bytes(data)
+    cache_key = digest if page_range is None and max_pages == MAX_PAGES else f"{digest}-p{page_range}-m{max_pages}".replace(" ", "")
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            logging.info(f"Extracted text for {filename} served from cache ({digest[:12]}).")
+            return ExtractedText(**cached)
+
+    deadline = time.monotonic() + WALL_SECONDS_PER_DOCUMENT
+    workers = None
+    try:
+        workers = _DocumentWorkers(deadline)
+        total_pages, cpu_used = workers.pool.submit(_budgeted_count_pages, data, CPU_SECONDS_PER_DOCUMENT).result(
+            timeout=max(0, deadline - time.monotonic()))
+
+        start, stop = page_range or (0, total_pages)
+        start, stop = max(0, start), min(stop, total_pages)
+        if max_pages and stop - start > max_pages:
+            logging.warning(f"{filename}: limiting extraction to {max_pages} of {stop - start} pages.")
+            stop = start + max_pages
+
+        if stop - start < PARALLEL_MIN_PAGES:
+            batches = [(start, stop)] if stop > start else []
+        else:
+            batches = [(b, min(b + PAGES_PER_TASK, stop)) for b in range(start, stop, PAGES_PER_TASK)]
+        # Batches share what is left of the per-document CPU budget, so their sum never exceeds it
+        cpu_per_batch = max(0.0, CPU_SECONDS_PER_DOCUMENT - cpu_used) / max(1, len(batches))
+        if batches and cpu_per_batch < 0.01:
+            raise PdfExtractionError(f"PDF extraction exceeded its CPU budget of {CPU_SECONDS_PER_DOCUMENT}s.")
+        workers.grow(len(batches))
+        futures = [workers.pool.submit(_budgeted_extract_page_range, data, b_start, b_stop, cpu_per_batch)
+                   for b_start, b_stop in batches]
+        pages = []
+        for future in futures:
+            pages.extend(future.result(timeout=max(0, deadline - time.monotonic())))
+    except FutureTimeoutError:
+        if workers is not None:
+            workers.close(terminate=True) # Frees the workers still stuck on this document
+            workers = None
+        raise PdfExtractionError(f"PDF extraction for {filename} took longer than {WALL_SECONDS_PER_DOCUMENT}s.")
+    except BrokenProcessPool:
+        raise PdfExtractionError(f"PDF extraction worker crashed while reading {filename}.")
+    except PdfExtractionError:
+        raise
+    except Exception as e:
+        raise PdfExtractionError(f"Could not read PDF {filename}: {e}") from e
+    finally:
+        if workers is not None:
+            workers.close()
+
+    page_offsets = []
+    offset = 0
+    for page_text in pages:
+        page_offsets.append(offset)
+        offset += len(page_text) + 1 # +1 for the joining newline
+    text = "\n".join(pages)
+    logging.info(f"Extracted text from {len(pages)} page(s) of {filename} in {len(batches)} batch(es).")
+    extracted = ExtractedText(text, page_offsets, start, len(pages), total_pages, digest)
+    if cache is not None:
+        cache.set(cache_key, extracted._asdict())
+    return extracted
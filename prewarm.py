@@ -0,0 +1,158 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+    import fcntl # POSIX only; elsewhere every worker process may pre-warm
+except ImportError:
+    fcntl = None
+
+from response_cache import make_cache_key, normalize_prompt
+
+
+# --- Pre-warming the response cache for fixed-choice and popular prompts ---
+
+# endpoint: response cache endpoint; prompt/generation_config: exactly what the route sends;
+# validate(text): raises ValueError if the output must not be cached (None: any non-empty text is stored)
+PrewarmJob = namedtuple('PrewarmJob', ['endpoint', 'prompt', 'generation_config', 'validate'])
+
+
+class PromptPopularity:
+    """
+    Counts how often each input (battle name, process name, topic) is requested per endpoint and day, in a
+    SQLite file shared by every worker on the host. Inputs are keyed with whitespace collapsed, as in cache keys.
+    """
+
+    def __init__(self, db_path, retention_days=30):
+        self.db_path = db_path
+        self.retention_days = retention_days
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS prompt_hits (
+                       endpoint TEXT NOT NULL,
+                       value TEXT NOT NULL,
+                       day INTEGER NOT NULL,
+                       hits INTEGER NOT NULL,
+                       PRIMARY KEY (endpoint, value, day)
+                   )"""
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, endpoint, value):
+        """Counts one request; failures are logged and ignored (popularity is only a hint)."""
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT INTO prompt_hits (endpoint, value, day, hits) VALUES (?, ?, ?, 1) "
+                    "ON CONFLICT (endpoint, value, day) DO UPDATE SET hits = hits + 1",
+                    (endpoint, normalize_prompt(value), int(time.time() // 86400)),
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"[PREWARM] Could not record request for '{endpoint}': {e}")
+
+    def top(self, endpoint, limit, days=7):
+        """Returns the limit most requested inputs for endpoint over the last days, most popular first."""
+        if limit <= 0:
+            return []
+        today = int(time.time() // 86400)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM prompt_hits WHERE day < ?", (today - self.retention_days,))
+            rows = conn.execute(
+                "SELECT value, SUM(hits) AS total FROM prompt_hits WHERE endpoint = ? AND day > ? "
+                "GROUP BY value ORDER BY total DESC, value LIMIT ?",
+                (endpoint, today - days, limit),
+            ).fetchall()
+        return [value for value, _ in rows]
+
+
+class CachePrewarmer:
+    """
+    Background thread that regenerates the responses for jobs() (a callable returning PrewarmJobs) whenever they
+    are missing from the response cache or expire within refresh_fraction of their endpoint's TTL, so the first
+    student to ask gets a cache hit. Calls run one at a time, at most max_calls per run, and a lock file ensures
+    only one worker process pre-warms at a time.
+    """
+
+    def __init__(self, gateway, cache, jobs, interval=3600, refresh_fraction=0.1, max_calls=50, start_delay=60):
+        self.gateway = gateway
+        self.cache = cache
+        self.jobs = jobs
+        self.interval = interval
+        self.refresh_fraction = refresh_fraction
+        self.max_calls = max_calls
+        self.start_delay = start_delay # Lets the app finish starting before any upstream calls
+        self._lock_path = cache.db_path + ".prewarm.lock"
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Starts the thread (once; later calls do nothing)."""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="cache-prewarmer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        time.sleep(self.start_delay)
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.exception(f"[PREWARM] Run failed: {e}")
+            time.sleep(self.interval)
+
+    def needs_refresh(self, job):
+        key = make_cache_key(self.gateway.model_name, job.prompt, job.generation_config)
+        remaining = self.cache.time_to_live(key)
+        return remaining is None or remaining <= self.cache.ttl_for(job.endpoint) * self.refresh_fraction
+
+    def run_once(self):
+        """Refreshes stale or missing entries; returns (refreshed, failed), or None if another process is pre-warming."""
+        if fcntl is None:
+            return self._refresh([job for job in self.jobs() if self.needs_refresh(job)])
+        with open(self._lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                return self._refresh([job for job in self.jobs() if self.needs_refresh(job)])
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self, stale):
+        refreshed = failed = 0
+        for job in stale[:self.max_calls]:
+            try:
+                result = self.gateway.refresh(job.endpoint, job.prompt, job.generation_config)
+                if not result.text.strip():
+                    raise ValueError(f"empty response (block reason: {result.block_reason})")
+                if job.validate is not None:
+                    job.validate(result.text)
+            except Exception as e:
+                logging.warning(f"[PREWARM] Could not refresh a '{job.endpoint}' entry: {e}")
+                failed += 1
+                continue
+            self.gateway.store_result(job.endpoint, result)
+            refreshed += 1
+        if stale:
+            skipped = max(len(stale) - self.max_calls, 0)
+            logging.info(f"[PREWARM] Refreshed {refreshed}, failed {failed}, deferred {skipped} of {len(stale)} stale entries.")
+        return refreshed, failed
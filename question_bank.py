@@ -0,0 +1,70 @@
+import hashlib
+import random
+import re
+
+from bm25_index import tokenize
+
+
+# --- Quiz question bank: topic fingerprints, duplicate keys and question selection ---
+
+VALID_ANSWERS = ("A", "B", "C", "D")
+
+
+def topic_fingerprint(source_text):
+    """
+    Identifies a quiz topic independently of case, punctuation, word order, stopwords and plurals, so
+    "Newton's laws of motion" and "laws of motion (Newton)" share banked questions.
+    """
+    terms = sorted({term for term in tokenize(source_text) if len(term) > 1}) # Drops the "s" of possessives
+    return hashlib.sha256(" ".join(terms).encode("utf-8")).hexdigest()[:32]
+
+
+def question_key(question_text):
+    """Duplicate-detection key: the question text case-folded with punctuation and spacing removed."""
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", question_text.lower()).split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:32]
+
+
+def clean_question(q):
+    """Returns a validated quiz item as a plain dict (stripped text, upper-case answer letter)."""
+    return {
+        "question": q["question"].strip(),
+        "options": [option.strip() for option in q["options"]],
+        "correct_answer": q["correct_answer"].strip().upper(),
+    }
+
+
+def _content_words(question_text):
+    return {term for term in tokenize(question_text) if len(term) > 1}
+
+
+def unique_questions(questions, existing=(), threshold=0.8):
+    """
+    Drops questions that repeat an existing question text or an earlier question in the list: same key, or a
+    Jaccard similarity of their content words of at least threshold (so rephrasings count). Keeps the input order.
+    """
+    seen_keys = {question_key(text) for text in existing}
+    seen_words = [_content_words(text) for text in existing]
+    unique = []
+    for q in questions:
+        key, words = question_key(q["question"]), _content_words(q["question"])
+        if key in seen_keys or any(
+            words and other and len(words & other) / len(words | other) >= threshold for other in seen_words
+        ):
+            continue
+        seen_keys.add(key)
+        seen_words.append(words)
+        unique.append(q)
+    return unique
+
+
+def pick_least_served(candidates, count, exclude_keys=(), rng=random):
+    """
+    Chooses up to count banked questions (objects with question_key and times_served), skipping exclude_keys.
+    Least served questions come first and ties are shuffled, so a class re-running a topic sees variety.
+    """
+    exclude = set(exclude_keys)
+    available = [c for c in candidates if c.question_key not in exclude]
+    rng.shuffle(available)
+    available.sort(key=lambda c: c.times_served)
+    return available[:count]
@@ -0,0 +1,202 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# --- Two-tier (memory LRU + SQLite) cache for AI responses ---
+
+def normalize_prompt(prompt):
+    """Collapses whitespace so prompts that only differ in indentation share a key."""
+    return " ".join(str(prompt).split())
+
+
+def normalize_question(question):
+    """Like normalize_prompt, but also case-folds and drops surrounding punctuation for user questions."""
+    return normalize_prompt(question).lower().strip(" ?!.")
+
+
+def _config_to_dict(generation_config):
+    """Turns a GenerationConfig (dataclass, dict or None) into something JSON-serialisable."""
+    if generation_config is None:
+        return None
+    if dataclasses.is_dataclass(generation_config):
+        return dataclasses.asdict(generation_config)
+    if isinstance(generation_config, dict):
+        return generation_config
+    return repr(generation_config)
+
+
+def make_cache_key(model_name, prompt, generation_config=None):
+    """Builds a stable SHA-256 key from (model name, normalized prompt, generation config)."""
+    payload = json.dumps(
+        {
+            "model": model_name,
+            "prompt": normalize_prompt(prompt),
+            "config": _config_to_dict(generation_config),
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Caches generated text in an in-process LRU backed by a SQLite file.
+    The memory tier answers repeat requests inside one worker; the SQLite tier
+    is shared by every worker on the host and survives restarts.
+    """
+
+    def __init__(self, db_path, max_memory_entries=512, max_disk_entries=20000,
+                 default_ttl=3600, endpoint_ttls=None):
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.default_ttl = default_ttl
+        self.endpoint_ttls = dict(endpoint_ttls or {})
+
+        self._memory = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                       key TEXT PRIMARY KEY,
+                       endpoint TEXT NOT NULL,
+                       value TEXT NOT NULL,
+                       created_at REAL NOT NULL,
+                       expires_at REAL NOT NULL,
+                       last_access REAL NOT NULL
+                   )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def ttl_for(self, endpoint):
+        return self.endpoint_ttls.get(endpoint, self.default_ttl)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _remember(self, key, value, expires_at):
+        """Puts an entry in the memory tier, evicting least-recently-used entries past the bound."""
+        with self._lock:
+            self._memory[key] = (value, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def get(self, key):
+        """Returns the cached value for key, or None on a miss or expiry."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row and row[1] > now:
+                    conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                elif row:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    row = None
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache read failed, treating as miss: {e}")
+            row = None
+
+        if row is None:
+            self._count("misses")
+            return None
+
+        value, expires_at = row
+        self._remember(key, value, expires_at)
+        self._count("disk_hits")
+        return value
+
+    def time_to_live(self, key):
+        """Seconds until key expires, or None if it isn't cached; doesn't count as a lookup or refresh last_access."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[1] - now
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache read failed, treating as missing: {e}")
+            return None
+        return row[0] - now if row and row[0] > now else None
+
+    def set(self, key, value, endpoint="default", ttl=None):
+        """Stores value in both tiers with the endpoint's TTL and trims the SQLite tier."""
+        now = time.time()
+        expires_at = now + (ttl if ttl is not None else self.ttl_for(endpoint))
+        self._remember(key, value, expires_at)
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, endpoint, value, created_at, expires_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, endpoint, value, now, expires_at, now),
+                )
+                self._evict_disk(conn, now)
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache write failed for endpoint '{endpoint}': {e}")
+            return
+        self._count("stores")
+
+    def _evict_disk(self, conn, now):
+        conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        (total,) = conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        overflow = total - self.max_disk_entries
+        if overflow > 0:
+            conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                (overflow,),
+            )
+            self._count("evictions", overflow)
+
+    def stats(self):
+        """Returns hit/miss counters for this process plus the current tier sizes."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_entries"] = len(self._memory)
+        try:
+            with self._connect() as conn:
+                (stats["disk_entries"],) = conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        except sqlite3.Error:
+            stats["disk_entries"] = None
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
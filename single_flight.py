@@ -0,0 +1,172 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl # POSIX only; on other platforms we coalesce within the process only
+except ImportError:
+    fcntl = None
+
+
+# --- Single-flight coalescing of identical in-flight calls ---
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Makes concurrent callers with the same key share one execution of the work.
+    Threads in a worker wait on the leader's Event; workers on the same host
+    serialise on a lock file for the key (removed once the result is published)
+    and pick up the leader's result from a small SQLite table instead of
+    repeating the call.
+    """
+
+    def __init__(self, state_dir, wait_timeout=120, result_ttl=60):
+        self.lock_dir = os.path.join(state_dir, "flight_locks")
+        self.db_path = os.path.join(state_dir, "flights.db")
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+
+        self._calls = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS flights (
+                       key TEXT PRIMARY KEY,
+                       value TEXT NOT NULL,
+                       finished_at REAL NOT NULL
+                   )"""
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def do(self, key, fn):
+        """
+        Runs fn() once for all concurrent callers of key.
+        Returns (value, shared) where shared is True if this caller reused another caller's result.
+        fn must return a JSON-serialisable value so it can be handed to other workers.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            if not call.done.wait(self.wait_timeout):
+                raise TimeoutError(f"Timed out waiting for in-flight request {key[:12]}")
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value, shared = self._run_across_workers(key, fn)
+            return call.value, shared
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            call.done.set()
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def _lock_path(self, key):
+        return os.path.join(self.lock_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".lock")
+
+    def _run_across_workers(self, key, fn):
+        if fcntl is None:
+            return fn(), False
+
+        started_at = time.time()
+        lock_path = self._lock_path(key)
+        lock_file = self._acquire(lock_path)
+        if lock_file is None:
+            logging.warning(f"[SINGLE_FLIGHT] Lock wait timed out for {key[:12]}, calling upstream directly.")
+            return fn(), False
+        try:
+            # Another worker may have finished the same call while we were waiting on the lock.
+            published = self._published_since(key, started_at)
+            if published is not None:
+                return published, True
+            value = fn()
+            self._publish(key, value)
+            return value, False
+        finally:
+            try:
+                os.remove(lock_path) # Keeps one file per key from piling up; waiters notice and reopen
+            except OSError:
+                pass
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def _acquire(self, lock_path):
+        """
+        Opens and locks the key's lock file, or returns None after wait_timeout. A lock won on a file that the
+        previous holder has since removed doesn't count (a new caller could lock the new file), so it reopens.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            lock_file = open(lock_path, "a+")
+            try:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() >= deadline:
+                            lock_file.close()
+                            return None
+                        time.sleep(0.05)
+                try:
+                    if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path)):
+                        return lock_file
+                except FileNotFoundError:
+                    pass
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    def _published_since(self, key, since):
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT value FROM flights WHERE key = ? AND finished_at >= ?", (key, since)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"[SINGLE_FLIGHT] Could not read published result: {e}")
+            return None
+        return json.loads(row[0]) if row else None
+
+    def _publish(self, key, value):
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO flights (key, value, finished_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), now),
+                )
+                conn.execute("DELETE FROM flights WHERE finished_at < ?", (now - self.result_ttl,))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logging.warning(f"[SINGLE_FLIGHT] Could not publish result for other workers: {e}")
@@ -101,6 +101,69 @@ document.addEventListener("DOMContentLoaded", () => {
     return htmlContent.trim() ? htmlContent : `<p>${text}</p>`; // Fallback if no formatting applied
   }
 
+  /**
+   * POSTs to an AI endpoint in streaming mode (?stream=1) and reads its Server-Sent Events.
+   * @param {string} url - The endpoint, e.g. "/generate-summary".
+   * @param {object} fetchOptions - Options passed straight to fetch (method, headers, body).
+   * @param {function} onText - Called with the full text received so far after every chunk.
+   * @returns {Promise<string>} - The complete generated text.
+   * Errors reported by the server (before or during the stream) reject with error.serverMessage set.
+   */
+  async function streamGeneration(url, fetchOptions, onText) {
+    const response = await fetch(`${url}?stream=1`, fetchOptions);
+
+    if (!response.ok || !response.body) {
+      let errorMsg = `HTTP error! status: ${response.status} ${response.statusText}`;
+      try {
+        const data = await response.json();
+        errorMsg = data.error || data.reply || errorMsg;
+      } catch (e) {
+        /* Ignore if error response isn't JSON */
+      }
+      const error = new Error(errorMsg);
+      error.serverMessage = errorMsg;
+      throw error;
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let fullText = "";
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      // SSE events are separated by a blank line
+      let boundary;
+      while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+
+        let eventType = "message";
+        const dataLines = [];
+        rawEvent.split("\n").forEach((line) => {
+          if (line.startsWith("event:")) eventType = line.slice(6).trim();
+          else if (line.startsWith("data:")) dataLines.push(line.slice(5).trim());
+        });
+        const payload = dataLines.length ? JSON.parse(dataLines.join("\n")) : {};
+
+        if (eventType === "error") {
+          const error = new Error(payload.error);
+          error.serverMessage = payload.error;
+          throw error;
+        }
+        if (eventType === "done") return fullText;
+        if (payload.delta) {
+          fullText += payload.delta;
+          onText(fullText);
+        }
+      }
+    }
+    return fullText;
+  }
+
   // === ENDING GLOBAL HELPER FUNCTIONS ===
 
   // === Summarization Feature Block (Attach Button UI) ===
@@ -207,27 +270,26 @@ document.addEventListener("DOMContentLoaded", () => {
       if (summaryTtsButton) summaryTtsButton.style.display = "none";
 
       try {
-        console.log("Sending request to /generate-summary...");
-        const response = await fetch("/generate-summary", fetchOptions); // Use prepared options
+        console.log("Streaming request to /generate-summary...");
+        // Render the summary as it arrives instead of waiting for the whole completion
+        const summary = await streamGeneration(
+          "/generate-summary",
+          fetchOptions,
+          (textSoFar) => {
+            summaryLoadingDiv.style.display = "none";
+            displaySummaryResult(textSoFar);
+          }
+        );
 
         summaryLoadingDiv.style.display = "none";
-        const data = await response.json(); // Expect JSON response always
-
-        if (!response.ok) {
-          const errorMsg =
-            data.error ||
-            `HTTP error! status: ${response.status} ${response.statusText}`;
-          console.error("Summary generation failed:", errorMsg);
-          displaySummaryError(errorMsg);
-        } else {
-          console.log("Summary received:", data.summary);
-          displaySummaryResult(data.summary); // Display result
-        }
+        console.log("Summary received:", summary);
+        displaySummaryResult(summary); // Display result
       } catch (error) {
         console.error("Error during summary fetch operation:", error);
         summaryLoadingDiv.style.display = "none";
         displaySummaryError(
-          "A network or unexpected error occurred. Please check the console."
+          error.serverMessage ||
+            "A network or unexpected error occurred. Please check the console."
         );
       } finally {
         // Clear file selection after attempt
@@ -875,31 +937,29 @@ document.addEventListener("DOMContentLoaded", () => {
       flowErrorDiv.style.display = "none";
 
       try {
-        console.log("Sending selected battle for event flow...");
-        const response = await fetch("/generate-battle-flow", {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({ battle: selectedBattle }),
-        });
+        console.log("Streaming selected battle for event flow...");
+        const flow = await streamGeneration(
+          "/generate-battle-flow",
+          {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ battle: selectedBattle }),
+          },
+          (textSoFar) => {
+            flowLoadingDiv.style.display = "none";
+            displayFlowResult(textSoFar);
+          }
+        );
 
         flowLoadingDiv.style.display = "none";
-        const data = await response.json();
-
-        if (!response.ok) {
-          const errorMsg =
-            data.error ||
-            `HTTP error! status: ${response.status} ${response.statusText}`;
-          console.error("Battle flow generation failed:", errorMsg);
-          displayFlowError(errorMsg);
-        } else {
-          console.log("Battle flow received:", data.flow);
-          displayFlowResult(data.flow);
-        }
+        console.log("Battle flow received:", flow);
+        displayFlowResult(flow);
       } catch (error) {
         console.error("Error during battle flow fetch operation:", error);
         flowLoadingDiv.style.display = "none";
         displayFlowError(
-          "An network or unexpected error occurred. Please check the console."
+          error.serverMessage ||
+            "An network or unexpected error occurred. Please check the console."
         );
       }
     });
@@ -1701,27 +1761,25 @@ document.addEventListener("DOMContentLoaded", () => {
       if (feedbackTtsButton) feedbackTtsButton.style.display = "none";
 
       try {
-        console.log("Sending request to /get-writing-feedback...");
-        const response = await fetch("/get-writing-feedback", fetchOptions); // Use prepared options
+        console.log("Streaming request to /get-writing-feedback...");
+        const feedback = await streamGeneration(
+          "/get-writing-feedback",
+          fetchOptions,
+          (textSoFar) => {
+            feedbackLoadingDiv.style.display = "none";
+            displayWritingFeedbackResult(textSoFar);
+          }
+        );
 
         feedbackLoadingDiv.style.display = "none";
-        const data = await response.json(); // Expect JSON response (feedback or error)
-
-        if (!response.ok) {
-          const errorMsg =
-            data.error ||
-            `HTTP error! status: ${response.status} ${response.statusText}`;
-          console.error("Writing feedback generation failed:", errorMsg);
-          displayWritingFeedbackError(errorMsg);
-        } else {
-          console.log("Writing feedback received.");
-          displayWritingFeedbackResult(data.feedback); // Display the feedback
-        }
+        console.log("Writing feedback received.");
+        displayWritingFeedbackResult(feedback); // Display the feedback
       } catch (error) {
         console.error("Error during writing feedback fetch operation:", error);
         feedbackLoadingDiv.style.display = "none";
         displayWritingFeedbackError(
-          "A network or unexpected error occurred. Please check the console."
+          error.serverMessage ||
+            "A network or unexpected error occurred. Please check the console."
         );
       } finally {
         // Clear file input after attempt
@@ -2337,35 +2395,33 @@ document.addEventListener("DOMContentLoaded", () => {
         true
       ); // true for temporary
 
+      let replyDiv = null; // Created when the first chunk arrives
       try {
-        console.log("Sending message to chatbot backend:", userMessage);
-        const response = await fetch("/chatbot-message", {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({ message: userMessage }),
-        });
+        console.log("Streaming message to chatbot backend:", userMessage);
+        const reply = await streamGeneration(
+          "/chatbot-message",
+          {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ message: userMessage }),
+          },
+          (textSoFar) => {
+            // Swap the "thinking" message for the reply as soon as text arrives
+            if (thinkingMessageDiv && thinkingMessageDiv.parentNode) {
+              thinkingMessageDiv.remove();
+            }
+            if (!replyDiv) replyDiv = addMessageToChat("", "ai");
+            replyDiv.textContent = textSoFar;
+            chatbotMessagesDiv.scrollTop = chatbotMessagesDiv.scrollHeight;
+          }
+        );
 
         // Remove "thinking" message
         if (thinkingMessageDiv && thinkingMessageDiv.parentNode) {
           thinkingMessageDiv.remove();
         }
-
-        if (!response.ok) {
-          let errorMsg = `Error: ${response.status}`;
-          try {
-            const errorData = await response.json();
-            errorMsg = errorData.error || errorData.reply || errorMsg;
-          } catch (e) {
-            /* Ignore if error response isn't JSON */
-          }
-          addMessageToChat(errorMsg, "ai-error"); // Use a different class for errors
-          console.error("Chatbot backend error:", errorMsg);
-        } else {
-          const data = await response.json();
-          addMessageToChat(
-            data.reply || "Sorry, I couldn't get a response.",
-            "ai"
-          );
+        if (!replyDiv) {
+          addMessageToChat(reply || "Sorry, I couldn't get a response.", "ai");
         }
       } catch (error) {
         console.error("Error sending/receiving chatbot message:", error);
@@ -2374,7 +2430,8 @@ document.addEventListener("DOMContentLoaded", () => {
           thinkingMessageDiv.remove();
         }
         addMessageToChat(
-          "Network error. Could not reach the AI helper.",
+          error.serverMessage ||
+            "Network error. Could not reach the AI helper.",
           "ai-error"
         );
       } finally {
@@ -2696,32 +2753,26 @@ document.addEventListener("DOMContentLoaded", () => {
 
         try {
           console.log(
-            "[HISTORY_FLOW] Sending selected battle for event flow..."
+            "[HISTORY_FLOW] Streaming selected battle for event flow..."
+          );
+          const flow = await streamGeneration(
+            "/generate-battle-flow",
+            {
+              method: "POST",
+              headers: { "Content-Type": "application/json" },
+              body: JSON.stringify({ battle: selectedBattle }),
+            },
+            (textSoFar) => {
+              battleFlowLoadingDiv.style.display = "none";
+              if (typeof displayBattleFlowResult === "function")
+                displayBattleFlowResult(textSoFar);
+            }
           );
-          const response = await fetch("/generate-battle-flow", {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ battle: selectedBattle }),
-          });
 
           battleFlowLoadingDiv.style.display = "none";
-          const data = await response.json();
-
-          if (!response.ok) {
-            const errorMsg =
-              data.error ||
-              `HTTP error! status: ${response.status} ${response.statusText}`;
-            console.error(
-              "[HISTORY_FLOW] Battle flow generation failed:",
-              errorMsg
-            );
-            if (typeof displayBattleFlowError === "function")
-              displayBattleFlowError(errorMsg);
-          } else {
-            console.log("[HISTORY_FLOW] Battle flow received:", data.flow);
-            if (typeof displayBattleFlowResult === "function")
-              displayBattleFlowResult(data.flow);
-          }
+          console.log("[HISTORY_FLOW] Battle flow received:", flow);
+          if (typeof displayBattleFlowResult === "function")
+            displayBattleFlowResult(flow);
         } catch (error) {
           console.error(
             "[HISTORY_FLOW] Error during battle flow fetch operation:",
@@ -2730,7 +2781,8 @@ document.addEventListener("DOMContentLoaded", () => {
           battleFlowLoadingDiv.style.display = "none";
           if (typeof displayBattleFlowError === "function")
             displayBattleFlowError(
-              "A network or unexpected error occurred. Please check the console."
+              error.serverMessage ||
+                "A network or unexpected error occurred. Please check the console."
             );
         }
       });
@@ -3005,6 +3057,16 @@ document.addEventListener("DOMContentLoaded", () => {
     const pdfQaLoadingAnswerDiv = pdfQaFeatureBox.querySelector(
       ".pdf-qa-loading-answer-control"
     );
+    // Optional: picker for the user's previously processed PDFs
+    const pdfDocumentsDiv = pdfQaFeatureBox.querySelector(
+      ".pdf-documents-control"
+    );
+    const pdfDocumentsListDiv = pdfQaFeatureBox.querySelector(
+      ".pdf-documents-list-control"
+    );
+    const usePdfDocumentsButton = pdfQaFeatureBox.querySelector(
+      ".use-pdf-documents-button-control"
+    );
 
     // Check if all core elements within the identified feature box are found
     if (
@@ -3022,6 +3084,98 @@ document.addEventListener("DOMContentLoaded", () => {
         "[PDF_QA_Integrated] All necessary elements for PDF Q&A found."
       );
 
+      // --- Processed PDF picker ---
+      function showSelectedDocuments(filenames, message) {
+        currentPdfFilenameSpan.textContent = filenames.join(", ");
+        pdfQaSectionDiv.style.display = "block";
+        pdfQaChatMessagesDiv.innerHTML = "";
+        addPdfQaMessage(message, "ai");
+      }
+
+      async function loadPdfDocuments(showSelection) {
+        if (!pdfDocumentsDiv || !pdfDocumentsListDiv) return;
+        try {
+          const response = await fetch("/pdf-documents");
+          const data = await response.json();
+          if (!response.ok || !data.success) return;
+
+          pdfDocumentsListDiv.innerHTML = "";
+          data.documents.forEach((doc) => {
+            const label = document.createElement("label");
+            label.style.display = "block";
+            const checkbox = document.createElement("input");
+            checkbox.type = "checkbox";
+            checkbox.value = doc.id;
+            checkbox.checked = doc.selected && doc.available;
+            checkbox.disabled = !doc.available;
+            label.appendChild(checkbox);
+            label.appendChild(
+              document.createTextNode(
+                ` ${doc.filename}${doc.available ? "" : " (expired, please upload again)"}`
+              )
+            );
+            pdfDocumentsListDiv.appendChild(label);
+          });
+          pdfDocumentsDiv.style.display = data.documents.length ? "block" : "none";
+
+          const selected = data.documents.filter((d) => d.selected && d.available);
+          if (showSelection && selected.length) {
+            showSelectedDocuments(
+              selected.map((d) => d.filename),
+              "Ask your questions about the selected PDFs."
+            );
+          }
+        } catch (error) {
+          console.error("[PDF_QA_Integrated] Error loading processed PDFs:", error);
+        }
+      }
+
+      if (usePdfDocumentsButton) {
+        usePdfDocumentsButton.addEventListener("click", async () => {
+          const documentIds = Array.from(
+            pdfDocumentsListDiv.querySelectorAll("input[type=checkbox]:checked")
+          ).map((checkbox) => parseInt(checkbox.value, 10));
+          if (!documentIds.length) {
+            pdfUploadStatusDiv.textContent = "Error: Select at least one PDF.";
+            pdfUploadStatusDiv.style.color = "red";
+            pdfUploadStatusDiv.style.display = "block";
+            return;
+          }
+          usePdfDocumentsButton.disabled = true;
+          try {
+            const response = await fetch("/select-pdf-documents", {
+              method: "POST",
+              headers: { "Content-Type": "application/json" },
+              body: JSON.stringify({ document_ids: documentIds }),
+            });
+            const data = await response.json();
+            if (response.ok && data.success) {
+              pdfUploadStatusDiv.style.display = "none";
+              showSelectedDocuments(
+                data.documents.map((d) => d.filename),
+                data.documents.length > 1
+                  ? "Ask your questions; answers draw on all selected PDFs."
+                  : "Ask your questions about this PDF."
+              );
+              pdfQaInput.focus();
+            } else {
+              pdfUploadStatusDiv.textContent = `Error: ${
+                data.error || "Could not select those PDFs."
+              }`;
+              pdfUploadStatusDiv.style.color = "red";
+              pdfUploadStatusDiv.style.display = "block";
+              loadPdfDocuments(false);
+            }
+          } catch (error) {
+            console.error("[PDF_QA_Integrated] Error selecting PDFs:", error);
+          } finally {
+            usePdfDocumentsButton.disabled = false;
+          }
+        });
+      }
+
+      loadPdfDocuments(true);
+
       processPdfButton.addEventListener("click", async () => {
         console.log("[PDF_QA_Integrated] Process PDF button clicked.");
         const file = pdfFileInput.files[0];
@@ -3062,7 +3216,32 @@ document.addEventListener("DOMContentLoaded", () => {
             "[PDF_QA_Integrated] Response status from /process-pdf-for-qa:",
             response.status
           );
-          const data = await response.json();
+          let data = await response.json();
+
+          if (response.ok && data.success && data.job_id) {
+            // Ingestion runs in the background; poll until the index is ready
+            const stageLabels = {
+              queued: "Waiting in queue",
+              starting: "Starting",
+              extracting: "Extracting text",
+              cleaning: "Removing headers and footers",
+              chunking: "Splitting text",
+              embedding: "Indexing",
+            };
+            while (data.success && data.status !== "done") {
+              const percent = Math.round((data.progress || 0) * 100);
+              pdfUploadStatusDiv.textContent = `${
+                stageLabels[data.stage || data.status] || "Processing"
+              } '${data.pdf_filename}'... ${percent}%`;
+              await new Promise((resolve) => setTimeout(resolve, 1500));
+              const statusResponse = await fetch(
+                data.status_url || `/pdf-qa-status/${data.job_id}`
+              );
+              const statusData = await statusResponse.json();
+              data = { ...data, ...statusData };
+              if (!statusResponse.ok) data.success = false;
+            }
+          }
           processPdfButton.disabled = false;
 
           if (response.ok && data.success) {
@@ -3073,6 +3252,7 @@ document.addEventListener("DOMContentLoaded", () => {
             pdfQaChatMessagesDiv.innerHTML =
               '<div class="pdf-qa-message ai">PDF processed! Ask your questions.</div>';
             pdfQaInput.focus();
+            loadPdfDocuments(false);
           } else {
             pdfUploadStatusDiv.textContent = `Error: ${
               data.error || "Failed to process PDF. Check server logs."
@@ -3121,7 +3301,20 @@ document.addEventListener("DOMContentLoaded", () => {
           const data = await response.json();
 
           if (response.ok) {
-            addPdfQaMessage(data.reply || "No reply received.", "ai");
+            let reply = data.reply || "No reply received.";
+            if (data.sources && data.sources.length > 1) {
+              // Answer drew on several selected PDFs: cite each one
+              reply += ` (Sources: ${data.sources
+                .map((source) =>
+                  source.pages.length
+                    ? `${source.filename} p. ${source.pages.join(", ")}`
+                    : source.filename
+                )
+                .join("; ")})`;
+            } else if (data.pages && data.pages.length) {
+              reply += ` (Source: page${data.pages.length > 1 ? "s" : ""} ${data.pages.join(", ")})`;
+            }
+            addPdfQaMessage(reply, "ai");
           } else {
             addPdfQaMessage(
               data.error || data.reply || "Error getting answer.",
@@ -0,0 +1,173 @@
+import copy
+import json
+import re
+from collections import namedtuple
+
+
+# --- Schema-driven validation of structured AI output, with partial salvage and repair ---
+# A schema is built once from the constructors below (text, number, boolean, array, obj, field); each returns a
+# compiled validator closure, so validating a response is a plain walk with no schema interpretation. Instead of
+# rejecting a whole response for one bad item, arrays can drop invalid items and fields can fall back to a value;
+# small, unambiguous slips (numbers sent as strings, "B) Paris" for "B") are repaired and reported.
+
+_FAIL = object() # field() default: an invalid value fails the enclosing object
+
+# value: the validated (and repaired) data; repaired/dropped: "path: what happened" notes, for logs and policies
+Salvaged = namedtuple('Salvaged', ['value', 'repaired', 'dropped'])
+
+
+class SchemaError(ValueError):
+    """A value that could not be validated or repaired; path locates it, e.g. "points_of_interest[2].lat"."""
+
+    def __init__(self, path, message):
+        super().__init__(f"{path or 'response'}: {message}")
+        self.path = path
+
+
+class _Report:
+    def __init__(self):
+        self.repaired = []
+        self.dropped = []
+
+
+def text(non_empty=True, choices=None, upper=False):
+    """A string, stripped (and upper-cased with upper=True). With choices, "B) Paris" or "B." repair to "B"."""
+    def validate(value, path, report):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            report.repaired.append(f"{path}: number {value!r} converted to text")
+            value = str(value)
+        if not isinstance(value, str):
+            raise SchemaError(path, "must be a string")
+        cleaned = value.strip().upper() if upper else value.strip()
+        if non_empty and not cleaned:
+            raise SchemaError(path, "must not be empty")
+        if choices is not None and cleaned not in choices:
+            match = re.match(r"^\(?(\w+)(?:[).:\s-]|$)", cleaned)
+            if not match or match.group(1) not in choices:
+                raise SchemaError(path, f"must be one of {', '.join(choices)} (got {value!r})")
+            report.repaired.append(f"{path}: {value!r} read as {match.group(1)!r}")
+            cleaned = match.group(1)
+        return cleaned
+    return validate
+
+
+def number(minimum=None, maximum=None, integer=False):
+    """A number within [minimum, maximum]; numeric strings are converted, and integer=True rounds floats."""
+    def validate(value, path, report):
+        if isinstance(value, str):
+            try:
+                converted = float(value.strip())
+            except ValueError:
+                raise SchemaError(path, f"must be a number (got {value!r})")
+            report.repaired.append(f"{path}: string {value!r} converted to a number")
+            value = converted
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value: # value != value: NaN
+            raise SchemaError(path, "must be a number")
+        if integer and not isinstance(value, int):
+            report.repaired.append(f"{path}: {value!r} rounded to an integer")
+            value = int(round(value))
+        if minimum is not None and value < minimum or maximum is not None and value > maximum:
+            raise SchemaError(path, f"{value} is outside [{minimum}, {maximum}]")
+        return value
+    return validate
+
+
+def boolean():
+    """A boolean; the strings "true" and "false" (any case) are converted."""
+    def validate(value, path, report):
+        if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+            report.repaired.append(f"{path}: string {value!r} converted to a boolean")
+            return value.strip().lower() == "true"
+        if not isinstance(value, bool):
+            raise SchemaError(path, "must be true or false")
+        return value
+    return validate
+
+
+def array(items, min_items=0, max_items=None, drop_invalid=False):
+    """
+    A list whose elements match items. With drop_invalid=True, invalid elements are dropped (and reported)
+    instead of failing the list; min_items then applies to what is left.
+    """
+    def validate(value, path, report):
+        if not isinstance(value, list):
+            raise SchemaError(path, "must be a list")
+        valid = []
+        for i, item in enumerate(value):
+            try:
+                valid.append(items(item, f"{path}[{i}]", report))
+            except SchemaError as e:
+                if not drop_invalid:
+                    raise
+                report.dropped.append(str(e))
+        if len(valid) < min_items:
+            raise SchemaError(path, f"needs at least {min_items} valid item(s), got {len(valid)}")
+        if max_items is not None and len(valid) > max_items:
+            raise SchemaError(path, f"allows at most {max_items} item(s), got {len(valid)}")
+        return valid
+    return validate
+
+
+def field(validator, nullable=False, on_error=_FAIL):
+    """
+    An object member. nullable=True accepts null. on_error (a value, or a callable returning one) replaces a
+    missing or invalid value instead of failing the object; the replacement is reported as a repair.
+    """
+    return validator, nullable, on_error
+
+
+def obj(fields, prepare=None, check=None):
+    """
+    An object with the given {name: field(...)} members (or bare validators, meaning required fields); other keys
+    are left out of the result. prepare(raw_dict) may rewrite the input first, e.g. to repair one field from
+    another; check(result) may raise ValueError for rules spanning several fields.
+    """
+    compiled = {name: spec if isinstance(spec, tuple) else field(spec) for name, spec in fields.items()}
+
+    def validate(value, path, report):
+        if not isinstance(value, dict):
+            raise SchemaError(path, "must be an object")
+        if prepare is not None:
+            value = prepare(dict(value))
+        result = {}
+        for name, (validator, nullable, on_error) in compiled.items():
+            member_path = f"{path}.{name}" if path else name
+            try:
+                if name not in value:
+                    raise SchemaError(member_path, "is missing")
+                if value[name] is None and nullable:
+                    result[name] = None
+                    continue
+                result[name] = validator(value[name], member_path, report)
+            except SchemaError as e:
+                if on_error is _FAIL:
+                    raise
+                result[name] = on_error() if callable(on_error) else copy.deepcopy(on_error)
+                report.repaired.append(f"{e} (replaced with {result[name]!r})")
+        if check is not None:
+            try:
+                check(result)
+            except ValueError as e:
+                raise SchemaError(path, str(e))
+        return result
+    return validate
+
+
+def strip_code_fence(json_text):
+    """Returns (json_text without surrounding whitespace and Markdown code fence, whether there was a fence)."""
+    stripped = json_text.strip()
+    fenced = re.match(r"^```(?:json)?\s*(.*?)\s*```$", stripped, re.DOTALL)
+    return (fenced.group(1), True) if fenced else (stripped, False)
+
+
+def salvage(schema, json_text):
+    """
+    Parses json_text (tolerating a Markdown code fence around it) and validates it against schema.
+    Returns Salvaged(value, repaired, dropped); raises json.JSONDecodeError or SchemaError if nothing is usable.
+    """
+    stripped, fenced = strip_code_fence(json_text)
+    report = _Report()
+    if fenced:
+        report.repaired.append("response: Markdown code fence removed")
+    value = schema(json.loads(stripped), "", report)
+    return Salvaged(value, report.repaired, report.dropped)
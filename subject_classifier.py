@@ -0,0 +1,103 @@
+import math
+import os
+from collections import Counter, namedtuple
+
+import numpy as np
+
+from bm25_index import tokenize
+
+
+# --- Local subject-relevance pre-classifier (nearest-centroid TF-IDF, NumPy) ---
+
+OTHER_LABEL = "other" # Training label for clearly non-academic text (sport, shopping, celebrities, ...)
+
+# verdict: "accept", "reject" or "ambiguous"; confidence: probability of that verdict (None if the subject is unknown);
+# best_label: most likely label; known_terms/total_terms: how much of the text the vocabulary covers
+SubjectDecision = namedtuple('SubjectDecision', ['verdict', 'confidence', 'best_label', 'known_terms', 'total_terms'])
+
+
+def _terms(text):
+    return [term for term in tokenize(text) if len(term) > 1]
+
+
+def load_corpora(directory):
+    """Reads <label>.txt files from directory into {label: [passages]}, one passage per non-empty line."""
+    corpora = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".txt"):
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                corpora[name[:-4]] = [line.strip() for line in f if line.strip()]
+    return corpora
+
+
+class SubjectClassifier:
+    """
+    Each label is represented by the normalised mean TF-IDF vector of its training passages. A text's label
+    probabilities are a softmax over its cosine similarity to each centroid, so scoring is one small
+    matrix-vector product and needs no network call.
+    """
+
+    def __init__(self, vocabulary, idf, centroids, labels, temperature=0.05):
+        self.vocabulary = vocabulary # term -> column
+        self.idf = idf
+        self.centroids = centroids # (len(labels), len(vocabulary)), rows L2-normalised
+        self.labels = labels
+        self.temperature = temperature
+
+    @classmethod
+    def train(cls, corpora, temperature=0.05):
+        """Trains on {label: [passages]}; every passage counts as one document for IDF."""
+        labels = sorted(corpora)
+        passages = [(label, Counter(_terms(text))) for label in labels for text in corpora[label]]
+        document_frequency = Counter(term for _, counts in passages for term in counts)
+        vocabulary = {term: i for i, term in enumerate(sorted(document_frequency))}
+        idf = np.array(
+            [math.log((1 + len(passages)) / (1 + document_frequency[term])) + 1 for term in sorted(document_frequency)],
+            dtype=np.float32,
+        )
+        centroids = np.zeros((len(labels), len(vocabulary)), dtype=np.float32)
+        for label, counts in passages:
+            vector = cls._weights(counts, vocabulary, idf)
+            centroids[labels.index(label)] += vector / max(np.linalg.norm(vector), 1e-12)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        return cls(vocabulary, idf, centroids, labels, temperature)
+
+    @staticmethod
+    def _weights(counts, vocabulary, idf):
+        vector = np.zeros(len(vocabulary), dtype=np.float32)
+        for term, count in counts.items():
+            column = vocabulary.get(term)
+            if column is not None:
+                vector[column] = (1 + math.log(count)) * idf[column]
+        return vector
+
+    def probabilities(self, text):
+        """Returns ({label: probability}, known terms, total terms) for text."""
+        terms = _terms(text)
+        vector = self._weights(Counter(terms), self.vocabulary, self.idf)
+        known = sum(1 for term in terms if term in self.vocabulary)
+        similarities = self.centroids @ (vector / max(np.linalg.norm(vector), 1e-12))
+        logits = similarities / self.temperature
+        exp = np.exp(logits - logits.max())
+        return dict(zip(self.labels, (exp / exp.sum()).tolist())), known, len(terms)
+
+    def classify(self, text, subject, accept_at=0.8, reject_at=0.8, min_known_terms=2):
+        """
+        Decides whether text is about subject: "reject" only when the text is confidently non-academic (most
+        likely OTHER_LABEL with at least reject_at), "accept" when confidently about subject, otherwise
+        "ambiguous" (left to the model). Text that looks like a different academic subject is ambiguous, since
+        cross-disciplinary topics (the thermodynamics of a reaction) are often on-subject. Texts with fewer than
+        min_known_terms known terms are always ambiguous.
+        """
+        probabilities, known, total = self.probabilities(text)
+        best_label = max(probabilities, key=probabilities.get)
+        if subject not in probabilities or subject == OTHER_LABEL:
+            return SubjectDecision("ambiguous", None, best_label, known, total)
+        p_subject = probabilities[subject]
+        if known >= min_known_terms:
+            if p_subject >= accept_at:
+                return SubjectDecision("accept", p_subject, best_label, known, total)
+            p_other = probabilities.get(OTHER_LABEL, 0.0)
+            if best_label == OTHER_LABEL and p_other >= reject_at:
+                return SubjectDecision("reject", p_other, best_label, known, total)
+        return SubjectDecision("ambiguous", max(p_subject, 1 - p_subject), best_label, known, total)
@@ -0,0 +1,106 @@
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+
+# --- Hierarchical (map-reduce) summarization for long documents ---
+
+SINGLE_PASS_PROMPT = "Summarize the following text concisely for a secondary school student. Focus on the main points and key information:\n\n---\n{text}\n---"
+
+# No section numbers in the map prompt: the prompt (and so its cache key) depends only on the chunk
+# content, which lets the same chapter hit the cache even when it is uploaded as part of another file.
+MAP_PROMPT = """
+Summarize the following section of a longer document for a secondary school student.
+Keep the main points, key facts, definitions, names and dates. Be concise and do not add an introduction.
+
+---
+{text}
+---
+"""
+
+REDUCE_PROMPT = """
+The following are summaries of consecutive sections of one document, in order.
+Combine them into a single concise summary for a secondary school student.
+Focus on the main points and key information, remove repetition, and keep the original order of ideas.
+
+---
+{text}
+---
+"""
+
+CHARS_PER_TOKEN = 4 # Rough average for English text with Gemini's tokenizer
+
+
+def estimate_tokens(text):
+    """Cheap local token estimate (no API call), good enough for sizing prompts."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def split_into_chunks(text, max_tokens):
+    """
+    Splits text into chunks of at most max_tokens (estimated), preferring paragraph,
+    then line, then sentence boundaries, and only hard-cutting as a last resort.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks = []
+    current = ""
+
+    def pieces(block, separators):
+        if len(block) <= max_chars:
+            return [block]
+        if not separators:
+            return [block[i:i + max_chars] for i in range(0, len(block), max_chars)]
+        parts = re.split(separators[0], block)
+        out = []
+        for part in parts:
+            out.extend(pieces(part, separators[1:]))
+        return out
+
+    for piece in pieces(text, [r"\n\s*\n", r"\n", r"(?<=[.!?])\s+"]):
+        piece = piece.strip()
+        if not piece:
+            continue
+        if current and len(current) + len(piece) + 2 > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class MapReduceSummarizer:
+    """
+    Builds the final summary prompt for a document of any size.
+    Short text is summarized in one pass; long text is split into token-bounded chunks that are
+    summarized concurrently (each through the gateway, so repeats are cache hits), and the partial
+    summaries are reduced - recursively if they are still too long - into one final prompt.
+    """
+
+    def __init__(self, gateway, single_pass_tokens=12000, chunk_tokens=6000, max_workers=4):
+        self.gateway = gateway
+        self.single_pass_tokens = single_pass_tokens
+        self.chunk_tokens = chunk_tokens
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary-map")
+
+    def build_prompt(self, text):
+        """Returns the prompt whose completion is the summary of text (running the map phase if needed)."""
+        level = 0
+        while estimate_tokens(text) > self.single_pass_tokens:
+            level += 1
+            chunks = split_into_chunks(text, self.chunk_tokens)
+            logging.info(f"[SUMMARY_MAP] Level {level}: summarizing {len(chunks)} chunks concurrently.")
+            partials = list(self._pool.map(self._summarize_chunk, chunks))
+            text = "\n\n".join(p.strip() for p in partials if p.strip())
+            if not text:
+                raise ValueError("Could not summarize any section of the document.")
+            if len(chunks) == 1:
+                break # A single chunk that is still too long cannot shrink further by splitting
+        return (REDUCE_PROMPT if level else SINGLE_PASS_PROMPT).format(text=text)
+
+    def _summarize_chunk(self, chunk):
+        result = self.gateway.generate('summary_chunk', MAP_PROMPT.format(text=chunk))
+        if not result.text.strip():
+            logging.warning(f"[SUMMARY_MAP] Empty summary for a chunk (block reason: {result.block_reason}).")
+        return result.text
@@ -0,0 +1,44 @@
+from bm25_index import BM25Index, reciprocal_rank_fusion, tokenize
+
+TEXTS = [
+    "Ohm's law relates voltage, current and resistance in a circuit.",
+    "Sulfuric acid (h2so4) is a strong acid used in batteries.",
+    "The voltages across resistors in series add up to the supply voltage.",
+    "Photosynthesis takes place in the chloroplasts of plant cells.",
+]
+
+
+def test_tokenize_drops_stopwords_folds_plurals_and_keeps_compounds():
+    assert tokenize("What are the voltages of X-ray tubes in 1857?") == ["voltage", "x-ray", "tube", "1857"]
+    assert tokenize("h2so4 and 3.14") == ["h2so4", "3.14"]
+    assert tokenize("glass gas") == ["glass", "gas"]
+
+
+def test_search_ranks_matching_chunks_with_coverage():
+    index = BM25Index.build(TEXTS)
+    hits = index.search("voltage across resistors", k=2)
+    assert [doc_id for doc_id, _, _ in hits] == [2, 0]
+    assert hits[0][1] > hits[1][1]
+    assert hits[0][2] == 1.0
+    assert 0 < hits[1][2] < 1
+    assert index.search("h2so4")[0][0] == 1
+
+
+def test_search_without_informative_terms_returns_nothing():
+    index = BM25Index.build(TEXTS)
+    assert index.search("what is the") == []
+    assert index.search("quasar") == []
+    assert BM25Index.build([]).search("voltage") == []
+
+
+def test_save_and_load_round_trip(tmp_path):
+    index = BM25Index.build(TEXTS, k1=1.2, b=0.5)
+    index.save(str(tmp_path))
+    loaded = BM25Index.load(str(tmp_path))
+    assert (loaded.k1, loaded.b, loaded.num_docs) == (1.2, 0.5, len(TEXTS))
+    assert loaded.search("chloroplasts plant") == index.search("chloroplasts plant")
+
+
+def test_reciprocal_rank_fusion_prefers_items_ranked_well_in_both_lists():
+    assert reciprocal_rank_fusion([["a", "b", "c"], ["b", "c", "a"]]) == ["b", "a", "c"]
+    assert reciprocal_rank_fusion([]) == []
@@ -0,0 +1,53 @@
+from collections import namedtuple
+
+from chunker import chunk_pages, count_tokens, is_heading, pack_to_budget
+
+Doc = namedtuple('Doc', ['page_content'])
+
+
+def sentences(n, prefix="Sentence"):
+    return " ".join(f"{prefix} number {i} explains one more idea about the topic." for i in range(n))
+
+
+def test_count_tokens_counts_words_punctuation_and_long_words():
+    assert count_tokens("") == 0
+    assert count_tokens("Hello, world.") == 4
+    assert count_tokens("electromagnetism") == 1 + (16 - 6) // 4
+
+
+def test_is_heading():
+    assert is_heading("Chapter 3 Forces")
+    assert is_heading("2.1 Newton's Laws")
+    assert is_heading("THERMODYNAMICS")
+    assert is_heading("The Structure of Atoms")
+    assert not is_heading("The structure of atoms is explained below.")
+    assert not is_heading("")
+
+
+def test_chunks_stay_near_target_and_overlap():
+    chunks = chunk_pages([sentences(60)], target_tokens=100, overlap_tokens=30)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk.text) <= 100 + 30 for chunk in chunks)
+    for previous, current in zip(chunks, chunks[1:]):
+        last_sentence = previous.text.split(". ")[-1]
+        assert last_sentence in current.text
+
+
+def test_headings_start_chunks_and_pages_are_tracked():
+    pages = [
+        "Chapter 1 Motion\n\n" + sentences(10, "Motion"),
+        sentences(10, "Motion") + "\n\nChapter 2 Energy\n\n" + sentences(10, "Energy"),
+    ]
+    chunks = chunk_pages(pages, first_page=5, target_tokens=400, overlap_tokens=50, min_tokens=20)
+    assert [chunk.heading for chunk in chunks] == ["Chapter 1 Motion", "Chapter 2 Energy"]
+    assert (chunks[0].page_start, chunks[0].page_end) == (5, 6)
+    assert (chunks[1].page_start, chunks[1].page_end) == (6, 6)
+    assert "Motion number" not in chunks[1].text # No overlap across a section boundary
+
+
+def test_pack_to_budget_keeps_relevance_order_and_minimum():
+    docs = [Doc("one two three"), Doc("four five"), Doc("six seven eight nine")]
+    assert pack_to_budget(docs, token_budget=5) == docs[:2]
+    assert pack_to_budget(docs, token_budget=1) == docs[:1]
+    assert pack_to_budget(docs, token_budget=1, min_documents=2) == docs[:2]
+    assert pack_to_budget(docs, token_budget=100) == docs
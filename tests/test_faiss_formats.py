@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+from faiss_formats import (
+    IncompatibleIndex, build_faiss_index, build_vector_store, choose_index_type, factory_string, open_vector_store,
+    read_index_meta, save_vector_store,
+)
+
+
+@pytest.mark.parametrize("num_vectors, expected", [(10, "flat"), (5000, "sq8"), (50000, "ivf_pq")])
+def test_auto_index_type_grows_with_the_document(num_vectors, expected):
+    assert choose_index_type(num_vectors) == expected
+
+
+@pytest.mark.parametrize("requested", ["ivf_pq", "ivf_sq8"])
+def test_explicit_ivf_type_falls_back_on_small_documents(requested):
+    assert choose_index_type(10, requested) == "flat"
+    assert choose_index_type(5000, requested) == "sq8"
+    assert choose_index_type(50000, requested) == requested
+
+
+def test_unknown_index_type_is_rejected():
+    with pytest.raises(ValueError):
+        choose_index_type(10, "hnsw")
+
+
+@pytest.mark.parametrize("requested", ["flat", "sq8", "ivf_sq8", "ivf_pq"])
+def test_small_document_builds_with_any_requested_type(requested):
+    vectors = np.random.default_rng(0).normal(size=(10, 64)).astype("float32")
+    index = build_faiss_index(vectors, choose_index_type(len(vectors), requested))
+    assert index.ntotal == 10
+
+
+def test_pq_sub_quantizers_divide_the_dimension():
+    description = factory_string("ivf_pq", 50000, 768)
+    m = int(description.split("PQ")[1].split("x")[0])
+    assert 768 % m == 0
+
+
+class _Embeddings:
+    model_name = "test-model"
+
+    def embed_documents(self, texts):
+        return [[float(len(t)), 1.0, 0.0, 0.0] for t in texts]
+
+    def embed_query(self, text):
+        return [float(len(text)), 1.0, 0.0, 0.0]
+
+
+@pytest.fixture
+def saved_index(tmp_path):
+    pytest.importorskip("langchain_community")
+    texts = ["alpha", "beta gamma", "delta epsilon zeta"]
+    embeddings = _Embeddings()
+    store = build_vector_store(texts, embeddings.embed_documents(texts), embeddings, "flat", [{"page_start": i} for i in range(3)])
+    path = str(tmp_path / "index")
+    save_vector_store(store, path, "flat", embeddings.model_name)
+    return path
+
+
+def test_metadata_records_model_and_dimension(saved_index):
+    meta = read_index_meta(saved_index)
+    assert meta["model_name"] == "test-model"
+    assert meta["dim"] == 4 and meta["num_vectors"] == 3
+
+
+def test_open_checks_the_embedding_model(saved_index):
+    store = open_vector_store(saved_index, _Embeddings(), mmap=False, model_name="test-model")
+    assert store.index.ntotal == 3
+    with pytest.raises(IncompatibleIndex):
+        open_vector_store(saved_index, _Embeddings(), mmap=False, model_name="another-model")
+
+
+def test_index_without_metadata_defaults_to_flat(tmp_path):
+    assert read_index_meta(str(tmp_path)) == {"index_type": "flat"}
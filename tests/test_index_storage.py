@@ -0,0 +1,45 @@
+import os
+import threading
+
+import pytest
+
+from index_storage import DirectoryIndexStorage, IndexNotFound, NodeIndexCache
+
+
+class CountingStorage(DirectoryIndexStorage):
+    def __init__(self, root):
+        super().__init__(root)
+        self.downloads = 0
+
+    def download(self, index_id, local_dir):
+        self.downloads += 1
+        super().download(index_id, local_dir)
+
+
+def publish(storage, tmp_path, index_id):
+    source = tmp_path / "build" / index_id
+    source.mkdir(parents=True)
+    (source / "index.faiss").write_bytes(b"vectors")
+    storage.upload(str(source), index_id)
+
+
+def test_concurrent_fetches_download_once(tmp_path):
+    storage = CountingStorage(str(tmp_path / "shared"))
+    publish(storage, tmp_path, "shared/abc.v3.model")
+    cache = NodeIndexCache(str(tmp_path / "node"), storage, fetch_lock_stripes=4)
+    threads = [threading.Thread(target=cache.fetch, args=("shared/abc.v3.model",)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert storage.downloads == 1
+    assert os.path.isfile(os.path.join(cache.local_path("shared/abc.v3.model"), "index.faiss"))
+    assert len(cache._fetch_locks) == 4
+
+
+def test_missing_index_raises(tmp_path):
+    cache = NodeIndexCache(str(tmp_path / "node"), DirectoryIndexStorage(str(tmp_path / "shared")))
+    with pytest.raises(IndexNotFound):
+        cache.fetch("shared/missing")
+    with pytest.raises(IndexNotFound):
+        NodeIndexCache(str(tmp_path / "local")).fetch("shared/missing")
@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from ingest_jobs import JobQueue, JobWorkerPool
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.db"), stale_after=60, max_attempts=2)
+
+
+def orphan(queue, job_id):
+    """Makes a running job look as if its worker died long ago."""
+    with queue._connect() as conn:
+        conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time() - 3600, job_id))
+
+
+def test_claims_oldest_queued_job_once(queue):
+    first = queue.enqueue("pdf_qa", {"n": 1})
+    queue.enqueue("pdf_qa", {"n": 2})
+    job = queue.claim()
+    assert job["id"] == first and job["payload"] == {"n": 1}
+    assert queue.get(first)["status"] == "running"
+    assert queue.get(first)["attempts"] == 1
+    assert queue.claim()["payload"] == {"n": 2}
+    assert queue.claim() is None
+
+
+def test_running_job_is_not_reclaimed_until_stale(queue):
+    job_id = queue.enqueue("pdf_qa", {})
+    queue.claim()
+    assert queue.claim() is None
+    orphan(queue, job_id)
+    job = queue.claim()
+    assert job["id"] == job_id
+    assert queue.get(job_id)["attempts"] == 2
+
+
+def test_orphaned_job_fails_after_max_attempts(queue):
+    job_id = queue.enqueue("pdf_qa", {})
+    for _ in range(2):
+        assert queue.claim()["id"] == job_id
+        orphan(queue, job_id)
+    next_id = queue.enqueue("pdf_qa", {"n": 2})
+    assert queue.claim()["id"] == next_id
+    job = queue.get(job_id)
+    assert job["status"] == "failed"
+    assert "2 attempts" in job["error"]
+
+
+def test_worker_pool_records_results_and_errors(queue):
+    done = threading.Event()
+
+    def handler(payload, report):
+        report("working", 0.5)
+        if payload.get("fail"):
+            raise ValueError("bad input")
+        done.set()
+        return {"ok": True}
+
+    bad = queue.enqueue("pdf_qa", {"fail": True})
+    good = queue.enqueue("pdf_qa", {})
+    pool = JobWorkerPool(queue, {"pdf_qa": handler}, num_threads=1, poll_interval=0.05)
+    pool.start()
+    pool.start()
+    assert len(pool._threads) == 1
+    assert done.wait(5)
+    deadline = time.time() + 5
+    while queue.get(good)["status"] != "done" and time.time() < deadline:
+        time.sleep(0.02)
+    assert queue.get(good)["result"] == {"ok": True}
+    assert queue.get(bad)["status"] == "failed"
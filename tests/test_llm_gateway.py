@@ -0,0 +1,35 @@
+import pytest
+
+from llm_gateway import GatewayBusyError, LLMGateway
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.parts = [self]
+        self.text = text
+
+
+class _Response(list):
+    prompt_feedback = None
+
+    @property
+    def parts(self):
+        return [_Chunk("".join(chunk.text for chunk in self))]
+
+
+class _FakeModel:
+    def generate_content(self, prompt, generation_config=None, stream=False, request_options=None):
+        return _Response([_Chunk("Hello "), _Chunk("world")])
+
+
+def test_stalled_streams_do_not_block_non_streamed_calls():
+    gateway = LLMGateway(_FakeModel(), "fake-model", default_deadline=0.2, max_concurrency=1, max_streams=1)
+    stalled = gateway.stream("chat", "prompt")
+    assert next(stalled) == "Hello " # The client stops reading here and keeps the stream open
+
+    assert gateway.generate("chat", "prompt").text == "Hello world"
+    with pytest.raises(GatewayBusyError):
+        next(gateway.stream("chat", "another prompt"))
+
+    stalled.close() # Releases the streaming slot
+    assert "".join(gateway.stream("chat", "another prompt")) == "Hello world"
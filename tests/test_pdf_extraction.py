@@ -0,0 +1,102 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import pdf_extraction
+from pdf_extraction import PdfExtractionError, _budgeted_extract_page_range, decode_text_bytes
+
+
+class _SlowPage:
+    def __init__(self, cpu_seconds):
+        self.cpu_seconds = cpu_seconds
+
+    def extract_text(self):
+        started = time.process_time()
+        while time.process_time() - started < self.cpu_seconds:
+            pass
+        return "x"
+
+
+class _FakeReader:
+    def __init__(self, pages):
+        self.pages = pages
+
+
+@pytest.mark.skipif(not pdf_extraction._HAS_CPU_TIMER, reason="no SIGPROF CPU timer on this platform")
+def test_cpu_budget_stops_the_whole_range(monkeypatch):
+    monkeypatch.setattr(pdf_extraction, "_open_reader", lambda data: _FakeReader([_SlowPage(0.4) for _ in range(5)]))
+    started = time.process_time()
+    with pytest.raises(PdfExtractionError, match="CPU budget"):
+        _budgeted_extract_page_range(b"", 0, 5, 1)
+    assert time.process_time() - started < 1.5 # Not 2s: the pages after the one interrupted are not extracted
+
+
+def test_failing_page_is_skipped(monkeypatch):
+    class BrokenPage:
+        def extract_text(self):
+            raise ValueError("bad content stream")
+
+    monkeypatch.setattr(pdf_extraction, "_open_reader", lambda data: _FakeReader([_SlowPage(0), BrokenPage(), _SlowPage(0)]))
+    assert _budgeted_extract_page_range(b"", 0, 3, 5) == ["x", "", "x"]
+
+
+def test_decode_text_bytes_falls_back_to_latin1():
+    assert decode_text_bytes("café".encode("utf-8")) == "café"
+    assert decode_text_bytes("café".encode("latin-1")) == "café"
+
+
+class _SleepyPage:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def extract_text(self):
+        time.sleep(self.seconds)
+        return "page"
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="fake readers reach the workers by fork")
+def test_timeout_stops_only_its_own_document(monkeypatch):
+    def open_reader(data):
+        return _FakeReader([_SleepyPage(30 if data == b"stuck" else 0.5) for _ in range(3)])
+
+    monkeypatch.setattr(pdf_extraction, "_open_reader", open_reader)
+    monkeypatch.setattr(pdf_extraction, "_worker_slots", threading.BoundedSemaphore(2))
+    monkeypatch.setattr(pdf_extraction, "WALL_SECONDS_PER_DOCUMENT", 0.5)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        stuck = executor.submit(pdf_extraction.extract_pdf_text, b"stuck", "stuck.pdf")
+        time.sleep(0.1)
+        monkeypatch.setattr(pdf_extraction, "WALL_SECONDS_PER_DOCUMENT", 10)
+        healthy = executor.submit(pdf_extraction.extract_pdf_text, b"healthy", "healthy.pdf")
+        with pytest.raises(PdfExtractionError, match="took longer"):
+            stuck.result()
+        assert healthy.result().text == "page\npage\npage" # Still running when the stuck document was stopped
+    assert pdf_extraction._worker_slots.acquire(blocking=False) and pdf_extraction._worker_slots.acquire(blocking=False)
+
+
+def test_batches_share_the_document_cpu_budget(monkeypatch):
+    budgets = []
+
+    class InlineWorkers:
+        def __init__(self, deadline):
+            self.pool = ThreadPoolExecutor(max_workers=1)
+
+        def grow(self, wanted):
+            pass
+
+        def close(self, terminate=False):
+            self.pool.shutdown()
+
+    def extract(data, start, stop, cpu_seconds):
+        budgets.append(cpu_seconds)
+        return ["p"] * (stop - start)
+
+    monkeypatch.setattr(pdf_extraction, "_DocumentWorkers", InlineWorkers)
+    monkeypatch.setattr(pdf_extraction, "_budgeted_count_pages", lambda data, cpu_seconds: (1000, 0.0))
+    monkeypatch.setattr(pdf_extraction, "_budgeted_extract_page_range", extract)
+    extracted = pdf_extraction.extract_pdf_text(b"big", "big.pdf")
+    assert extracted.page_count == pdf_extraction.MAX_PAGES
+    assert len(budgets) > 1
+    assert sum(budgets) <= pdf_extraction.CPU_SECONDS_PER_DOCUMENT + 1e-9
@@ -0,0 +1,54 @@
+import random
+from collections import namedtuple
+
+from question_bank import clean_question, pick_least_served, question_key, topic_fingerprint, unique_questions
+
+Banked = namedtuple('Banked', ['question_key', 'times_served'])
+
+
+def q(text):
+    return {"question": text, "options": ["a", "b", "c", "d"], "correct_answer": "A"}
+
+
+def test_topic_fingerprint_ignores_case_order_stopwords_and_plurals():
+    assert topic_fingerprint("Newton's laws of motion") == topic_fingerprint("laws of motion (Newton)")
+    assert topic_fingerprint("The Laws of Motion") == topic_fingerprint("law motion")
+    assert topic_fingerprint("laws of motion") != topic_fingerprint("laws of thermodynamics")
+
+
+def test_question_key_ignores_case_punctuation_and_spacing():
+    assert question_key("What is  the SI unit of force?") == question_key("what is the si unit of force")
+    assert question_key("What is force?") != question_key("What is mass?")
+
+
+def test_clean_question_strips_and_upper_cases():
+    raw = {"question": " Q? ", "options": [" a ", "b"], "correct_answer": " c ", "extra": 1}
+    assert clean_question(raw) == {"question": "Q?", "options": ["a", "b"], "correct_answer": "C"}
+
+
+def test_unique_questions_drops_repeats_and_rephrasings_in_order():
+    questions = [
+        q("What is the SI unit of force?"),
+        q("What is the SI unit of force"),
+        q("Which SI unit of force is used?"),
+        q("What does Newton's first law state?"),
+        q("Define kinetic energy."),
+    ]
+    kept = unique_questions(questions, existing=["Define kinetic energy"])
+    assert [x["question"] for x in kept] == [
+        "What is the SI unit of force?", "Which SI unit of force is used?", "What does Newton's first law state?",
+    ]
+    assert unique_questions(questions[:1] + [q("SI unit of force: what is it?")])[1:] == []
+
+
+def test_pick_least_served_prefers_unserved_and_skips_excluded():
+    candidates = [Banked("a", 3), Banked("b", 0), Banked("c", 1), Banked("d", 0)]
+    picked = pick_least_served(candidates, 3, exclude_keys={"d"}, rng=random.Random(0))
+    assert [c.question_key for c in picked] == ["b", "c", "a"]
+    assert pick_least_served(candidates, 10, exclude_keys={"a", "b", "c", "d"}) == []
+
+
+def test_pick_least_served_shuffles_ties():
+    candidates = [Banked(key, 0) for key in "abcdefgh"]
+    orders = {tuple(c.question_key for c in pick_least_served(candidates, 8, rng=random.Random(seed))) for seed in range(5)}
+    assert len(orders) > 1
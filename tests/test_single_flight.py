@@ -0,0 +1,50 @@
+import os
+import threading
+import time
+
+import pytest
+
+import single_flight
+from single_flight import SingleFlight
+
+pytestmark = pytest.mark.skipif(single_flight.fcntl is None, reason="cross-worker locking needs fcntl")
+
+
+def test_workers_share_one_call_per_key(tmp_path):
+    # Two instances on one state directory behave like two worker processes on one host
+    first, second = SingleFlight(str(tmp_path), wait_timeout=5), SingleFlight(str(tmp_path), wait_timeout=5)
+    release, calls = threading.Event(), []
+
+    def slow():
+        calls.append("slow")
+        release.wait(5)
+        return {"answer": 42}
+
+    leader = threading.Thread(target=first.do, args=("key", slow))
+    leader.start()
+    while not calls:
+        time.sleep(0.01)
+    threading.Timer(0.2, release.set).start()
+    assert second.do("key", lambda: calls.append("again") or {"answer": 0}) == ({"answer": 42}, True)
+    leader.join()
+    assert calls == ["slow"]
+    assert os.listdir(first.lock_dir) == []
+
+
+def test_unrelated_keys_do_not_wait_for_each_other(tmp_path):
+    first, second = SingleFlight(str(tmp_path), wait_timeout=5), SingleFlight(str(tmp_path), wait_timeout=5)
+    release, started = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    leader = threading.Thread(target=first.do, args=("key-a", slow))
+    leader.start()
+    started.wait(5)
+    began = time.monotonic()
+    assert second.do("key-b", lambda: "fast") == ("fast", False)
+    assert time.monotonic() - began < 1
+    release.set()
+    leader.join()
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from structured_output import SchemaError, array, boolean, field, number, obj, salvage, strip_code_fence, text
+
+QUESTION = obj({
+    "question": text(),
+    "answer": text(choices=("A", "B", "C", "D"), upper=True),
+    "points": field(number(minimum=0, integer=True), on_error=1),
+    "hint": field(text(), nullable=True, on_error=None),
+})
+QUIZ = array(QUESTION, min_items=1, drop_invalid=True)
+
+
+def test_strip_code_fence():
+    assert strip_code_fence('  ```json\n{"a": 1}\n```  ') == ('{"a": 1}', True)
+    assert strip_code_fence('```\n[]\n```') == ("[]", True)
+    assert strip_code_fence(' {"a": 1} ') == ('{"a": 1}', False)
+
+
+def test_valid_input_passes_unchanged():
+    data = [{"question": "Q?", "answer": "B", "points": 2, "hint": None}]
+    result = salvage(QUIZ, json.dumps(data))
+    assert result.value == data
+    assert result.repaired == [] and result.dropped == []
+
+
+def test_repairs_small_slips_and_reports_them():
+    data = [{"question": " Q? ", "answer": "b) Paris", "points": "2.4", "extra": 1}]
+    result = salvage(QUIZ, "```json\n" + json.dumps(data) + "\n```")
+    assert result.value == [{"question": "Q?", "answer": "B", "points": 2, "hint": None}]
+    assert any("code fence" in note for note in result.repaired)
+    assert any("answer" in note for note in result.repaired)
+    assert any("hint" in note for note in result.repaired)
+
+
+def test_drops_invalid_items_but_keeps_the_rest():
+    data = [{"question": "", "answer": "A"}, {"question": "Q?", "answer": "E"}, {"question": "Ok?", "answer": "C"}]
+    result = salvage(QUIZ, json.dumps(data))
+    assert [q["question"] for q in result.value] == ["Ok?"]
+    assert len(result.dropped) == 2
+    assert result.dropped[0].startswith("[0].question")
+
+
+def test_fails_when_nothing_is_usable():
+    with pytest.raises(SchemaError):
+        salvage(QUIZ, json.dumps([{"question": "Q?"}]))
+    with pytest.raises(json.JSONDecodeError):
+        salvage(QUIZ, "not json")
+
+
+def test_number_and_boolean_validation():
+    schema = obj({"n": number(minimum=0, maximum=10), "flag": boolean()})
+    assert salvage(schema, '{"n": "3", "flag": "TRUE"}').value == {"n": 3.0, "flag": True}
+    with pytest.raises(SchemaError, match=r"n: 11 is outside"):
+        salvage(schema, '{"n": 11, "flag": false}')
+    with pytest.raises(SchemaError, match="flag"):
+        salvage(schema, '{"n": 1, "flag": "yes"}')
+
+
+def test_check_failures_are_schema_errors():
+    def ordered(result):
+        if result["low"] > result["high"]:
+            raise ValueError("low must not exceed high")
+
+    schema = obj({"low": number(), "high": number()}, check=ordered)
+    assert salvage(schema, '{"low": 1, "high": 2}').value == {"low": 1, "high": 2}
+    with pytest.raises(SchemaError, match="low must not exceed high"):
+        salvage(schema, '{"low": 3, "high": 2}')
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from subject_classifier import OTHER_LABEL, SubjectClassifier, load_corpora
+
+CORPORA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "subject_corpora")
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    return SubjectClassifier.train(load_corpora(CORPORA_DIR))
+
+
+@pytest.mark.parametrize("subject, text", [
+    ("physics", "Newton's laws of motion and force"),
+    ("history", "the French revolution and Napoleon"),
+    ("biology", "the cell membrane and mitochondria"),
+])
+def test_accepts_on_subject_text(classifier, subject, text):
+    assert classifier.classify(text, subject).verdict == "accept"
+
+
+@pytest.mark.parametrize("subject, text", [
+    ("physics", "Thermodynamics of chemical reactions and enthalpy"),
+    ("chemistry", "Photosynthesis converts carbon dioxide and water into glucose"),
+    ("biology", "The chemistry of enzymes and reaction rates"),
+    ("geography", "The industrial revolution and the growth of cities"),
+])
+def test_cross_disciplinary_text_is_never_rejected(classifier, subject, text):
+    assert classifier.classify(text, subject).verdict != "reject"
+
+
+@pytest.mark.parametrize("subject, text", [
+    ("physics", "Football match scores and transfer news"),
+    ("history", "Celebrity fashion and shopping deals this weekend"),
+])
+def test_rejects_non_academic_text(classifier, subject, text):
+    decision = classifier.classify(text, subject)
+    assert decision.verdict == "reject"
+    assert decision.best_label == OTHER_LABEL
+
+
+def test_too_few_known_terms_is_ambiguous(classifier):
+    assert classifier.classify("zxqv blorft", "physics").verdict == "ambiguous"
+
+
+def test_unknown_subject_is_ambiguous(classifier):
+    decision = classifier.classify("Newton's laws of motion", "general topics")
+    assert decision.verdict == "ambiguous" and decision.confidence is None
+
+
+def test_probabilities_sum_to_one(classifier):
+    probabilities, known, total = classifier.probabilities("Atoms, ions and covalent bonds")
+    assert sum(probabilities.values()) == pytest.approx(1.0)
+    assert 0 < known <= total
@@ -0,0 +1,32 @@
+import pytest
+
+from text_cleanup import _PAGE_NUMBER_RE, drop_near_duplicates, strip_repeated_lines
+
+
+@pytest.mark.parametrize("line", ["12", "Page 3", "page 3 of 10", "PAGE 4 OF 9", "3/10", "xiv", "Page vii", "iv"])
+def test_page_numbers_match(line):
+    assert _PAGE_NUMBER_RE.match(line)
+
+
+@pytest.mark.parametrize("line", ["civil", "ill", "Cl", "VII", "XL", "page", "iiii", "vx", "Chapter 3"])
+def test_words_and_upper_case_numerals_are_not_page_numbers(line):
+    assert not _PAGE_NUMBER_RE.match(line)
+
+
+def test_strips_running_headers_and_page_numbers_only():
+    pages = [f"Intro to Physics - Chapter 1\nbody text {i} about motion\nmore body text\n{i + 1}" for i in range(4)]
+    pages.append("Intro to Physics - Chapter 1\nThe Civil War\nill\nVII")
+    cleaned, removed = strip_repeated_lines(pages)
+    assert all("Intro to Physics" not in page for page in cleaned)
+    assert cleaned[0] == "body text 0 about motion\nmore body text"
+    assert cleaned[-1] == "The Civil War\nill\nVII"
+    assert removed == 9
+
+
+def test_drops_near_duplicate_chunks():
+    base = "the mitochondria is the powerhouse of the cell and produces energy through cellular respiration " * 3
+    chunks = [base, base + "extra", "photosynthesis converts light energy into chemical energy in chloroplasts"]
+    kept, indexes, dropped = drop_near_duplicates(chunks)
+    assert indexes == [0, 2]
+    assert kept == [chunks[0], chunks[2]]
+    assert dropped == 1
@@ -0,0 +1,38 @@
+import os
+import shutil
+
+import pytest
+
+from vector_store_cache import IndexMissing, VectorStoreCache
+
+
+def make_index(root, name, size):
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "index.faiss"), "wb") as f:
+        f.write(b"x" * size)
+    return path
+
+
+def test_loads_once_and_evicts_least_recently_used(tmp_path):
+    loads = []
+    cache = VectorStoreCache(lambda path: loads.append(path) or os.path.basename(path), max_bytes=250, load_lock_stripes=4)
+    a, b, c = (make_index(str(tmp_path), name, 100) for name in "abc")
+    assert cache.get(a) == "a" and cache.get(a) == "a"
+    cache.get(b)
+    cache.get(a) # b is now the least recently used
+    cache.get(c)
+    cache.get(a)
+    cache.get(b)
+    assert loads == [a, b, c, b]
+    assert len(cache._load_locks) == 4
+
+
+def test_deleted_index_is_reported_missing(tmp_path):
+    cache = VectorStoreCache(lambda path: "store")
+    path = make_index(str(tmp_path), "gone", 10)
+    assert cache.get(path) == "store"
+    shutil.rmtree(path)
+    with pytest.raises(IndexMissing):
+        cache.get(path)
+    assert path not in cache._entries
@@ -0,0 +1,103 @@
+import re
+import zlib
+from collections import Counter
+
+import numpy as np
+
+
+# --- Pre-embedding cleanup: running headers/footers and near-duplicate chunks ---
+
+EDGE_LINES = 3 # Lines at the top and bottom of a page that may be a running header/footer
+# Digits, or a lower-case roman numeral as used for front matter ("xiv"); upper case is left alone so section
+# numbers and words like "VII", "XL" or "Cl" survive. The lookahead keeps the numeral from matching empty.
+_ROMAN_PAGE = r"(?=[ivxlcdm])m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})"
+_PAGE_NUMBER_RE = re.compile(rf"^((?i:page)\s*)?(\d+|{_ROMAN_PAGE})(\s*((?i:of)|/)\s*\d+)?$")
+
+
+def split_pages(extracted):
+    """Splits an ExtractedText back into per-page strings using its page offsets."""
+    offsets = list(extracted.page_offsets) + [len(extracted.text) + 1]
+    return [extracted.text[offsets[i]:offsets[i + 1] - 1] for i in range(len(extracted.page_offsets))]
+
+
+def _line_signature(line):
+    """Normalises a line so "Chapter 3 - Page 41" and "Chapter 3 - Page 42" compare equal."""
+    return re.sub(r"\d+", "#", " ".join(line.lower().split()))
+
+
+def strip_repeated_lines(pages, min_fraction=0.5, min_pages=3):
+    """
+    Removes running headers, footers and bare page numbers. A line near the top or bottom of a page is
+    dropped when (ignoring digits and spacing) it appears in that zone on at least min_fraction of the
+    pages, and on at least min_pages pages. Returns (cleaned pages, number of lines removed).
+    """
+    page_lines = [page.split("\n") for page in pages]
+
+    def edge_indexes(lines):
+        depth = max(1, min(EDGE_LINES, len(lines) // 4)) # Short pages: only the very first/last line can be a header/footer
+        return set(range(min(depth, len(lines)))) | set(range(max(0, len(lines) - depth), len(lines)))
+
+    seen_on_pages = Counter()
+    for lines in page_lines:
+        seen_on_pages.update({_line_signature(lines[i]) for i in edge_indexes(lines) if lines[i].strip()})
+    threshold = max(min_pages, min_fraction * len(pages))
+    repeated = {sig for sig, count in seen_on_pages.items() if count >= threshold}
+
+    cleaned, removed = [], 0
+    for lines in page_lines:
+        edges = edge_indexes(lines)
+        kept = []
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            if i in edges and stripped and (_line_signature(line) in repeated or _PAGE_NUMBER_RE.match(stripped)):
+                removed += 1
+                continue
+            kept.append(line)
+        cleaned.append("\n".join(kept))
+    return cleaned, removed
+
+
+_HASH_PRIME = 4294967291 # Largest prime below 2**32, so (a * x + b) stays within uint64 for 32-bit shingles
+
+
+def _shingles(text, size):
+    words = text.lower().split()
+    if len(words) <= size:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))}
+    return {zlib.crc32(" ".join(words[i:i + size]).encode("utf-8")) for i in range(len(words) - size + 1)}
+
+
+def minhash_signatures(texts, num_perm=64, shingle_size=5, seed=1):
+    """Returns a (len(texts), num_perm) array of MinHash signatures over word shingles."""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _HASH_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, _HASH_PRIME, size=num_perm, dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for row, text in enumerate(texts):
+        shingles = np.fromiter(_shingles(text, shingle_size), dtype=np.uint64)
+        hashed = (np.outer(shingles, a) + b) % np.uint64(_HASH_PRIME) # (a * x + b) mod p per shingle and permutation
+        signatures[row] = hashed.min(axis=0)
+    return signatures
+
+
+def drop_near_duplicates(chunks, threshold=0.85, num_perm=64, bands=16):
+    """
+    Drops chunks whose estimated Jaccard similarity (MinHash over 5-word shingles) with an earlier kept chunk
+    is at least threshold. Candidates come from LSH banding, so cost stays roughly linear in the number of chunks.
+    Returns (kept chunks, indexes of the kept chunks in the input, number dropped).
+    """
+    if len(chunks) < 2:
+        return list(chunks), list(range(len(chunks))), 0
+    signatures = minhash_signatures(chunks, num_perm=num_perm)
+    rows = num_perm // bands
+    buckets = {}
+    kept_indexes = []
+    for i, signature in enumerate(signatures):
+        keys = [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(bands)]
+        candidates = {j for key in keys for j in buckets.get(key, ())}
+        if any(np.mean(signatures[j] == signature) >= threshold for j in candidates):
+            continue
+        kept_indexes.append(i)
+        for key in keys:
+            buckets.setdefault(key, []).append(i)
+    return [chunks[i] for i in kept_indexes], kept_indexes, len(chunks) - len(kept_indexes)
@@ -0,0 +1,82 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+# --- Per-worker LRU of loaded vector stores ---
+
+class IndexMissing(LookupError):
+    """The index directory was deleted (quota sweeper, node cache eviction) before it could be loaded."""
+
+
+def index_fingerprint(index_path):
+    """Returns (latest mtime, total bytes) of the files that make up a saved index."""
+    latest_mtime, total_bytes = 0.0, 0
+    for name in os.listdir(index_path):
+        st = os.stat(os.path.join(index_path, name))
+        latest_mtime = max(latest_mtime, st.st_mtime)
+        total_bytes += st.st_size
+    return latest_mtime, total_bytes
+
+
+class VectorStoreCache:
+    """
+    Keeps recently used vector stores loaded in memory, keyed by index path.
+    Entries are reloaded when the files on disk change (mtime), and the least recently used
+    stores are dropped once their combined size (approximated by on-disk size) exceeds max_bytes.
+    """
+
+    def __init__(self, loader, max_bytes=512 * 1024 * 1024, load_lock_stripes=64):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # index_path -> (store, mtime, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._load_locks = [threading.Lock() for _ in range(load_lock_stripes)] # Fixed size, however many indexes
+
+    def get(self, index_path):
+        """
+        Returns the loaded store for index_path, loading it (once per change on disk) if needed.
+        Raises IndexMissing if the index has been deleted.
+        """
+        try:
+            mtime, nbytes = index_fingerprint(index_path)
+        except FileNotFoundError:
+            self.invalidate(index_path)
+            raise IndexMissing(f"Index {index_path} no longer exists.")
+        with self._lock:
+            entry = self._entries.get(index_path)
+            if entry and entry[1] == mtime:
+                self._entries.move_to_end(index_path)
+                return entry[0]
+        load_lock = self._load_locks[hash(index_path) % len(self._load_locks)]
+        with load_lock: # Concurrent questions on the same cold index load it only once
+            with self._lock:
+                entry = self._entries.get(index_path)
+                if entry and entry[1] == mtime:
+                    self._entries.move_to_end(index_path)
+                    return entry[0]
+            try:
+                store = self.loader(index_path)
+            except FileNotFoundError:
+                raise IndexMissing(f"Index {index_path} no longer exists.")
+            logging.info(f"[VECTOR_CACHE] Loaded index {index_path} ({nbytes} bytes).")
+            with self._lock:
+                self._drop(index_path)
+                self._entries[index_path] = (store, mtime, nbytes)
+                self._bytes += nbytes
+                while self._bytes > self.max_bytes and len(self._entries) > 1:
+                    evicted_path = next(iter(self._entries))
+                    self._drop(evicted_path)
+                    logging.info(f"[VECTOR_CACHE] Evicted index {evicted_path}.")
+            return store
+
+    def invalidate(self, index_path):
+        with self._lock:
+            self._drop(index_path)
+
+    def _drop(self, index_path):
+        entry = self._entries.pop(index_path, None)
+        if entry:
+            self._bytes -= entry[2]